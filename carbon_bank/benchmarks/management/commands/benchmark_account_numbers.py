@@ -0,0 +1,108 @@
+import itertools
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+
+from management.account_numbers import BLOCK_SIZE, AccountNumberAllocator, format_account_number
+
+TABLE = 'bench_account_numbers'
+LEGACY_ALPHABET = '0123456789ABCDEFGHIKLMNOPRS'
+
+
+def random_numbers(rng):
+    """The previous generator: 13 random characters."""
+    while True:
+        yield ''.join(rng.choices(LEGACY_ALPHABET, k=13))
+
+
+def block_numbers(workers):
+    """Block allocated numbers as ``workers`` processes creating accounts at the same rate insert them."""
+    counter = itertools.count(1, BLOCK_SIZE)
+    blocks = [iter(()) for _ in range(workers)]
+    while True:
+        for worker in range(workers):
+            number = next(blocks[worker], None)
+            if number is None:
+                start = next(counter)
+                blocks[worker] = iter(range(start, start + BLOCK_SIZE))
+                number = next(blocks[worker])
+            yield format_account_number(number)
+
+
+class Command(BaseCommand):
+    help = ('Insert account numbers from the previous random generator and from block allocation '
+            'into scratch tables with a unique index, and compare insert throughput and index size. '
+            'Also measures the allocator itself. PostgreSQL only.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=10_000_000)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--workers', type=int, default=8, help='Processes allocating blocks concurrently.')
+        parser.add_argument('--allocations', type=int, default=100_000,
+                            help='Account numbers requested one by one from the allocator.')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Index sizes are read from PostgreSQL, run this against a PostgreSQL database.')
+
+        strategies = {
+            'random': random_numbers(random.Random(options['seed'])),
+            'blocks': block_numbers(options['workers']),
+        }
+        self.stdout.write(f'{"strategy":<10}{"rows/s":>12}{"last 10% rows/s":>17}{"index MB":>10}{"leaf density":>14}')
+        for name, numbers in strategies.items():
+            result = self.load(name, numbers, options['accounts'], options['batch_size'])
+            self.stdout.write(
+                f'{name:<10}{result["rate"]:>12.0f}{result["tail_rate"]:>17.0f}'
+                f'{result["index_bytes"] / 2 ** 20:>10.1f}{result["leaf_density"]:>14}'
+            )
+
+        allocator = AccountNumberAllocator()
+        started = time.perf_counter()
+        for _ in range(options['allocations']):
+            allocator.allocate()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'allocator: {options["allocations"] / elapsed:.0f} numbers/s, '
+                          f'{allocator.blocks} sequence round trips')
+
+    def load(self, name, numbers, accounts, batch_size):
+        table = f'{TABLE}_{name}'
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+            cursor.execute(f'CREATE TABLE {table} (id bigserial PRIMARY KEY, account_number varchar(15) UNIQUE)')
+
+        timings = []
+        for offset in range(0, accounts, batch_size):
+            batch = list(itertools.islice(numbers, min(batch_size, accounts - offset)))
+            started = time.perf_counter()
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'INSERT INTO {table} (account_number) SELECT unnest(%s::varchar[])', [batch])
+            timings.append((len(batch), time.perf_counter() - started))
+
+        tail = timings[-max(1, len(timings) // 10):]
+        with connection.cursor() as cursor:
+            cursor.execute(f'VACUUM ANALYZE {table}')
+            cursor.execute("SELECT pg_relation_size(%s)", [f'{table}_account_number_key'])
+            index_bytes = cursor.fetchone()[0]
+            leaf_density = self.leaf_density(cursor, f'{table}_account_number_key')
+            cursor.execute(f'DROP TABLE {table}')
+        return {
+            'rate': sum(rows for rows, _ in timings) / sum(seconds for _, seconds in timings),
+            'tail_rate': sum(rows for rows, _ in tail) / sum(seconds for _, seconds in tail),
+            'index_bytes': index_bytes,
+            'leaf_density': leaf_density,
+        }
+
+    @staticmethod
+    def leaf_density(cursor, index):
+        """Average fill of the index leaf pages in percent, needs the pgstattuple extension."""
+        try:
+            with transaction.atomic():
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pgstattuple')
+                cursor.execute('SELECT avg_leaf_density FROM pgstatindex(%s)', [index])
+                return f'{cursor.fetchone()[0]:.1f}%'
+        except DatabaseError:
+            return 'n/a'
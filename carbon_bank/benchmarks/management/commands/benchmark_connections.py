@@ -0,0 +1,72 @@
+import copy
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished
+from django.db import close_old_connections, connection
+from django.db.backends.signals import connection_created
+
+from benchmarks.runner import run_scenario
+from benchmarks.scenarios import SCENARIOS, BenchmarkContext
+
+MODES = {
+    # Stock Django behaviour before pooling: a new connection for every request.
+    'per-request': {'CONN_MAX_AGE': 0, 'POOL': {'ENABLED': False}},
+    'persistent': {'CONN_MAX_AGE': 600, 'POOL': {'ENABLED': False}},
+    'pool': {'CONN_MAX_AGE': 0, 'POOL': {'ENABLED': True}},
+}
+
+
+class Command(BaseCommand):
+    help = ('Run the get-balance scenario with a new connection per request, persistent '
+            'connections and the connection pool, and compare latency and connections opened.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', default='get-balance', choices=sorted(SCENARIOS))
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stderr.write(f'Running against {connection.vendor}: connection setup is nearly free, '
+                              f'the numbers below say little about Postgres.')
+        try:
+            context = BenchmarkContext(seed=options['seed'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        def finish_request(**kwargs):
+            # The test client keeps connections open across requests, release them as a
+            # server would so CONN_MAX_AGE and the pool are exercised.
+            close_old_connections()
+
+        original = copy.deepcopy(connection.settings_dict)
+        connection_created.connect(count_connection)
+        request_finished.connect(finish_request)
+        self.stdout.write(f'{"mode":<14}{"req":>6}{"p50 ms":>9}{"p95 ms":>9}{"connects":>10}')
+        try:
+            for mode, overrides in MODES.items():
+                connection.close()
+                connection.settings_dict['CONN_MAX_AGE'] = overrides['CONN_MAX_AGE']
+                connection.settings_dict['POOL'] = {**original.get('POOL', {}), **overrides['POOL']}
+                del opened[:]
+
+                summary = run_scenario(
+                    options['scenario'], SCENARIOS[options['scenario']], context,
+                    options['requests'], options['warmup'],
+                ).summary()
+                self.stdout.write(
+                    f'{mode:<14}{summary["requests"]:>6}{summary["p50_ms"]:>9.2f}'
+                    f'{summary["p95_ms"]:>9.2f}{len(opened):>10}'
+                )
+        finally:
+            connection_created.disconnect(count_connection)
+            request_finished.disconnect(finish_request)
+            connection.close()
+            connection.settings_dict.clear()
+            connection.settings_dict.update(original)
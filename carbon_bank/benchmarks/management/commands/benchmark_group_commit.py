@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+
+from benchmarks.seeding import seed_customers
+from customers.models import Customer
+from management.api.serializers import DepositTransactionSerializer
+from management.group_commit import get_deposit_batcher
+
+
+class Command(BaseCommand):
+    help = ('Make concurrent deposits with a transaction per deposit and with group commit, and '
+            'compare throughput, latency and the number of commits. PostgreSQL only.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=64)
+        parser.add_argument('--deposits', type=int, default=20000)
+        parser.add_argument('--max-batch', type=int, default=settings.DEPOSIT_GROUP_COMMIT['MAX_BATCH'])
+        parser.add_argument('--max-wait-ms', type=float, default=settings.DEPOSIT_GROUP_COMMIT['MAX_WAIT'] * 1000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('SQLite serializes all writers, run this against a PostgreSQL database.')
+
+        threads = options['threads']
+        account_ids = seed_customers(threads)
+        customers = list(Customer.objects.select_related('bankaccount').filter(bankaccount__pk__in=account_ids))
+
+        self.stdout.write(f'{"mode":<14}{"deposits/s":>12}{"p50 ms":>9}{"p95 ms":>9}{"commits":>9}')
+        for mode, enabled in (('per-request', False), ('group-commit', True)):
+            with override_settings(DEPOSIT_GROUP_COMMIT={
+                'ENABLED': enabled,
+                'MAX_BATCH': options['max_batch'],
+                'MAX_WAIT': options['max_wait_ms'] / 1000,
+            }):
+                batcher = get_deposit_batcher()
+                rate, p50, p95 = self.run(customers, options['deposits'], threads)
+            commits = batcher.batches if batcher is not None else options['deposits']
+            self.stdout.write(f'{mode:<14}{rate:>12.0f}{p50:>9.2f}{p95:>9.2f}{commits:>9}')
+
+    @staticmethod
+    def run(customers, deposits, threads):
+        serializer = DepositTransactionSerializer()
+
+        def deposit(index):
+            started = time.perf_counter()
+            serializer.create({'sender': customers[index % len(customers)], 'amount': Decimal('1.00')})
+            return time.perf_counter() - started
+
+        closing = threading.Barrier(threads)
+
+        def close(_):
+            # The barrier holds every worker until all took a task: each closes its own connection.
+            closing.wait()
+            connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(executor.map(deposit, range(deposits)))
+            list(executor.map(close, range(threads)))
+        elapsed = time.perf_counter() - started
+        return (deposits / elapsed, latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.95)] * 1000)
@@ -0,0 +1,77 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from benchmarks.seeding import seed_customers
+from customers.models import Customer
+from management.api.serializers import TransferTransactionSerializer
+from management.hot_accounts import set_hot_shards, sweep_shards
+from management.locking import lock_stats
+from management.models import BankAccount, BankTransaction
+
+
+class Command(BaseCommand):
+    help = ('Transfer from many senders into one account concurrently, with the account as a single '
+            'balance row and spread over balance shards, and compare throughput. PostgreSQL only.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--transfers', type=int, default=5000)
+        parser.add_argument('--shards', type=int, default=settings.HOT_ACCOUNT_SHARDS)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('SQLite serializes all writers, run this against a PostgreSQL database.')
+
+        threads = options['threads']
+        receiver_id, *sender_ids = seed_customers(threads + 1)
+        receiver = BankAccount.objects.get(pk=receiver_id)
+        senders = list(Customer.objects.select_related('bankaccount').filter(bankaccount__pk__in=sender_ids))
+        BankTransaction.objects.post([
+            BankTransaction(bank_account=sender.bankaccount, sender=sender, receiver=sender,
+                            amount=options['transfers'], is_debit=False, description='Amount deposit')
+            for sender in senders
+        ])
+
+        self.stdout.write(f'{"mode":<12}{"transfers/s":>13}{"p95 ms":>9}{"retries":>9}')
+        try:
+            for mode, shards in (('single-row', 0), ('sharded', options['shards'])):
+                set_hot_shards(receiver, shards)
+                lock_stats.reset()
+                rate, p95 = self.run(senders, receiver.account_number, options['transfers'], threads)
+                self.stdout.write(f'{mode:<12}{rate:>13.0f}{p95:>9.2f}{lock_stats.snapshot()["retries"]:>9}')
+        finally:
+            set_hot_shards(receiver, 0)
+            sweep_shards()
+
+    @staticmethod
+    def run(senders, account_number, transfers, threads):
+        serializer = TransferTransactionSerializer()
+
+        def transfer(index):
+            started = time.perf_counter()
+            serializer.create({
+                'sender': senders[index % len(senders)],
+                'destination_account_number': account_number,
+                'amount': Decimal('1.00'),
+            })
+            return time.perf_counter() - started
+
+        closing = threading.Barrier(threads)
+
+        def close(_):
+            # The barrier holds every worker until all took a task: each closes its own connection.
+            closing.wait()
+            connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(executor.map(transfer, range(transfers)))
+            list(executor.map(close, range(threads)))
+        elapsed = time.perf_counter() - started
+        return transfers / elapsed, latencies[int(len(latencies) * 0.95)] * 1000
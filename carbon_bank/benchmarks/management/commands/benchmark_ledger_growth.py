@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from benchmarks.runner import percentile, run_scenario
+from benchmarks.scenarios import SCENARIOS, BenchmarkContext
+from benchmarks.seeding import BENCH_PREFIX, seed_customers, seed_ledger, vacuum_analyze
+from management import partitions
+from management.models import AccountPeriodBalance, BankAccount, BankTransaction
+from management.periods import PeriodError, close_period
+
+
+class Command(BaseCommand):
+    help = ('Grow the ledger in steps and measure ledger balance computation and transaction '
+            'history latency after each one. Closes the ledger at the start of the current month '
+            'after every step, so only the open period is aggregated. Use a dedicated database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--steps', type=int, nargs='+', default=[100_000, 1_000_000, 5_000_000],
+                            help='Ledger sizes to measure at, in rows.')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--skew', type=float, default=3.0)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs.')
+        parser.add_argument('--no-close', dest='close', action='store_false',
+                            help='Do not close the ledger period, to compare against a full scan.')
+
+    def handle(self, *args, **options):
+        if AccountPeriodBalance.objects.exclude(
+            bank_account__owner__user__username__startswith=BENCH_PREFIX,
+        ).exists():
+            raise CommandError('Closing balances of real accounts exist, run this on a benchmark database.')
+
+        account_ids = list(BankAccount.objects.filter(
+            owner__user__username__startswith=BENCH_PREFIX,
+        ).order_by('pk').values_list('pk', flat=True))
+        if len(account_ids) < options['customers']:
+            account_ids += seed_customers(options['customers'] - len(account_ids))
+
+        self.stdout.write(f'partitioned: {partitions.is_partitioned()}, closed periods: {options["close"]}')
+        self.stdout.write(f'{"rows":>12}{"balance p50":>13}{"balance p95":>13}{"history p50":>13}{"history p95":>13}')
+        for target in sorted(options['steps']):
+            missing = target - BankTransaction.objects.count()
+            if missing > 0:
+                seed_ledger(account_ids, missing, skew=options['skew'])
+            # Seeding backdates rows, so the closing balances are rebuilt for every step.
+            AccountPeriodBalance.objects.all().delete()
+            if options['close']:
+                try:
+                    close_period(partitions.month_start(timezone.now()))
+                except PeriodError as exc:
+                    raise CommandError(str(exc))
+            vacuum_analyze()
+
+            context = BenchmarkContext(skew=options['skew'], seed=options['seed'])
+            balance = sorted(self.time_balance(context) for _ in range(options['requests']))
+            history = run_scenario(
+                'transaction-list', SCENARIOS['transaction-list'], context, options['requests'],
+            ).summary()
+            self.stdout.write(
+                f'{target:>12}{percentile(balance, 50) * 1000:>13.2f}{percentile(balance, 95) * 1000:>13.2f}'
+                f'{history["p50_ms"]:>13.2f}{history["p95_ms"]:>13.2f}'
+            )
+
+    @staticmethod
+    def time_balance(context):
+        account_number = context.pick().account_number
+        started = time.perf_counter()
+        BankAccount.objects.with_ledger_balance().get(account_number=account_number).ledger_balance
+        return time.perf_counter() - started
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+
+from benchmarks.seeding import seed_customers, seed_ledger, vacuum_analyze
+from management.models import BankAccount, BankTransaction, signed_amount_sum
+
+
+class Command(BaseCommand):
+    help = ('Seed a large ledger and EXPLAIN the balance and history queries to check that '
+            'they are served by the ledger indexes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-rows', type=int, default=0,
+                            help='Ledger rows to seed before explaining, e.g. 10000000. Default: none.')
+        parser.add_argument('--customers', type=int, default=100_000,
+                            help='Benchmark customers to create when seeding.')
+        parser.add_argument('--skew', type=float, default=3.0,
+                            help='Account skew exponent, higher means hotter top accounts.')
+
+    def handle(self, *args, **options):
+        if options['seed_rows']:
+            self.stdout.write(f'Seeding {options["customers"]} customers...')
+            account_ids = seed_customers(options['customers'])
+            self.stdout.write(f'Seeding {options["seed_rows"]} ledger rows...')
+            seed_ledger(account_ids, options['seed_rows'], skew=options['skew'])
+        vacuum_analyze()
+
+        busiest = BankTransaction.objects.values('bank_account', 'bank_account__owner').order_by()
+        busiest = busiest.annotate(rows=Count('id')).order_by('-rows').first()
+        if busiest is None:
+            self.stderr.write('The ledger is empty, use --seed-rows.')
+            return
+        account_id, customer_id = busiest['bank_account'], busiest['bank_account__owner']
+
+        balance = BankTransaction.objects.filter(
+            bank_account_id=account_id,
+            is_deleted=False,
+        ).order_by().values('bank_account').annotate(total=signed_amount_sum())
+        history = BankTransaction.objects.filter(
+            bank_account__owner_id=customer_id,
+            is_deleted=False,
+        ).order_by('-created_date', '-id')[:100]
+
+        self.stdout.write(f'Ledger rows: {BankTransaction.objects.count()}, '
+                          f'accounts: {BankAccount.objects.count()}, account explained: {account_id}')
+        self._explain('Balance aggregation', balance, expect='Index Only Scan')
+        self._explain('Transaction history', history, expect='ledger_account_history_idx')
+
+    def _explain(self, title, queryset, expect):
+        if connection.vendor == 'postgresql':
+            plan = queryset.explain(analyze=True, buffers=True)
+        else:
+            plan = queryset.explain()
+
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(plan)
+        if expect in plan:
+            self.stdout.write(self.style.SUCCESS(f'-> plan uses {expect}'))
+        else:
+            self.stdout.write(self.style.WARNING(f'-> plan does not use {expect}'))
@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.runner import run_scenario
+from benchmarks.scenarios import SCENARIOS, BenchmarkContext
+
+
+class Command(BaseCommand):
+    help = ('Run the API scenarios in-process against the seeded benchmark data and report '
+            'p50/p95/p99 latency, throughput and queries per request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                            help=f'Scenarios to run, default all of: {", ".join(SCENARIOS)}.')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--skew', type=float, default=3.0)
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs.')
+        parser.add_argument('--json', action='store_true', help='Print one JSON object per scenario.')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenario(s): {", ".join(sorted(unknown))}.')
+
+        try:
+            context = BenchmarkContext(skew=options['skew'], seed=options['seed'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if not options['json']:
+            self.stdout.write(f'{"scenario":<18}{"req":>6}{"rps":>9}{"p50 ms":>9}{"p95 ms":>9}'
+                              f'{"p99 ms":>9}{"q/req":>7}  statuses')
+        for name in names:
+            summary = run_scenario(
+                name, SCENARIOS[name], context, options['requests'], options['warmup'],
+            ).summary()
+            if options['json']:
+                self.stdout.write(json.dumps(summary))
+                continue
+            self.stdout.write(
+                f'{name:<18}{summary["requests"]:>6}{summary["throughput_rps"]:>9.1f}'
+                f'{summary["p50_ms"]:>9.2f}{summary["p95_ms"]:>9.2f}{summary["p99_ms"]:>9.2f}'
+                f'{summary["queries_per_request"]:>7.1f}  {summary["statuses"]}'
+            )
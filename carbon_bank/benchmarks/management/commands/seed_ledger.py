@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from benchmarks.seeding import seed_customers, seed_ledger, vacuum_analyze
+
+
+class Command(BaseCommand):
+    help = 'Bulk seed benchmark customers, bank accounts and a skewed ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--transactions', type=int, default=100_000)
+        parser.add_argument('--skew', type=float, default=3.0,
+                            help='Account skew exponent, higher means hotter top accounts.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Seeding {options["customers"]} customers...')
+        account_ids = seed_customers(options['customers'])
+        self.stdout.write(f'Seeding {options["transactions"]} ledger rows...')
+        seed_ledger(account_ids, options['transactions'], skew=options['skew'])
+        vacuum_analyze()
+        self.stdout.write(self.style.SUCCESS('Done.'))
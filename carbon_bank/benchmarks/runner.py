@@ -0,0 +1,66 @@
+import math
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    latencies: list = field(default_factory=list)
+    queries: list = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    elapsed: float = 0.0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'scenario': self.name,
+            'requests': count,
+            'throughput_rps': count / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_request': sum(self.queries) / count if count else 0.0,
+            'max_queries': max(self.queries, default=0),
+            'statuses': dict(sorted(self.statuses.items())),
+        }
+
+
+def run_scenario(name, scenario, context, requests, warmup=10):
+    """
+        Drive ``scenario`` through the full WSGI request handler in-process, one request at a
+        time, and collect latency, status code and SQL query count per request.
+    """
+    client = APIClient()
+    result = ScenarioResult(name)
+
+    for index in range(warmup + requests):
+        user, method, path, data = scenario(context)
+        client.force_authenticate(user=user)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data, format='json')
+            duration = time.perf_counter() - started
+        if index < warmup:
+            continue
+
+        result.latencies.append(duration)
+        result.queries.append(len(captured))
+        result.statuses[response.status_code] += 1
+        result.elapsed += duration
+
+    return result
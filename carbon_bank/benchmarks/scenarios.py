@@ -0,0 +1,97 @@
+import random
+from dataclasses import dataclass
+
+from django.contrib.auth.models import User
+from rest_framework.reverse import reverse
+
+from benchmarks.seeding import BENCH_PREFIX
+from management.models import BankAccount
+
+BENCH_ADMIN = f'{BENCH_PREFIX}admin'
+
+
+@dataclass
+class Principal:
+    user: User
+    customer_id: int
+    account_number: str
+
+
+class BenchmarkContext:
+    """
+        Users the scenarios act as. Customers are drawn with the same ``random() ** skew``
+        distribution the seeder uses, so the hot accounts of the ledger are also the ones
+        hit hardest by the scenarios.
+    """
+
+    def __init__(self, skew=3.0, sample_size=1000, seed=None):
+        self.skew = skew
+        self.random = random.Random(seed)
+        self.admin = User.objects.filter(username=BENCH_ADMIN).first()
+        if self.admin is None:
+            self.admin = User.objects.create_superuser(BENCH_ADMIN, f'{BENCH_ADMIN}@carbonbank.com', None)
+
+        accounts = BankAccount.objects.with_owner().filter(
+            owner__user__username__startswith=BENCH_PREFIX,
+            is_active=True,
+        ).order_by('pk')[:sample_size]
+        self.principals = [
+            Principal(account.owner.user, account.owner_id, account.account_number) for account in accounts
+        ]
+        if len(self.principals) < 2:
+            raise ValueError('At least two active benchmark accounts are needed, run seed_ledger first.')
+
+    def pick(self):
+        return self.principals[int(self.random.random() ** self.skew * len(self.principals))]
+
+    def pick_other(self, principal):
+        while True:
+            other = self.pick()
+            if other is not principal:
+                return other
+
+
+def account_list(context):
+    return context.admin, 'get', reverse('management:account-list'), None
+
+
+def transaction_list(context):
+    return context.admin, 'get', reverse('management:transaction-list', args=[context.pick().customer_id]), None
+
+
+def get_balance(context):
+    return context.admin, 'get', reverse('customers:get-balance', args=[context.pick().customer_id]), None
+
+
+def customer_search(context):
+    query = context.pick().user.username.split('@')[0]
+    return context.admin, 'get', reverse('customers:list'), {'q': query}
+
+
+def deposit(context):
+    return context.pick().user, 'post', reverse('management:deposit'), {'amount': '100.00'}
+
+
+def withdraw(context):
+    return context.pick().user, 'post', reverse('management:withdraw'), {'amount': '1.00'}
+
+
+def transfer(context):
+    sender = context.pick()
+    receiver = context.pick_other(sender)
+    return sender.user, 'post', reverse('management:transfer'), {
+        'sender': sender.customer_id,
+        'destination_account_number': receiver.account_number,
+        'amount': '1.00',
+    }
+
+
+SCENARIOS = {
+    'account-list': account_list,
+    'transaction-list': transaction_list,
+    'get-balance': get_balance,
+    'customer-search': customer_search,
+    'deposit': deposit,
+    'withdraw': withdraw,
+    'transfer': transfer,
+}
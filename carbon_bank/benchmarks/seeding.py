@@ -0,0 +1,146 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from customers.models import Customer, customer_search_text
+from management.balance_cache import invalidate_balances
+from management import partitions
+from management.models import BankAccount, BankTransaction, ledger_balance_expression
+
+BENCH_PREFIX = 'bench-'
+BENCH_DESCRIPTION = 'Benchmark seed'
+# Seeded rows are spread over this many days back from now (PostgreSQL only).
+SEED_HISTORY_DAYS = 730
+
+
+def seed_customers(count, batch_size=5000):
+    """
+        Bulk create ``count`` active benchmark customers with their bank accounts.
+        Returns the created account ids in creation order.
+    """
+    password = make_password(None)
+    start = User.objects.filter(username__startswith=BENCH_PREFIX).count()
+    account_ids = []
+
+    for offset in range(0, count, batch_size):
+        numbers = range(start + offset, start + min(offset + batch_size, count))
+        with transaction.atomic():
+            usernames = [f'{BENCH_PREFIX}{number}@carbonbank.com' for number in numbers]
+            users = [
+                User(username=username, email=username, password=password,
+                     first_name='bench', last_name=str(number))
+                for number, username in zip(numbers, usernames)
+            ]
+            User.objects.bulk_create(users)
+            user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+
+            Customer.objects.bulk_create(
+                Customer(identity_number=f'{BENCH_PREFIX}{number}', address='benchmark', sex=Customer.MALE,
+                         user_id=user_ids[user.username],
+                         search_text=customer_search_text(user, f'{BENCH_PREFIX}{number}'))
+                for number, user in zip(numbers, users)
+            )
+            customer_ids = Customer.objects.filter(
+                user_id__in=user_ids.values(),
+            ).order_by('pk').values_list('pk', flat=True)
+
+            BankAccount.objects.bulk_create(
+                BankAccount(account_number=account_number, owner_id=customer_id, is_active=True)
+                for customer_id, account_number in zip(
+                    customer_ids, BankAccount.generate_account_numbers(len(customer_ids)),
+                )
+            )
+            account_ids.extend(BankAccount.objects.filter(
+                owner_id__in=customer_ids,
+            ).order_by('pk').values_list('pk', flat=True))
+
+    return account_ids
+
+
+def seed_ledger(account_ids, rows, skew=3.0, debit_ratio=0.3, batch_size=1_000_000):
+    """
+        Insert ``rows`` ledger rows spread over ``account_ids``. Account choice follows
+        ``random() ** skew``, so with the default skew the first few accounts receive most of
+        the traffic, like busy merchant accounts do. Balances are rebuilt afterwards.
+    """
+    if connection.vendor == 'postgresql':
+        _seed_ledger_postgresql(account_ids, rows, skew, debit_ratio, batch_size)
+    else:
+        _seed_ledger_python(account_ids, rows, skew, debit_ratio, min(batch_size, 10_000))
+    refresh_balances(account_ids)
+
+
+def _seed_ledger_postgresql(account_ids, rows, skew, debit_ratio, batch_size):
+    if partitions.is_partitioned():
+        now = timezone.now()
+        partitions.ensure_partitions(now - timedelta(days=SEED_HISTORY_DAYS), now)
+    table = BankTransaction._meta.db_table
+    account_table = BankAccount._meta.db_table
+    sql = f'''
+        INSERT INTO {table} (created_date, modified_date, is_deleted, amount, is_debit,
+                             description, bank_account_id, sender_id, receiver_id)
+        SELECT s.ts, s.ts, false, round((1 + random() * 999)::numeric, 2), random() < %(debit_ratio)s,
+               %(description)s, a.id, a.owner_id, a.owner_id
+        FROM (
+            SELECT now() - random() * %(history)s AS ts,
+                   (%(ids)s::bigint[])[1 + floor(power(random(), %(skew)s) * %(count)s)::int] AS account_id
+            FROM generate_series(1, %(rows)s)
+        ) s
+        JOIN {account_table} a ON a.id = s.account_id
+    '''
+    for offset in range(0, rows, batch_size):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, {
+                'ids': list(account_ids),
+                'count': len(account_ids),
+                'rows': min(batch_size, rows - offset),
+                'skew': skew,
+                'debit_ratio': debit_ratio,
+                'description': BENCH_DESCRIPTION,
+                'history': timedelta(days=SEED_HISTORY_DAYS),
+            })
+
+
+def _seed_ledger_python(account_ids, rows, skew, debit_ratio, batch_size):
+    owners = dict(BankAccount.objects.filter(pk__in=account_ids).values_list('pk', 'owner_id'))
+    for offset in range(0, rows, batch_size):
+        batch = []
+        for _ in range(min(batch_size, rows - offset)):
+            account_id = account_ids[int(random.random() ** skew * len(account_ids))]
+            batch.append(BankTransaction(
+                bank_account_id=account_id,
+                sender_id=owners[account_id],
+                receiver_id=owners[account_id],
+                amount=round(random.uniform(1, 1000), 2),
+                is_debit=random.random() < debit_ratio,
+                description=BENCH_DESCRIPTION,
+            ))
+        BankTransaction.objects.bulk_create(batch)
+
+
+def refresh_balances(account_ids):
+    """Recompute the materialized balance of the given accounts in one statement."""
+    ledger = BankTransaction.objects.filter(bank_account=OuterRef('pk')).order_by().values('bank_account')
+    BankAccount.objects.filter(pk__in=account_ids).update(
+        balance=ledger_balance_expression(),
+        balance_watermark=Coalesce(
+            Subquery(ledger.annotate(last=Max('id')).values('last')),
+            0, output_field=BankAccount._meta.get_field('balance_watermark'),
+        ),
+    )
+    invalidate_balances(account_ids)
+
+
+def vacuum_analyze():
+    """Refresh planner statistics and the visibility map so index-only scans are possible."""
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for model in (BankAccount, BankTransaction):
+            cursor.execute(f'VACUUM ANALYZE {model._meta.db_table}')
@@ -0,0 +1,27 @@
+from django.test import TestCase
+
+from management.models import BankAccount
+from .runner import percentile, run_scenario
+from .scenarios import SCENARIOS, BenchmarkContext
+from .seeding import seed_customers, seed_ledger
+
+
+class BenchmarkSuiteTest(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_seed_and_run_every_scenario(self):
+        account_ids = seed_customers(5)
+        seed_ledger(account_ids, 200)
+        for account in BankAccount.objects.filter(pk__in=account_ids):
+            self.assertEqual(account.balance, account.ledger_balance)
+
+        context = BenchmarkContext(seed=1)
+        for name, scenario in SCENARIOS.items():
+            summary = run_scenario(name, scenario, context, requests=3, warmup=0).summary()
+            self.assertEqual(summary['requests'], 3)
+            self.assertTrue(all(code < 500 for code in summary['statuses']), (name, summary))
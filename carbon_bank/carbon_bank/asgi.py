@@ -9,8 +9,9 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'carbon_bank.settings')
 
+# Django's handler, except that streaming responses are produced off the event loop.
+from cores.asgi import get_asgi_application  # noqa: E402
+
 application = get_asgi_application()
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import copy
+import datetime
 import os
 from pathlib import Path
 import sys
@@ -30,10 +32,12 @@ ALLOWED_HOSTS = ['*']
 # DRF config 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        # Needs no query, see cores/authentication.py. The others stay for existing clients:
+        # Token auth queries the token table and Basic auth hashes the password on every request.
+        'cores.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.TokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
-        # 'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema',
@@ -41,6 +45,124 @@ REST_FRAMEWORK = {
 }
 # 
 
+SIMPLE_JWT = {
+    # Claims are not re-read from the database, keep access tokens short lived.
+    'ACCESS_TOKEN_LIFETIME': datetime.timedelta(minutes=int(os.environ.get('JWT_ACCESS_TOKEN_MINUTES', '15'))),
+    'REFRESH_TOKEN_LIFETIME': datetime.timedelta(days=1),
+}
+# 'default' is local to the process. 'shared' is seen by every worker: memcached at
+# SHARED_CACHE_LOCATION (host:port, see docker-compose.yml), else a database table created
+# by `manage.py createcachetable`. cores/checks.py rejects a local cache where one has to be
+# shared and more than one worker runs.
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': os.environ['SHARED_CACHE_LOCATION'],
+    } if os.environ.get('SHARED_CACHE_LOCATION') else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'carbon_bank_cache',
+    },
+}
+# Revoked tokens, see cores/revocation.py. Must be shared by all workers.
+JWT_REVOCATION_CACHE = 'shared'
+
+# Banking config
+BATCH_TRANSFER_MAX_ITEMS = 1000
+# Retries for transfers aborted by a deadlock or serialization failure, delays in seconds.
+LEDGER_LOCK_RETRY_ATTEMPTS = 5
+LEDGER_LOCK_RETRY_BASE_DELAY = 0.02
+LEDGER_LOCK_RETRY_MAX_DELAY = 0.5
+# Withdrawals and transfers as one SQL statement on PostgreSQL, see management/fast_path.py.
+# Off until SQLFastPathParityTest and SQLFastPathAPITest run against PostgreSQL in CI.
+LEDGER_SQL_FAST_PATH = os.environ.get('LEDGER_SQL_FAST_PATH', '0') == '1'
+# Hot accounts (management/hot_accounts.py): default shard count of the hot_account command,
+# and seconds between two runs of sweep_balance_shards.
+HOT_ACCOUNT_SHARDS = 16
+BALANCE_SHARD_SWEEP_INTERVAL = 5.0
+# Deposits queued for up to MAX_WAIT seconds and committed together, see management/group_commit.py.
+DEPOSIT_GROUP_COMMIT = {
+    'ENABLED': os.environ.get('DEPOSIT_GROUP_COMMIT', '0') == '1',
+    'MAX_BATCH': int(os.environ.get('DEPOSIT_GROUP_COMMIT_MAX_BATCH', '100')),
+    'MAX_WAIT': float(os.environ.get('DEPOSIT_GROUP_COMMIT_MAX_WAIT_MS', '5')) / 1000,
+}
+# Seconds a stored Idempotency-Key response is replayed for.
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# A ledger period can be closed once it ended this long ago, see management/periods.py.
+LEDGER_CLOSE_GRACE = datetime.timedelta(hours=1)
+# Where archive_ledger writes the rows of closed periods.
+LEDGER_ARCHIVE_DIR = os.environ.get('LEDGER_ARCHIVE_DIR', os.path.join(os.path.dirname(BASE_DIR), 'ledger-archive'))
+# Ledger rows fetched per round trip while a statement export streams, see management/api/statements.py.
+STATEMENT_CHUNK_SIZE = 2000
+
+# Per-request query/latency instrumentation, see cores/instrumentation.py.
+# Fraction of requests measured, lower it to keep the overhead negligible under load.
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '1.0'))
+INSTRUMENTATION_SERVER_TIMING = True
+
+# 'wsgi' (gunicorn sync workers) or 'asgi' (gunicorn uvicorn workers, async money movement
+# and listing views), see gunicorn.conf.py and cores/async_views.py.
+SERVER_MODE = os.environ.get('CARBON_BANK_SERVER_MODE', 'wsgi')
+# Threads the async views run their database work on, per worker process.
+ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', '32'))
+# Gunicorn worker processes, see gunicorn.conf.py.
+SERVER_WORKERS = int(os.environ.get('GUNICORN_WORKERS', '1'))
+
+# Replicas lagging more than this many seconds are skipped, the lag is re-measured at most
+# every REPLICA_LAG_CHECK_INTERVAL seconds.
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '2'))
+REPLICA_LAG_CHECK_INTERVAL = 5
+# Seconds a user reads from the primary after a write, and the cache that remembers it.
+REPLICA_PIN_SECONDS = int(os.environ.get('DB_REPLICA_PIN_SECONDS', '5'))
+REPLICA_PIN_CACHE = 'shared'
+
+# Outbox events are delivered to these sinks by drain_outbox workers, see management/outbox.py.
+OUTBOX = {
+    'SINKS': [
+        {
+            'BACKEND': 'management.outbox.FileSink',
+            'OPTIONS': {'PATH': os.environ.get('OUTBOX_FILE', os.path.join(os.path.dirname(BASE_DIR), 'outbox.jsonl'))},
+        },
+    ],
+    'BATCH_SIZE': 500,
+    # Seconds an idle worker waits before polling again, and the longest wait after failures.
+    'POLL_INTERVAL': 1.0,
+    'RETRY_MAX_DELAY': 60.0,
+    # Failed deliveries after which an event is parked instead of blocking the queue.
+    'MAX_ATTEMPTS': 10,
+    # Statement, lock and idle-in-transaction timeout of a batch transaction (PostgreSQL).
+    # Sinks run inside it, so their own timeouts have to stay well below.
+    'TRANSACTION_TIMEOUT': 30.0,
+}
+if os.environ.get('OUTBOX_WEBHOOK_URL'):
+    OUTBOX['SINKS'].append({
+        'BACKEND': 'management.outbox.WebhookSink',
+        'OPTIONS': {'URL': os.environ['OUTBOX_WEBHOOK_URL'], 'TIMEOUT': 5.0},
+    })
+
+# Bulk onboarding (customers/onboarding.py): rows inserted per transaction, processes hashing
+# passwords in import_customers (the API hashes in the request's process), and the largest
+# import accepted by the API (the command has no limit).
+ONBOARDING_CHUNK_SIZE = 1000
+ONBOARDING_HASH_PROCESSES = int(os.environ.get('ONBOARDING_HASH_PROCESSES', os.cpu_count() or 1))
+ONBOARDING_MAX_ROWS = 10000
+
+# Cache of the get-balance response per account, see management/balance_cache.py.
+# 'shared' uses the CACHES entry BALANCE_CACHE_ALIAS. 'local' is an LRU per process: only
+# correct with a single worker and no other process moving money, management commands such
+# as rebuild_balances and sweep_balance_shards included, since invalidations stay in-process.
+BALANCE_CACHE = {
+    'local': {
+        'BACKEND': 'management.balance_cache.LocalBalanceCache',
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('BALANCE_CACHE_MAX_ENTRIES', '10000'))},
+    },
+    'shared': {
+        'BACKEND': 'management.balance_cache.SharedBalanceCache',
+        'OPTIONS': {'CACHE_ALIAS': os.environ.get('BALANCE_CACHE_ALIAS', 'shared')},
+    },
+}[os.environ.get('BALANCE_CACHE_BACKEND', 'shared')]
+BALANCE_CACHE['TIMEOUT'] = int(os.environ.get('BALANCE_CACHE_TIMEOUT', '60'))
+
 
 # Application definition
 
@@ -56,6 +178,7 @@ INSTALLED_APPS = [
     'cores',
     'customers',
     'management',
+    'benchmarks',
 
     # libs
     'django_extensions',
@@ -66,6 +189,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cores.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,6 +197,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'cores.db.replicas.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'carbon_bank.urls'
@@ -99,16 +224,43 @@ WSGI_APPLICATION = 'carbon_bank.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 #
+# Connection reuse (cores/db/backends/postgresql): persistent connections with a health
+# check on reuse by default; DB_POOL=1 switches to the in-process pool, which returns the
+# connection to the pool at the end of every request instead of keeping one per thread.
+DB_POOL_ENABLED = os.environ.get('DB_POOL', '0') == '1'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'cores.db.backends.postgresql',
         'NAME': 'databasepostgresql',
         'USER': 'databasepostgresql_user',
         'PASSWORD': 'databasepostgresql_password',
         'HOST': 'databasepostgresql',
         'PORT': '5432',
+        'CONN_MAX_AGE': 0 if DB_POOL_ENABLED else int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        'POOL': {
+            'ENABLED': DB_POOL_ENABLED,
+            'MAX_SIZE': int(os.environ.get('DB_POOL_MAX_SIZE', '10')),
+            'MAX_OVERFLOW': int(os.environ.get('DB_POOL_MAX_OVERFLOW', '5')),
+            'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', '5')),
+            'RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+        },
     }
 }
+
+# Read replicas for the listing and balance views, see cores/db/replicas.py.
+# DB_REPLICA_HOSTS is a comma separated list of hosts streaming from the primary.
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    DATABASE_REPLICAS.append(f'replica{_index}')
+    DATABASES[f'replica{_index}'] = {
+        **copy.deepcopy(DATABASES['default']), 'HOST': _host.strip(), 'TEST': {'MIRROR': 'default'},
+    }
+if not DATABASE_REPLICAS:
+    # Unused until listed in DATABASE_REPLICAS, the tests route reads to it.
+    DATABASES['replica'] = {**copy.deepcopy(DATABASES['default']), 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['cores.db.replicas.PrimaryReplicaRouter']
 #
 # DATABASES = {
 #    'default': {
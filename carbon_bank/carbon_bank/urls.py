@@ -18,11 +18,12 @@ from datetime import datetime
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.schemas import get_schema_view
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
 
+from cores.views import TokenObtainView, TokenRefreshView, TokenRevokeView, metrics_view
+
 schema_view = get_schema_view(
    openapi.Info(
       title="Carbon Bank API",
@@ -44,7 +45,9 @@ urlpatterns = [
     path('swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('token/', TokenObtainView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
-    path('rest-auth/', include('rest_auth.urls'))
+    path('token/revoke/', TokenRevokeView.as_view(), name='token_revoke'),
+    path('rest-auth/', include('rest_auth.urls')),
+    path('metrics/', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class CoresConfig(AppConfig):
+    name = 'cores'
+
+    def ready(self):
+        from . import checks  # noqa: F401
@@ -0,0 +1,47 @@
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+
+from cores.async_views import iterate_in_db_thread
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """
+        Django 3.2 iterates streaming response bodies on the event loop, where the ORM is not
+        allowed. Here they are produced on a database thread (statement exports read the
+        ledger while streaming) and sent as the parts arrive.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': self.response_headers(response),
+        })
+        async for part in iterate_in_db_thread(response):
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+    @staticmethod
+    def response_headers(response):
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return headers
+
+
+def get_asgi_application():
+    """``django.core.asgi.get_asgi_application`` with the handler above."""
+    django.setup(set_prefix=False)
+    return ASGIHandler()
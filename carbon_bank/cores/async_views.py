@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from cores.instrumentation import current_metrics, instrumented_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    """
+        Thread pool every async view hands its database work to. Its size caps how many
+        requests hold a database connection at once; any further in-flight requests wait as
+        cheap coroutines on the event loop instead of each holding a worker process.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.ASYNC_DB_THREADS,
+                    thread_name_prefix='carbon-bank-db',
+                )
+    return _executor
+
+
+def shutdown_db_executor():
+    """Close the connections of the database threads and stop them, before dropping a database."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return
+    # One task per thread: each waits for all the others, so every thread closes its own.
+    workers = executor._max_workers
+    barrier = threading.Barrier(workers)
+
+    def close():
+        barrier.wait()
+        connections.close_all()
+
+    for _ in range(workers):
+        executor.submit(close)
+    executor.shutdown(wait=True)
+
+
+def _call_in_db_thread(func, args, kwargs):
+    # Executor threads do not see request_started/request_finished, so connection
+    # housekeeping (CONN_MAX_AGE, broken connections) is done around every call.
+    close_old_connections()
+    try:
+        metrics = current_metrics()
+        if metrics is None:
+            return func(*args, **kwargs)
+        with instrumented_connections(metrics):
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """Await the synchronous, ORM using ``func`` on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_db_executor(),
+        functools.partial(context.run, _call_in_db_thread, func, args, kwargs),
+    )
+
+
+async def iterate_in_db_thread(iterable, buffer_size=8):
+    """
+        Async iterator over a synchronous, ORM using ``iterable``. The whole iteration runs
+        on one database thread, so a server-side cursor stays on the connection it was
+        opened on; at most ``buffer_size`` items wait for the consumer.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(buffer_size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            for item in iterable:
+                put((item, None))
+                if stopped.is_set():
+                    return
+            put((done, None))
+        except Exception as exc:
+            put((done, exc))
+
+    producer = asyncio.ensure_future(run_in_db_thread(produce))
+    try:
+        while True:
+            item, exc = await queue.get()
+            if exc is not None:
+                raise exc
+            if item is done:
+                break
+            yield item
+    finally:
+        # The consumer went away early (client disconnect): unblock the producer and let it finish.
+        stopped.set()
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+        producer.result()
+
+
+def async_api_view(view_class, **initkwargs):
+    """
+        ASGI native version of a DRF view. Authentication, permissions, serializers, the ORM
+        and rendering run as one unit on the database thread pool, the event loop only awaits.
+    """
+    sync_view = view_class.as_view(**initkwargs)
+
+    def handle(request, *args, **kwargs):
+        response = sync_view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    async def view(request, *args, **kwargs):
+        return await run_in_db_thread(handle, request, *args, **kwargs)
+
+    # Keeps the view name, csrf_exempt and the DRF ``cls`` attributes for resolvers and schema.
+    return functools.update_wrapper(view, sync_view)
+
+
+def server_view(view_class, **initkwargs):
+    """The view matching SERVER_MODE: ``async_api_view`` under ASGI, ``as_view`` under WSGI."""
+    if settings.SERVER_MODE == 'asgi':
+        return async_api_view(view_class, **initkwargs)
+    return view_class.as_view(**initkwargs)
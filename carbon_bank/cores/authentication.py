@@ -0,0 +1,109 @@
+"""
+JWT authentication that does not query the database.
+
+Tokens from ``token/`` carry, besides the user id, the user's username and staff flags and the
+pks of their customer and bank account. JWTAuthentication builds ``request.user`` from these
+claims, with ``user.customer`` and ``user.customer.bankaccount`` already loaded, so
+authentication, the permission checks and ``request.user.customer.pk`` cost no query. Other
+fields of these objects are deferred and load on first access.
+
+A token stays valid until it expires even if the user changed in between, so tokens are
+short lived and revoked when the password, the active or staff flags change (see
+cores/revocation.py and customers/models.py). The revocation check reads the shared cache,
+which is memcached when deployed and costs no query either. Tokens without these claims are
+rejected.
+"""
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers
+from rest_framework_simplejwt import authentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from customers.models import Customer
+from management.models import BankAccount
+from .revocation import is_revoked
+
+User = get_user_model()
+
+IDENTITY_CLAIMS = ('username', 'is_staff', 'is_superuser', 'customer_id', 'account_id')
+
+
+def _from_db(model, **values):
+    """A ``model`` instance as if loaded from the database with only ``values``, the other fields deferred."""
+    field_names = [field.attname for field in model._meta.concrete_fields if field.attname in values]
+    return model.from_db(DEFAULT_DB_ALIAS, field_names, [values[name] for name in field_names])
+
+
+def user_from_token(token):
+    user = _from_db(
+        User,
+        **{api_settings.USER_ID_FIELD: token[api_settings.USER_ID_CLAIM]},
+        username=token['username'],
+        is_staff=token['is_staff'],
+        is_superuser=token['is_superuser'],
+        is_active=True,
+    )
+    customer = None
+    if token['customer_id'] is not None:
+        customer = _from_db(Customer, id=token['customer_id'], user_id=user.pk)
+        Customer.user.field.set_cached_value(customer, user)
+        if token['account_id'] is not None:
+            account = _from_db(BankAccount, id=token['account_id'], owner_id=customer.pk)
+            BankAccount.owner.field.set_cached_value(account, customer)
+            BankAccount.owner.field.remote_field.set_cached_value(customer, account)
+    # Also caches a missing customer, hasattr(user, 'customer') is then False without a query.
+    Customer.user.field.remote_field.set_cached_value(user, customer)
+    return user
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if any(claim not in token for claim in IDENTITY_CLAIMS):
+            raise InvalidToken(_('Token has no identity claims, request a new one.'))
+        if is_revoked(token):
+            raise InvalidToken(_('Token is revoked.'))
+        return token
+
+    def get_user(self, validated_token):
+        return user_from_token(validated_token)
+
+
+class CustomerTokenObtainPairSerializer(TokenObtainPairSerializer):
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        customer_id, account_id = Customer.objects.filter(user=user).values_list(
+            'pk', 'bankaccount__pk',
+        ).first() or (None, None)
+        token['username'] = user.username
+        token['is_staff'] = user.is_staff
+        token['is_superuser'] = user.is_superuser
+        token['customer_id'] = customer_id
+        token['account_id'] = account_id
+        return token
+
+
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+
+    def validate(self, attrs):
+        if is_revoked(self.token_class(attrs['refresh'])):
+            raise InvalidToken(_('Token is revoked.'))
+        return super().validate(attrs)
+
+
+class RevokeTokenSerializer(serializers.Serializer):
+    refresh = serializers.CharField(required=False)
+
+    def validate_refresh(self, value):
+        try:
+            return RefreshToken(value)
+        except TokenError as exc:
+            raise InvalidToken(exc.args[0])
+
@@ -0,0 +1,59 @@
+"""
+System checks of the deployment settings.
+
+State that every worker must see, revoked tokens for instance, lives in a cache. A local
+memory cache only reaches the process that wrote it, which is fine with one worker and
+silently wrong with several. gunicorn.conf.py runs these checks before it starts the workers.
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def shared_cache_settings():
+    """``{setting: cache alias}`` of the caches that have to be shared by all workers."""
+    aliases = {'JWT_REVOCATION_CACHE': settings.JWT_REVOCATION_CACHE}
+    if settings.DATABASE_REPLICAS:
+        # Read-your-writes pins, see cores/db/replicas.py.
+        aliases['REPLICA_PIN_CACHE'] = settings.REPLICA_PIN_CACHE
+    if settings.BALANCE_CACHE['BACKEND'] == 'management.balance_cache.SharedBalanceCache':
+        aliases["BALANCE_CACHE['OPTIONS']['CACHE_ALIAS']"] = settings.BALANCE_CACHE.get(
+            'OPTIONS', {}).get('CACHE_ALIAS', 'default')
+    return aliases
+
+
+@register(Tags.caches)
+def check_shared_caches(app_configs, **kwargs):
+    local_balances = settings.BALANCE_CACHE['BACKEND'] == 'management.balance_cache.LocalBalanceCache'
+    if settings.SERVER_WORKERS <= 1:
+        if local_balances:
+            # Management commands run in their own process: their invalidations stay there.
+            return [Warning(
+                'The local balance cache serves stale balances after money moves in any other '
+                'process, such as rebuild_balances or sweep_balance_shards.',
+                hint='Only use it when the server is the only process writing ledger rows, '
+                     'otherwise set BALANCE_CACHE_BACKEND=shared.',
+                id='cores.W001',
+            )]
+        return []
+    errors = []
+    for name, alias in shared_cache_settings().items():
+        if settings.CACHES[alias]['BACKEND'] in LOCAL_CACHE_BACKENDS:
+            errors.append(Error(
+                f"{name} names the cache '{alias}', which is local to each of the "
+                f"{settings.SERVER_WORKERS} worker processes.",
+                hint="Point it at a cache shared by all workers, such as CACHES['shared'].",
+                id='cores.E001',
+            ))
+    if local_balances:
+        # Invalidations only reach the LRU of the process that moved the money.
+        errors.append(Error(
+            f'The local balance cache would serve stale balances with {settings.SERVER_WORKERS} workers.',
+            hint='Set BALANCE_CACHE_BACKEND=shared.',
+            id='cores.E002',
+        ))
+    return errors
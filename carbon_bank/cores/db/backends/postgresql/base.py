@@ -0,0 +1,90 @@
+"""
+PostgreSQL backend with health checks for persistent connections and an optional
+in-process connection pool.
+
+    'ENGINE': 'cores.db.backends.postgresql',
+    'CONN_MAX_AGE': 60,             # persistent connections, as with the stock backend
+    'CONN_HEALTH_CHECKS': True,     # SELECT 1 on the first use of a reused connection per request
+    'POOL': {                       # optional, use with CONN_MAX_AGE = 0
+        'ENABLED': True,
+        'MAX_SIZE': 10, 'MAX_OVERFLOW': 5, 'TIMEOUT': 5.0, 'RECYCLE': 1800,
+    },
+
+With the pool enabled, closing a connection (end of request for WSGI, end of every
+database call for the async views) returns it to the pool instead of closing the socket,
+so neither the TCP/TLS handshake nor authentication is paid per request.
+"""
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+from cores.db.pool import PoolTimeout, get_pool
+
+Database = base.Database
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+        self.pooled = False
+        self.discard_on_close = False
+
+    @property
+    def pool_options(self):
+        return self.settings_dict.get('POOL') or {}
+
+    def get_new_connection(self, conn_params):
+        self.pooled = self.pool_options.get('ENABLED', False)
+        if not self.pooled:
+            return super().get_new_connection(conn_params)
+
+        pool = get_pool(self.alias, self.pool_options)
+        try:
+            connection = pool.acquire(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        except PoolTimeout as exc:
+            raise Database.OperationalError(str(exc)) from exc
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None or not self.pooled:
+            return super()._close()
+
+        pool = get_pool(self.alias, self.pool_options)
+        # A connection closed inside an atomic block stays referenced by this wrapper,
+        # so it must never be handed to another thread.
+        discard = self.discard_on_close or self.in_atomic_block or self.connection.closed
+        self.discard_on_close = False
+        if not discard:
+            try:
+                if self.connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    self.connection.rollback()
+            except Database.Error:
+                discard = True
+        pool.release(self.connection, discard=discard)
+
+    def connect(self):
+        # A new connection needs no health check. connect() calls ensure_connection() through
+        # set_autocommit(), and a SELECT 1 there would open a transaction before autocommit is set.
+        self.health_check_done = True
+        super().connect()
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Called at the start and end of every request: check the connection again on next use.
+        self.health_check_done = False
+
+    def ensure_connection(self):
+        if (
+            self.connection is not None
+            and not self.health_check_done
+            and not self.in_atomic_block
+            and self.settings_dict.get('CONN_HEALTH_CHECKS', False)
+        ):
+            if not self.is_usable():
+                self.discard_on_close = True
+                self.close()
+            self.health_check_done = True
+        super().ensure_connection()
+        self.health_check_done = True
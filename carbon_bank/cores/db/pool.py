@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import deque
+
+from cores.metrics import registry
+
+pool_wait = registry.histogram(
+    'carbon_bank_db_pool_wait_seconds', 'Time spent waiting to check a connection out of the pool.',
+    (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5), ['pool'],
+)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+        Thread safe pool of DB-API connections.
+
+        Up to ``max_size`` connections are kept open between checkouts. Under load up to
+        ``max_overflow`` extra connections are opened and closed again when returned. When
+        all ``max_size + max_overflow`` connections are checked out, ``acquire`` waits up to
+        ``timeout`` seconds for one to be returned. Connections older than ``recycle`` seconds
+        are closed instead of being reused.
+    """
+
+    def __init__(self, name, max_size=10, max_overflow=5, timeout=5.0, recycle=1800):
+        self.name = name
+        self.max_size = max_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+
+        self._condition = threading.Condition()
+        self._idle = deque()
+        self._opened_at = {}
+        self.size = 0
+        self.in_use = 0
+        self.created = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+
+    def acquire(self, factory):
+        """Check out an idle connection, or open one with ``factory()`` if the pool has room."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        stale = []
+        try:
+            with self._condition:
+                while True:
+                    connection = self._pop_idle(stale)
+                    if connection is not None:
+                        self._checked_out(started)
+                        return connection
+
+                    if self.size < self.max_size + self.max_overflow:
+                        # Reserve the slot, the connection itself is opened outside the lock.
+                        self.size += 1
+                        self._checked_out(started)
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            f'Connection pool {self.name!r} exhausted: {self.size} connections in use, '
+                            f'waited {self.timeout}s.'
+                        )
+                    self._condition.wait(remaining)
+        finally:
+            for connection in stale:
+                self._close_quietly(connection)
+
+        try:
+            connection = factory()
+        except BaseException:
+            with self._condition:
+                self.size -= 1
+                self.in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self.created += 1
+            self._opened_at[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection, discard=False):
+        """Return a checked out connection. Broken, stale or overflow connections are closed."""
+        with self._condition:
+            self.in_use -= 1
+            keep = (
+                not discard
+                and not getattr(connection, 'closed', False)
+                and len(self._idle) < self.max_size
+                and not self._is_stale(connection)
+            )
+            if keep:
+                self._idle.append(connection)
+            else:
+                self.size -= 1
+                self._opened_at.pop(id(connection), None)
+            self._condition.notify()
+
+        if not keep:
+            self._close_quietly(connection)
+
+    def close_idle(self):
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+            for connection in idle:
+                self.size -= 1
+                self._opened_at.pop(id(connection), None)
+        for connection in idle:
+            self._close_quietly(connection)
+
+    def collect(self):
+        labels = {'pool': self.name}
+        with self._condition:
+            yield 'carbon_bank_db_pool_connections', 'gauge', 'Open pool connections.', self.size, labels
+            yield 'carbon_bank_db_pool_in_use', 'gauge', 'Checked out pool connections.', self.in_use, labels
+            yield 'carbon_bank_db_pool_idle', 'gauge', 'Idle pool connections.', len(self._idle), labels
+            yield 'carbon_bank_db_pool_created_total', 'counter', 'Connections opened by the pool.', \
+                self.created, labels
+            yield 'carbon_bank_db_pool_checkouts_total', 'counter', 'Pool checkouts.', self.checkouts, labels
+            yield 'carbon_bank_db_pool_timeouts_total', 'counter', 'Checkouts that timed out.', \
+                self.timeouts, labels
+            yield 'carbon_bank_db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection.', \
+                self.wait_seconds_total, labels
+
+    def _pop_idle(self, stale):
+        # Most recently returned first: it is the most likely to still be healthy.
+        while self._idle:
+            connection = self._idle.pop()
+            if not getattr(connection, 'closed', False) and not self._is_stale(connection):
+                return connection
+            self.size -= 1
+            self._opened_at.pop(id(connection), None)
+            stale.append(connection)
+        return None
+
+    def _checked_out(self, started):
+        waited = time.monotonic() - started
+        self.in_use += 1
+        self.checkouts += 1
+        self.wait_seconds_total += waited
+        pool_wait.observe(waited, pool=self.name)
+
+    def _is_stale(self, connection):
+        opened_at = self._opened_at.get(id(connection))
+        return self.recycle is not None and opened_at is not None and time.monotonic() - opened_at > self.recycle
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, options):
+    """The process wide pool of a database alias, created from its ``POOL`` settings."""
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool = _pools[alias] = ConnectionPool(
+                    alias,
+                    max_size=options.get('MAX_SIZE', 10),
+                    max_overflow=options.get('MAX_OVERFLOW', 5),
+                    timeout=options.get('TIMEOUT', 5.0),
+                    recycle=options.get('RECYCLE', 1800),
+                )
+                registry.register_collector(pool.collect)
+    return pool
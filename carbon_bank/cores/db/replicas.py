@@ -0,0 +1,197 @@
+"""
+Read replica routing for the read-only API views.
+
+Views that list or show data use ``ReplicaReadMixin``: once the request is authenticated the
+mixin picks a replica for it, and ``PrimaryReplicaRouter`` sends every read of that request
+to the chosen alias. Everything else, writes included, stays on ``default``.
+
+A replica is skipped while its replication lag is above REPLICA_MAX_LAG seconds or it
+cannot be reached. After a successful write ``ReadYourWritesMiddleware`` pins the user to
+the primary for REPLICA_PIN_SECONDS, so a client never reads its own write back from a
+replica that has not replayed it yet. The pin lives in the REPLICA_PIN_CACHE cache, which
+has to be shared by all workers for the pin to hold across them (CACHES['shared'], see
+cores/checks.py). Cache tables of the database cache are always read from the primary.
+"""
+import asyncio
+import contextvars
+import random
+import threading
+import time
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from cores.metrics import registry
+
+_read_alias = contextvars.ContextVar('carbon_bank_read_alias', default=None)
+
+# 0 when the replica has replayed everything it received, otherwise the age of the last
+# replayed transaction. Not in recovery means the alias points at a primary.
+POSTGRES_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReplicaLagMonitor:
+    """
+        Replication lag per replica alias, measured at most once every
+        REPLICA_LAG_CHECK_INTERVAL seconds per process. ``None`` means unreachable.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._lags = {}
+
+    def lag(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._lags.get(alias, (None, None))
+            if checked_at is not None and now - checked_at < settings.REPLICA_LAG_CHECK_INTERVAL:
+                return lag
+            # Other threads keep using the previous value while this one measures.
+            self._lags[alias] = (now, lag)
+
+        lag = self.measure(alias)
+        with self._lock:
+            self._lags[alias] = (time.monotonic(), lag)
+        return lag
+
+    @staticmethod
+    def measure(alias):
+        connection = connections[alias]
+        try:
+            if connection.vendor != 'postgresql':
+                connection.ensure_connection()
+                return 0.0
+            with connection.cursor() as cursor:
+                cursor.execute(POSTGRES_LAG_SQL)
+                return float(cursor.fetchone()[0])
+        except DatabaseError:
+            return None
+
+    def collect(self):
+        with self._lock:
+            lags = dict(self._lags)
+        for alias, (_, lag) in sorted(lags.items()):
+            yield 'carbon_bank_db_replica_lag_seconds', 'gauge', \
+                'Last measured replication lag, -1 if the replica is unreachable.', \
+                -1 if lag is None else lag, {'alias': alias}
+
+
+lag_monitor = ReplicaLagMonitor()
+registry.register_collector(lag_monitor.collect)
+
+
+def available_replicas():
+    """Replica aliases that are reachable and within REPLICA_MAX_LAG."""
+    replicas = []
+    for alias in settings.DATABASE_REPLICAS:
+        lag = lag_monitor.lag(alias)
+        if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+            replicas.append(alias)
+    return replicas
+
+
+def _pin_key(user):
+    return f'replica-pin:{user.pk}'
+
+
+def pin_to_primary(user):
+    caches[settings.REPLICA_PIN_CACHE].set(_pin_key(user), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return bool(caches[settings.REPLICA_PIN_CACHE].get(_pin_key(user)))
+
+
+def choose_read_alias(user):
+    """The replica ``user`` should read from, or ``None`` for the primary."""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if user is not None and user.is_authenticated and is_pinned_to_primary(user):
+        return None
+    replicas = available_replicas()
+    return random.choice(replicas) if replicas else None
+
+
+class PrimaryReplicaRouter:
+    """Reads inside a ``ReplicaReadMixin`` view go to its replica, everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        # DatabaseCache entries: a lagging replica would miss pins and invalidations.
+        if model._meta.app_label == 'django_cache':
+            return DEFAULT_DB_ALIAS
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaReadMixin:
+    """
+        For read-only DRF views. Authentication and permission checks read from the
+        primary, the view itself reads from one replica chosen for the whole request.
+    """
+    read_alias = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.read_alias = choose_read_alias(request.user)
+        self._read_alias_token = _read_alias.set(self.read_alias)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_read_alias_token', None)
+        if token is not None:
+            _read_alias.reset(token)
+            self._read_alias_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class ReadYourWritesMiddleware:
+    """Pin a user to the primary for REPLICA_PIN_SECONDS after any successful unsafe request."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.pin_after_write(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        self.pin_after_write(request, response)
+        return response
+
+    @staticmethod
+    def pin_after_write(request, response):
+        if not settings.DATABASE_REPLICAS or request.method in SAFE_METHODS or response.status_code >= 400:
+            return
+        # DRF copies the user it authenticated back onto the Django request.
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            pin_to_primary(user)
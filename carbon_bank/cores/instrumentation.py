@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import random
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from cores.metrics import registry
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 250)
+
+request_duration = registry.histogram(
+    'carbon_bank_request_duration_seconds', 'Total request latency.', LATENCY_BUCKETS, ['view'],
+)
+request_db_duration = registry.histogram(
+    'carbon_bank_request_db_seconds', 'Time spent executing SQL per request.', LATENCY_BUCKETS, ['view'],
+)
+request_serializer_duration = registry.histogram(
+    'carbon_bank_request_serializer_seconds', 'Time spent in serializer validation and representation '
+    'per request, lazy queries included.', LATENCY_BUCKETS, ['view'],
+)
+request_queries = registry.histogram(
+    'carbon_bank_request_queries', 'SQL queries executed per request.', QUERY_BUCKETS, ['view'],
+)
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.view = 'unresolved'
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.started = time.perf_counter()
+        self._serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # django.db execute_wrapper hook.
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+
+
+def current_metrics():
+    return _current.get()
+
+
+@contextmanager
+def instrumented_connections(metrics):
+    """Count the SQL run by the current thread on every database alias into ``metrics``."""
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(metrics))
+        yield
+
+
+@contextmanager
+def serializer_timer():
+    metrics = _current.get()
+    if metrics is None or metrics._serializer_depth:
+        yield
+        return
+
+    metrics._serializer_depth += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializer_seconds += time.perf_counter() - started
+        metrics._serializer_depth -= 1
+
+
+class TimedSerializerMixin:
+    """Report validation and representation time to the instrumentation middleware."""
+
+    def run_validation(self, *args, **kwargs):
+        with serializer_timer():
+            return super().run_validation(*args, **kwargs)
+
+    def to_representation(self, instance):
+        with serializer_timer():
+            return super().to_representation(instance)
+
+
+class InstrumentationMiddleware:
+    """
+        Record query count, DB time, serializer time and total latency of every sampled
+        request. They are exported as histograms per view on the metrics endpoint and, when
+        INSTRUMENTATION_SERVER_TIMING is on, as a ``Server-Timing`` response header.
+        Requests left out by INSTRUMENTATION_SAMPLE_RATE are passed through untouched.
+
+        Under ASGI the middleware stays on the event loop; SQL is counted by
+        ``cores.async_views.run_in_db_thread`` on the thread that actually runs it.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        metrics = self.start()
+        if metrics is None:
+            return self.get_response(request)
+
+        token = _current.set(metrics)
+        try:
+            with instrumented_connections(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = self.start()
+        if metrics is None:
+            return await self.get_response(request)
+
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    @staticmethod
+    def start():
+        sample_rate = settings.INSTRUMENTATION_SAMPLE_RATE
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return None
+        return RequestMetrics()
+
+    @staticmethod
+    def finish(request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is not None:
+            metrics.view = getattr(resolver_match.func, '__name__', 'unknown')
+
+        request_duration.observe(total, view=metrics.view)
+        request_db_duration.observe(metrics.db_seconds, view=metrics.view)
+        request_serializer_duration.observe(metrics.serializer_seconds, view=metrics.view)
+        request_queries.observe(metrics.queries, view=metrics.view)
+
+        if settings.INSTRUMENTATION_SERVER_TIMING:
+            response['Server-Timing'] = (
+                f'db;dur={metrics.db_seconds * 1000:.2f};desc="{metrics.queries} queries", '
+                f'serializer;dur={metrics.serializer_seconds * 1000:.2f}, '
+                f'total;dur={total * 1000:.2f}'
+            )
+        return response
@@ -0,0 +1,94 @@
+import bisect
+import threading
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative histogram with one series per label set, rendered in Prometheus text format."""
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][index] += 1
+            series['sum'] += value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = {key: (list(value['counts']), value['sum']) for key, value in self._series.items()}
+
+        for key, (counts, total) in sorted(series.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                yield f'{self.name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(labels)} {cumulative}'
+
+
+class Registry:
+    """
+        Metrics of this process. Besides histograms, collectors can be registered: callables
+        returning ``(name, type, documentation, value[, labels])`` tuples read at scrape time,
+        which is how existing counters (lock stats, caches, pools) are exposed without coupling
+        them to this module.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def histogram(self, name, documentation, buckets, labelnames=()):
+        histogram = Histogram(name, documentation, buckets, labelnames)
+        self._metrics.append(histogram)
+        return histogram
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        described = set()
+        for collector in self._collectors:
+            for name, metric_type, documentation, value, *labels in collector():
+                if name not in described:
+                    described.add(name)
+                    lines.append(f'# HELP {name} {documentation}')
+                    lines.append(f'# TYPE {name} {metric_type}')
+                labels = sorted(labels[0].items()) if labels else []
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -1,9 +1,10 @@
 from rest_framework.permissions import IsAuthenticated
 
+from cores.principal import get_principal
+
 
 class IsCustomer(IsAuthenticated):
 
     def has_permission(self, request, view):
         authenticated = super(IsCustomer, self).has_permission(request, view)
-        return authenticated and hasattr(request.user, 'customer')
-
+        return authenticated and get_principal(request).customer is not None
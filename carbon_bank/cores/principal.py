@@ -0,0 +1,59 @@
+"""
+Who a request acts for: the authenticated user and, for customers, their customer and bank
+account.
+
+``get_principal(request)`` loads the customer and the bank account in one query the first
+time it is called for a request and keeps them on it, so permissions, views and serializers
+share them instead of each querying ``Customer.objects.get(user=...)`` and lazy-loading
+``customer.bankaccount``. They are also cached on ``request.user`` (``user.customer`` and
+``user.customer.bankaccount``). With JWT authentication the token claims already carry them
+and no query is made at all.
+"""
+from customers.models import Customer
+from management.models import BankAccount
+
+
+class Principal:
+
+    def __init__(self, user, customer=None):
+        self.user = user
+        self.customer = customer
+
+    @property
+    def customer_id(self):
+        return self.customer.pk if self.customer is not None else None
+
+    @property
+    def account(self):
+        """The customer's bank account, ``None`` for users that are not customers or have none."""
+        if self.customer is None:
+            return None
+        return BankAccount.owner.field.remote_field.get_cached_value(self.customer, None)
+
+    @property
+    def is_superuser(self):
+        return self.user.is_superuser
+
+
+def load_principal(user):
+    if user is None or not user.is_authenticated:
+        return Principal(user)
+    customer_cache = Customer.user.field.remote_field
+    account_cache = BankAccount.owner.field.remote_field
+    if customer_cache.is_cached(user):
+        customer = customer_cache.get_cached_value(user)
+        if customer is None or account_cache.is_cached(customer):
+            return Principal(user, customer)
+
+    customer = Customer.objects.select_related('bankaccount').filter(user=user).first()
+    customer_cache.set_cached_value(user, customer)
+    if customer is not None:
+        Customer.user.field.set_cached_value(customer, user)
+    return Principal(user, customer)
+
+
+def get_principal(request):
+    principal = getattr(request, '_principal', None)
+    if principal is None or principal.user is not request.user:
+        principal = request._principal = load_principal(request.user)
+    return principal
@@ -0,0 +1,56 @@
+"""
+Revocation of JWTs before they expire.
+
+Revoked tokens are kept in the JWT_REVOCATION_CACHE cache, which has to be shared by all
+workers (CACHES['shared'], see cores/checks.py) for a revocation to apply everywhere. Two kinds of entries exist,
+both dropped once no token they apply to can still be valid:
+
+- one per revoked token, keyed by its ``jti`` (logout),
+- one per user, holding the time before which all their tokens were issued (password or
+  permission change, deactivation).
+
+Checking a token is one ``get_many`` on the cache: a memcached round trip, or one query with
+the database cache used when no memcached is configured.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework_simplejwt.settings import api_settings
+
+
+def _cache():
+    return caches[settings.JWT_REVOCATION_CACHE]
+
+
+def _token_key(jti):
+    return f'jwt-revoked:{jti}'
+
+
+def _user_key(user_id):
+    return f'jwt-revoked-user:{user_id}'
+
+
+def revoke_token(token):
+    """Reject ``token`` (an access or refresh token) until it expires."""
+    remaining = int(token['exp'] - time.time()) + 1
+    if remaining > 0:
+        _cache().set(_token_key(token[api_settings.JTI_CLAIM]), True, remaining)
+
+
+def revoke_user_tokens(user_id):
+    """Reject every token issued to the user until now."""
+    lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+    _cache().set(_user_key(user_id), int(time.time()), int(lifetime.total_seconds()) + 1)
+
+
+def is_revoked(token):
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    keys = [_token_key(token.get(api_settings.JTI_CLAIM)), _user_key(user_id)]
+    revoked = _cache().get_many(keys)
+    if keys[0] in revoked:
+        return True
+    # iat has a one second resolution, a token issued in the second of the revocation is
+    # revoked as well.
+    revoked_before = revoked.get(keys[1])
+    return revoked_before is not None and token.get('iat', 0) <= revoked_before
@@ -0,0 +1,324 @@
+import threading
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from customers.models import Customer
+from management.balance_cache import get_balance_cache
+from management.models import BankAccount
+from .authentication import JWTAuthentication
+from .checks import check_shared_caches
+from .db.pool import ConnectionPool, PoolTimeout
+from .db.replicas import PrimaryReplicaRouter, lag_monitor
+from .permissions import IsCustomer
+
+
+class InstrumentationMiddlewareTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            email='tes111t@test.com',
+            password='test123',
+            username="test_user"
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_server_timing_header_and_metrics(self):
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries", serializer;dur=')
+
+        metrics = self.client.get(reverse('metrics'))
+        self.assertEqual(metrics.status_code, status.HTTP_200_OK)
+        body = metrics.content.decode()
+        self.assertIn('carbon_bank_request_queries_bucket{view="AccountListAPIView",le="+Inf"}', body)
+        self.assertIn('carbon_bank_request_duration_seconds_count{view="AccountListAPIView"}', body)
+        self.assertIn('carbon_bank_account_lock_wait_seconds_total', body)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_unsampled_request_is_not_instrumented(self):
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(SimpleTestCase):
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool('test', max_size=2, max_overflow=0)
+        first = pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertIs(pool.acquire(FakeConnection), first)
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.checkouts, 2)
+
+    def test_overflow_connections_are_closed_on_release(self):
+        pool = ConnectionPool('test', max_size=1, max_overflow=1)
+        first, second = pool.acquire(FakeConnection), pool.acquire(FakeConnection)
+        pool.release(first)
+        pool.release(second)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.size, 1)
+
+    def test_exhausted_pool_waits_then_times_out(self):
+        pool = ConnectionPool('test', max_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        self.assertEqual(pool.timeouts, 1)
+
+        timer = threading.Timer(0.01, pool.release, [connection])
+        timer.start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(FakeConnection), connection)
+        timer.join()
+
+    def test_broken_and_stale_connections_are_replaced(self):
+        pool = ConnectionPool('test', max_size=2, max_overflow=0, recycle=60)
+        broken, stale = pool.acquire(FakeConnection), pool.acquire(FakeConnection)
+        pool.release(stale)
+        broken.closed = True
+        pool.release(broken)
+        self.assertEqual(pool.size, 1)
+
+        with mock.patch('cores.db.pool.time.monotonic', return_value=10 ** 9):
+            fresh = pool.acquire(FakeConnection)
+        self.assertIsNot(fresh, stale)
+        self.assertTrue(stale.closed)
+        self.assertEqual(pool.size, 1)
+
+    def test_failed_connect_frees_the_slot(self):
+        pool = ConnectionPool('test', max_size=1, max_overflow=0, timeout=0)
+
+        def fail():
+            raise OSError('connection refused')
+
+        with self.assertRaises(OSError):
+            pool.acquire(fail)
+        self.assertIsInstance(pool.acquire(FakeConnection), FakeConnection)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_MAX_LAG=2)
+class ReplicaRoutingTest(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        caches['default'].clear()
+        lag_monitor.reset()
+        self.admin = User.objects.create_superuser(username='admin', email='admin@test.com', password='test123')
+        user = User.objects.create_user(username='customer', email='customer@test.com', password='test123')
+        self.customer = Customer.objects.create(
+            identity_number='12345', address='istanbul', sex=Customer.MALE, user=user,
+        )
+        BankAccount.objects.create(account_number=BankAccount.generate_account_number(), owner=self.customer)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['replica']) as replica, \
+                CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(replica), len(primary)
+
+    def test_read_views_use_the_replica(self):
+        for url in (
+            reverse('management:account-list'),
+            reverse('management:transaction-list', args=[self.customer.pk]),
+            reverse('customers:list'),
+        ):
+            response, replica_queries, _ = self.get(url)
+            self.assertGreater(replica_queries, 0, url)
+
+        response, _, _ = self.get(reverse('management:account-list'))
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_streamed_statement_reads_only_the_replica(self):
+        self.client.force_authenticate(user=self.customer.user)
+        account = self.customer.bankaccount
+        account.is_active = True
+        account.save()
+        response = self.client.post(reverse('management:deposit'), {'amount': 100})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.client.force_authenticate(user=self.admin)
+        url = reverse('management:statement', args=[self.customer.pk])
+        with CaptureQueriesContext(connections['replica']) as replica, \
+                CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary:
+            response = self.client.get(url, {'format': 'ndjson'})
+            b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(len(replica), 0)
+        # The read-your-writes pin lives in the shared cache, which is always on the primary.
+        ledger_queries = [query for query in primary if 'carbon_bank_cache' not in query['sql']]
+        self.assertEqual(ledger_queries, [])
+
+    def test_balance_cache_is_filled_from_the_primary(self):
+        get_balance_cache().invalidate([self.customer.bankaccount.pk])
+        # Choosing the replica measures its lag with a query on PostgreSQL, which is not a read.
+        with mock.patch.object(lag_monitor, 'measure', return_value=0.0):
+            _, replica_queries, primary_queries = self.get(reverse('customers:get-balance', args=[self.customer.pk]))
+        self.assertEqual(replica_queries, 0)
+        self.assertGreater(primary_queries, 0)
+
+    def test_router_defaults_to_the_primary(self):
+        router = PrimaryReplicaRouter()
+        self.assertIsNone(router.db_for_read(BankAccount))
+        self.assertEqual(router.db_for_write(BankAccount), DEFAULT_DB_ALIAS)
+        self.assertFalse(router.allow_migrate('replica', 'management'))
+        self.assertTrue(router.allow_migrate(DEFAULT_DB_ALIAS, 'management'))
+
+    def test_reads_after_a_write_are_pinned_to_the_primary(self):
+        self.client.force_authenticate(user=self.customer.user)
+        account = self.customer.bankaccount
+        account.is_active = True
+        account.save()
+        response = self.client.post(reverse('management:deposit'), {'amount': 100})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.client.force_authenticate(user=self.admin)
+        _, replica_queries, _ = self.get(reverse('management:account-list'))
+        self.assertGreater(replica_queries, 0)
+
+        self.client.force_authenticate(user=self.customer.user)
+        response, replica_queries, primary_queries = self.get(reverse('management:account-list'))
+        self.assertEqual(replica_queries, 0)
+        self.assertEqual(response.data['results'][0]['balance'], '100.00')
+
+    def test_lagging_or_unreachable_replicas_are_skipped(self):
+        url = reverse('management:account-list')
+        with mock.patch.object(lag_monitor, 'measure', return_value=5.0):
+            _, replica_queries, _ = self.get(url)
+        self.assertEqual(replica_queries, 0)
+
+        lag_monitor.reset()
+        with mock.patch.object(lag_monitor, 'measure', return_value=None):
+            _, replica_queries, _ = self.get(url)
+        self.assertEqual(replica_queries, 0)
+
+        lag_monitor.reset()
+        with mock.patch.object(lag_monitor, 'measure', return_value=0.5):
+            _, replica_queries, _ = self.get(url)
+        self.assertGreater(replica_queries, 0)
+
+
+class JWTAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='customer', email='customer@test.com', password='test123')
+        self.customer = Customer.objects.create(
+            identity_number='12345', address='istanbul', sex=Customer.MALE, user=self.user,
+        )
+        self.account = BankAccount.objects.create(
+            account_number=BankAccount.generate_account_number(), owner=self.customer,
+        )
+        response = self.client.post(reverse('token_obtain_pair'), {'username': 'customer', 'password': 'test123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.access, self.refresh = response.data['access'], response.data['refresh']
+
+    def authenticate(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    # With memcached, as deployed. The database cache fallback costs the revocation lookup.
+    @override_settings(JWT_REVOCATION_CACHE='default')
+    def test_authentication_needs_no_query(self):
+        request = Request(APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.access}'))
+        with self.assertNumQueries(0):
+            user, _ = JWTAuthentication().authenticate(request)
+            request.user = user
+            self.assertTrue(IsCustomer().has_permission(request, None))
+            self.assertEqual(user.customer.pk, self.customer.pk)
+            self.assertEqual(user.customer.bankaccount.pk, self.account.pk)
+            self.assertFalse(user.is_staff)
+        # Other fields load when used.
+        self.assertEqual(user.email, 'customer@test.com')
+
+        self.authenticate(self.access)
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['id'], self.account.pk)
+
+    def test_tokens_without_identity_claims_are_rejected(self):
+        self.authenticate(RefreshToken.for_user(self.user).access_token)
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revoked_tokens_are_rejected(self):
+        self.authenticate(self.access)
+        response = self.client.post(reverse('token_revoke'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_revokes_all_tokens(self):
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        access = response.data['access']
+
+        self.user.last_login = None
+        self.user.save(update_fields=['last_login'])
+        self.authenticate(access)
+        self.assertEqual(self.client.get(reverse('management:account-list')).status_code, status.HTTP_200_OK)
+
+        self.user.set_password('changed')
+        self.user.save()
+        for token in (self.access, access):
+            self.authenticate(token)
+            response = self.client.get(reverse('management:account-list'))
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(BALANCE_CACHE={
+    'BACKEND': 'management.balance_cache.SharedBalanceCache', 'TIMEOUT': 60, 'OPTIONS': {'CACHE_ALIAS': 'shared'},
+})
+class SharedCacheCheckTest(SimpleTestCase):
+
+    def test_local_cache_is_rejected_with_several_workers(self):
+        with override_settings(SERVER_WORKERS=1, JWT_REVOCATION_CACHE='default'):
+            self.assertEqual(check_shared_caches(None), [])
+        with override_settings(SERVER_WORKERS=4, JWT_REVOCATION_CACHE='default'):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['cores.E001'])
+        with override_settings(SERVER_WORKERS=4, JWT_REVOCATION_CACHE='shared'):
+            self.assertEqual(check_shared_caches(None), [])
+
+    def test_local_replica_pin_cache_is_rejected_with_replicas(self):
+        with override_settings(SERVER_WORKERS=4, DATABASE_REPLICAS=[], REPLICA_PIN_CACHE='default'):
+            self.assertEqual(check_shared_caches(None), [])
+        with override_settings(SERVER_WORKERS=4, DATABASE_REPLICAS=['replica'], REPLICA_PIN_CACHE='default'):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['cores.E001'])
+
+    def test_local_balance_cache_is_flagged(self):
+        local = {'BACKEND': 'management.balance_cache.LocalBalanceCache', 'TIMEOUT': 60}
+        shared = {'BACKEND': 'management.balance_cache.SharedBalanceCache', 'TIMEOUT': 60,
+                  'OPTIONS': {'CACHE_ALIAS': 'default'}}
+        with override_settings(SERVER_WORKERS=1, BALANCE_CACHE=local):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['cores.W001'])
+        with override_settings(SERVER_WORKERS=1, BALANCE_CACHE=shared):
+            self.assertEqual(check_shared_caches(None), [])
+        with override_settings(SERVER_WORKERS=4, BALANCE_CACHE=local):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['cores.E002'])
+        with override_settings(SERVER_WORKERS=4, BALANCE_CACHE=shared):
+            self.assertEqual([error.id for error in check_shared_caches(None)], ['cores.E001'])
@@ -0,0 +1,55 @@
+from django.http import HttpResponse
+from django.utils.translation import gettext_lazy as _
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt import views
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from cores.authentication import (
+    CustomerTokenObtainPairSerializer, JWTAuthentication, RevocableTokenRefreshSerializer, RevokeTokenSerializer,
+)
+from cores.metrics import registry
+from cores.revocation import revoke_token
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for the metrics of this worker process."""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class TokenObtainView(views.TokenObtainPairView):
+    """
+        Get an access and a refresh token for your username and password.
+    """
+    serializer_class = CustomerTokenObtainPairSerializer
+
+
+class TokenRefreshView(views.TokenRefreshView):
+    """
+        Get a new access token for a refresh token.
+    """
+    serializer_class = RevocableTokenRefreshSerializer
+
+
+class TokenRevokeView(APIView):
+    """
+        Log out: revoke the access token of this request, and the refresh token if sent.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = RevokeTokenSerializer
+
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        revoke_token(request.auth)
+        refresh = serializer.validated_data.get('refresh')
+        if refresh is not None:
+            if str(refresh[api_settings.USER_ID_CLAIM]) != str(request.user.pk):
+                raise InvalidToken(_('Token belongs to another user.'))
+            revoke_token(refresh)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
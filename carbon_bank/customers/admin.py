@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 from .models import Customer
+from .search import search_customers
 
 
 class CustomerAdmin(admin.ModelAdmin):
@@ -13,6 +14,10 @@ class CustomerAdmin(admin.ModelAdmin):
     ]
     list_filter = ['sex']
 
+    def get_search_results(self, request, queryset, search_term):
+        # search_fields only enables the search box, matching uses the search index.
+        return search_customers(queryset, search_term), False
+
 
 
 admin.site.register(Customer, CustomerAdmin)
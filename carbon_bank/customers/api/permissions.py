@@ -1,5 +1,7 @@
 from rest_framework.permissions import BasePermission
 
+from cores.principal import get_principal
+
 
 class IsOwner(BasePermission):
     def has_permission(self, request, view):
@@ -12,4 +14,4 @@ class IsOwner(BasePermission):
     def has_object_permission(self, request, view, obj):
         # sadece delete işlemi yapıldığında çalışır
         # this is called just in delete process
-        return obj.owner.user == request.user
+        return obj.owner_id == get_principal(request).customer_id
@@ -2,11 +2,12 @@ from django.contrib.auth.models import User
 from django.db import transaction
 from rest_framework import serializers
 
+from cores.instrumentation import TimedSerializerMixin
 from customers.models import Customer
 from management.models import BankAccount
 
 
-class CustomerCreateSerializer(serializers.ModelSerializer):
+class CustomerCreateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     first_name = serializers.CharField(write_only=True)
     last_name = serializers.CharField(write_only=True)
     email = serializers.EmailField(write_only=True)
@@ -55,7 +56,7 @@ class CustomerCreateSerializer(serializers.ModelSerializer):
         return customer
 
 
-class CustomerListSerializer(serializers.ModelSerializer):
+class CustomerListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     first_name = serializers.CharField(source='user.first_name')
     last_name = serializers.CharField(source='user.last_name')
     email = serializers.EmailField(source='user.email')
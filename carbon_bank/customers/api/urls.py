@@ -1,11 +1,13 @@
 from django.urls import path
 
+from cores.async_views import server_view
 from . import views
-from .views import CustomerCreateAPIView, CustomerListAPIView, GetBalanceAPIView
+from .views import CustomerBulkCreateAPIView, CustomerCreateAPIView, CustomerListAPIView, GetBalanceAPIView
 
 app_name = "customers"
 urlpatterns = [
     path('create/', CustomerCreateAPIView.as_view(), name='create'),
+    path('bulk-create/', CustomerBulkCreateAPIView.as_view(), name='bulk-create'),
     path('list/', CustomerListAPIView.as_view(), name='list'),
-    path('get-balance/<owner>', GetBalanceAPIView.as_view(), name='get-balance'),
+    path('get-balance/<owner>', server_view(GetBalanceAPIView), name='get-balance'),
 ]
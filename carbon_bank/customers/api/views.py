@@ -1,14 +1,25 @@
+import csv
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 from django.db.models import Q
-from rest_framework import mixins, viewsets
+from rest_framework import mixins, status, viewsets
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import CreateAPIView, RetrieveAPIView
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import AllowAny
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from cores.db.replicas import ReplicaReadMixin
 from cores.permissions import IsCustomer
 from customers.models import Customer
+from customers.onboarding import onboard_customers, read_upload
+from customers.search import search_customers
 from management.api.serializers import AccountSerializer
+from management.balance_cache import get_balance_cache
 from management.models import BankAccount
 from .permissions import IsOwner
 from .serializers import CustomerListSerializer, CustomerCreateSerializer
@@ -26,9 +37,37 @@ class CustomerCreateAPIView(CreateAPIView):
         serializer.save(user=self.request.user)
 
 
-class CustomerListAPIView(ListAPIView):
+class CustomerBulkCreateAPIView(APIView):
+    """
+        Create many customers at once. You should be admin user. Send a JSON list of
+        customers with the fields of create/, or upload a .csv or .jsonl file as "file".
+        Valid rows are created, the others are reported with their row number.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            rows = request.data
+        elif 'file' in request.FILES:
+            try:
+                # One row past the limit is enough to refuse the upload.
+                rows = list(islice(read_upload(request.FILES['file']), settings.ONBOARDING_MAX_ROWS + 1))
+            except (UnicodeDecodeError, csv.Error) as exc:
+                raise ValidationError({'file': [str(exc)]})
+        else:
+            raise ValidationError({'detail': 'Send a list of customers or upload a file.'})
+        if len(rows) > settings.ONBOARDING_MAX_ROWS:
+            raise ValidationError({'detail': f'At most {settings.ONBOARDING_MAX_ROWS} customers per request, '
+                                             f'use the import_customers command for more.'})
+
+        report = onboard_customers(rows)
+        return Response(report.as_dict(), status.HTTP_201_CREATED if report.created else status.HTTP_400_BAD_REQUEST)
+
+
+class CustomerListAPIView(ReplicaReadMixin, ListAPIView):
     """
-        List all customer information. You should be admin user.
+        List all customer information. You should be admin user. ?q= searches username, email,
+        names and identity number, tolerating typos on PostgreSQL.
     """
     permission_classes = [IsAdminUser]
     serializer_class = CustomerListSerializer
@@ -38,11 +77,11 @@ class CustomerListAPIView(ListAPIView):
         queryset = Customer.objects.filter(is_deleted=False).order_by('-created_date')
         query = self.request.GET.get("q")
         if query:
-            queryset = queryset.filter(user__username__icontains=query)
+            queryset = search_customers(queryset, query)
         return queryset
 
 
-class GetBalanceAPIView(RetrieveAPIView):
+class GetBalanceAPIView(ReplicaReadMixin, RetrieveAPIView):
     """
         Get balance for a specific bank account. You should be admin user. owner parameter = customer id
     """
@@ -52,4 +91,20 @@ class GetBalanceAPIView(RetrieveAPIView):
     permission_classes = [IsAdminUser]
 
     def get_queryset(self):
-        return BankAccount.objects.filter(Q(owner=self.kwargs["owner"]))
+        return BankAccount.objects.with_owner().with_shard_balance().filter(Q(owner=self.kwargs["owner"]))
+
+    def retrieve(self, request, *args, **kwargs):
+        balance_cache = get_balance_cache()
+        account_id = balance_cache.account_of_owner(self.kwargs['owner'])
+        if account_id is None:
+            account_id = self.get_object().pk
+            balance_cache.remember_owner(self.kwargs['owner'], account_id)
+        return Response(balance_cache.get_or_load(account_id, self.load_account))
+
+    def load_account(self, account_id):
+        # Fill from the primary: a lagging replica would put a stale balance in the cache.
+        try:
+            account = BankAccount.objects.using(DEFAULT_DB_ALIAS).with_owner().with_shard_balance().get(pk=account_id)
+        except BankAccount.DoesNotExist:
+            raise NotFound
+        return dict(self.get_serializer(account).data)
@@ -0,0 +1,43 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from customers.onboarding import hash_pool, onboard_customers, read_rows
+
+
+class Command(BaseCommand):
+    help = ('Create customers with inactive bank accounts from a CSV file (with a header line) '
+            'or a JSON Lines file. Rows with errors are skipped and reported.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                            help='Default: from the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=settings.ONBOARDING_CHUNK_SIZE)
+        parser.add_argument('--processes', type=int, default=settings.ONBOARDING_HASH_PROCESSES,
+                            help='Processes hashing passwords, 1 hashes them in this process.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        try:
+            stream = open(path, encoding='utf-8-sig', newline='')
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        pool = None
+        if options['processes'] > 1:
+            pool = hash_pool(options['processes'])
+        try:
+            with stream:
+                report = onboard_customers(read_rows(stream, format), options['chunk_size'], pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        for error in report.errors:
+            self.stderr.write(f'row {error["row"]}: {json.dumps(error["errors"])}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(report.created)} customers created, {len(report.errors)} rows skipped.'
+        ))
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.18 on 2026-10-17 21:40
+
+from django.db import migrations, models
+
+from customers.models import customer_search_text
+
+TABLE = 'customers_customer'
+
+
+def fill_search_text(apps, schema_editor):
+    Customer = apps.get_model('customers', 'Customer')
+    customers = Customer.objects.select_related('user').order_by('pk')
+    batch = []
+    for customer in customers.iterator(chunk_size=2000):
+        customer.search_text = customer_search_text(customer.user, customer.identity_number)
+        batch.append(customer)
+        if len(batch) >= 2000:
+            Customer.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    Customer.objects.bulk_update(batch, ['search_text'])
+
+
+def create_search_indexes(apps, schema_editor):
+    # Trigram indexes are PostgreSQL only, other backends search without an index.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(f'CREATE INDEX {TABLE}_search_trgm_idx ON {TABLE} USING gin (search_text gin_trgm_ops)')
+    schema_editor.execute(f'CREATE INDEX {TABLE}_search_prefix_idx ON {TABLE} (search_text text_pattern_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX {TABLE}_search_trgm_idx')
+    schema_editor.execute(f'DROP INDEX {TABLE}_search_prefix_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customers', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='search_text',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
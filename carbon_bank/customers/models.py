@@ -2,8 +2,20 @@ import uuid
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
 
 from cores.models import CustomBaseClass
+from cores.revocation import revoke_user_tokens
+
+# Changing any of these revokes the user's JWTs, whose claims may no longer hold.
+SECURITY_FIELDS = ('password', 'is_active', 'is_staff', 'is_superuser')
+
+
+def customer_search_text(user, identity_number):
+    """What customer search matches against, see customers/search.py."""
+    values = [user.username, user.email, user.first_name, user.last_name, identity_number]
+    return ' '.join(dict.fromkeys(value.lower() for value in values if value))
 
 
 class Customer(CustomBaseClass):
@@ -19,6 +31,12 @@ class Customer(CustomBaseClass):
     address = models.TextField()
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='customer')
     sex = models.CharField(choices=SEX_CHOICES, max_length=6)
+    # Lower-cased username, email, names and identity number, indexed for search on PostgreSQL.
+    search_text = models.TextField(default='', editable=False)
+
+    def save(self, *args, **kwargs):
+        self.search_text = customer_search_text(self.user, self.identity_number)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f" Username: {self.user.username}, FirstName: {self.user.first_name}, LastName: {self.user.last_name}"
@@ -26,3 +44,29 @@ class Customer(CustomBaseClass):
     @property
     def fullname(self):
         return f"{self.user.first_name} {self.user.last_name}"
+
+
+@receiver(post_save, sender=User)
+def refresh_search_text(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only save last_login.
+    if created or (update_fields and not {'username', 'email', 'first_name', 'last_name'} & set(update_fields)):
+        return
+    customers = Customer.objects.filter(user=instance)
+    identity_number = customers.values_list('identity_number', flat=True).first()
+    if identity_number is not None:
+        customers.update(search_text=customer_search_text(instance, identity_number))
+
+
+@receiver(pre_save, sender=User)
+def remember_security_fields(sender, instance, update_fields=None, **kwargs):
+    instance._security_fields = None
+    if instance.pk is None or (update_fields and not set(SECURITY_FIELDS) & set(update_fields)):
+        return
+    instance._security_fields = User.objects.filter(pk=instance.pk).values_list(*SECURITY_FIELDS).first()
+
+
+@receiver(post_save, sender=User)
+def revoke_tokens_on_security_change(sender, instance, **kwargs):
+    previous = instance._security_fields
+    if previous is not None and previous != tuple(getattr(instance, field) for field in SECURITY_FIELDS):
+        revoke_user_tokens(instance.pk)
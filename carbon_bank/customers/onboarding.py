@@ -0,0 +1,205 @@
+"""
+Bulk customer onboarding.
+
+Rows are validated, checked for duplicate emails and identity numbers (within the import and
+against the database, one query per chunk), their passwords hashed (on a process pool when
+given one) and the users, customers and bank accounts inserted with ``bulk_create``, one
+transaction per chunk. Invalid rows are reported with their row number and never stop the rest
+of the import.
+
+The API hashes in the request's process: a web worker must not fork a pool that outlives the
+request. ``import_customers`` starts its own pool, see ``hash_pool``.
+"""
+import csv
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from rest_framework import serializers
+
+from customers.models import Customer, customer_search_text
+from management.models import BankAccount
+
+# Passwords sent to a pool process at a time.
+HASH_BATCH_SIZE = 16
+# Inserts of a chunk that lost a race with other requests before its rows go one by one.
+INSERT_ATTEMPTS = 3
+
+
+class OnboardingRowSerializer(serializers.Serializer):
+    """The fields of ``CustomerCreateSerializer``, without its per-row uniqueness queries."""
+    first_name = serializers.CharField(max_length=150)
+    last_name = serializers.CharField(max_length=150)
+    email = serializers.EmailField(max_length=150)
+    password = serializers.CharField()
+    identity_number = serializers.CharField(max_length=60)
+    address = serializers.CharField()
+    sex = serializers.ChoiceField(choices=Customer.SEX_CHOICES)
+
+
+@dataclass
+class OnboardingReport:
+    created: list = field(default_factory=list)
+    errors: list = field(default_factory=list)
+
+    def as_dict(self):
+        return {'created': len(self.created), 'customers': self.created, 'errors': self.errors}
+
+
+def hash_pool(processes):
+    """
+        Process pool for hashing passwords, which is CPU bound. Spawned rather than forked, so
+        the processes do not inherit the caller's database connections and threads.
+    """
+    return ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+    )
+
+
+def hash_passwords(passwords, pool=None):
+    if pool is None or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    return list(pool.map(make_password, passwords, chunksize=HASH_BATCH_SIZE))
+
+
+def read_rows(stream, format):
+    """Rows of a CSV (with a header line) or JSON Lines text stream."""
+    if format == 'csv':
+        yield from csv.DictReader(stream)
+    elif format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        raise ValueError(f'Unknown format {format!r}, use csv or jsonl.')
+
+
+def read_upload(upload):
+    """Rows of an uploaded .csv or .jsonl file."""
+    format = 'jsonl' if upload.name.endswith(('.jsonl', '.ndjson')) else 'csv'
+    return read_rows(io.TextIOWrapper(upload, encoding='utf-8-sig'), format)
+
+
+def onboard_customers(rows, chunk_size=None, pool=None):
+    """
+        Create a customer with an inactive bank account for every valid row of ``rows``.
+        Rows are numbered from 1 in the report.
+    """
+    chunk_size = chunk_size or settings.ONBOARDING_CHUNK_SIZE
+    report = OnboardingReport()
+    seen_emails, seen_identities = set(), set()
+    chunk = []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            report.errors.append({'row': number, 'errors': {'row': ['Expected an object with the customer fields.']}})
+            continue
+        serializer = OnboardingRowSerializer(data=row)
+        if not serializer.is_valid():
+            report.errors.append({'row': number, 'errors': serializer.errors})
+            continue
+        data = serializer.validated_data
+        errors = _duplicate_errors(data, seen_emails, seen_identities, 'in this import')
+        if errors:
+            report.errors.append({'row': number, 'errors': errors})
+            continue
+        seen_emails.add(data['email'])
+        seen_identities.add(data['identity_number'])
+        chunk.append((number, data))
+        if len(chunk) >= chunk_size:
+            _onboard_chunk(chunk, report, pool)
+            chunk = []
+    _onboard_chunk(chunk, report, pool)
+    report.errors.sort(key=lambda error: error['row'])
+    return report
+
+
+def _duplicate_errors(data, emails, identities, where):
+    errors = {}
+    if data['email'] in emails:
+        errors['email'] = [f'This email is already used {where}.']
+    if data['identity_number'] in identities:
+        errors['identity_number'] = [f'This identity number is already used {where}.']
+    return errors
+
+
+def _onboard_chunk(chunk, report, pool):
+    if not chunk:
+        return
+    passwords = hash_passwords([data['password'] for _, data in chunk], pool)
+    for _ in range(INSERT_ATTEMPTS):
+        try:
+            _insert_chunk(chunk, passwords, report)
+            return
+        except IntegrityError:
+            # Another request created one of these customers since the duplicate check: check again.
+            pass
+    # Still racing: one row at a time, so that a conflict only fails its own row.
+    for row, password in zip(chunk, passwords):
+        try:
+            _insert_chunk([row], [password], report)
+        except IntegrityError:
+            report.errors.append({'row': row[0], 'errors': {
+                'non_field_errors': ['This customer was created by another request during the import.'],
+            }})
+
+
+def _insert_chunk(chunk, passwords, report):
+    existing = list(User.objects.filter(
+        Q(username__in=[data['email'] for _, data in chunk])
+        | Q(customer__identity_number__in=[data['identity_number'] for _, data in chunk])
+    ).values_list('username', 'customer__identity_number'))
+    emails, identities = {username for username, _ in existing}, {identity for _, identity in existing}
+
+    rows, errors = [], []
+    for (number, data), password in zip(chunk, passwords):
+        duplicates = _duplicate_errors(data, emails, identities, 'by another customer')
+        if duplicates:
+            errors.append({'row': number, 'errors': duplicates})
+        else:
+            rows.append((number, data, password))
+    if not rows:
+        report.errors.extend(errors)
+        return
+
+    with transaction.atomic():
+        users = [
+            User(username=data['email'], email=data['email'], password=password,
+                 first_name=data['first_name'], last_name=data['last_name'])
+            for _, data, password in rows
+        ]
+        User.objects.bulk_create(users)
+        user_ids = dict(User.objects.filter(
+            username__in=[user.username for user in users],
+        ).values_list('username', 'pk'))
+
+        Customer.objects.bulk_create(
+            Customer(identity_number=data['identity_number'], address=data['address'], sex=data['sex'],
+                     user_id=user_ids[user.username], search_text=customer_search_text(user, data['identity_number']))
+            for (_, data, _), user in zip(rows, users)
+        )
+        customer_ids = dict(Customer.objects.filter(
+            user_id__in=user_ids.values(),
+        ).values_list('user_id', 'pk'))
+
+        account_numbers = BankAccount.generate_account_numbers(len(rows))
+        BankAccount.objects.bulk_create(
+            BankAccount(account_number=account_number, owner_id=customer_ids[user_ids[data['email']]])
+            for (_, data, _), account_number in zip(rows, account_numbers)
+        )
+
+    report.errors.extend(errors)
+    report.created.extend(
+        {'row': number, 'id': customer_ids[user_ids[data['email']]], 'account_number': account_number}
+        for (number, data, _), account_number in zip(rows, account_numbers)
+    )
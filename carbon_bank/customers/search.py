@@ -0,0 +1,72 @@
+"""
+Customer search over username, email, first and last name and identity number (or an
+exact guid).
+
+The searched values are kept lower-cased in ``Customer.search_text``. On PostgreSQL a trigram
+GIN index on that column serves substring matches (``LIKE '%q%'``) as well as fuzzy ones
+(``q <% search_text``, pg_trgm word similarity, for typos), so a search stays an index scan
+at millions of customers. Results are ranked: matches at the start of a word first, then by
+word similarity. Queries shorter than a trigram only match the start of a word, through the
+``text_pattern_ops`` index for the first word and the trigram index (``LIKE '% q%'``, pg_trgm
+pads the start of every word) for the others.
+
+Other backends match substrings without an index.
+"""
+import uuid
+
+from django.db import connections
+from django.db.models import Case, FloatField, Func, Q, TextField, Value, When
+from django.db.models.lookups import PostgresOperatorLookup
+
+# Shorter queries have no trigram to look up.
+MIN_TRIGRAM_LENGTH = 3
+
+
+class TrigramWordSimilarity(Func):
+    """``word_similarity(string, expression)``, as added to django.contrib.postgres in Django 4.0."""
+    function = 'WORD_SIMILARITY'
+    output_field = FloatField()
+
+    def __init__(self, string, expression, **extra):
+        super().__init__(Value(string), expression, **extra)
+
+
+@TextField.register_lookup
+class TrigramWordSimilar(PostgresOperatorLookup):
+    """``search_text__trigram_word_similar=q``: q is similar to a word of search_text."""
+    lookup_name = 'trigram_word_similar'
+    postgres_operator = '%%>'
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def word_prefix(query):
+    """``query`` at the start of any word of search_text, whose values are joined with spaces."""
+    return Q(search_text__startswith=query) | Q(search_text__contains=f' {query}')
+
+
+def search_customers(queryset, query):
+    """Customers of ``queryset`` matching ``query``, best matches first on PostgreSQL."""
+    query = normalize_query(query)
+    if not query:
+        return queryset
+    try:
+        return queryset.filter(guid=uuid.UUID(query))
+    except ValueError:
+        pass
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.filter(search_text__contains=query)
+    if len(query) < MIN_TRIGRAM_LENGTH:
+        return queryset.filter(word_prefix(query)).order_by('search_text', 'pk')
+
+    return queryset.filter(
+        Q(search_text__contains=query) | Q(search_text__trigram_word_similar=query),
+    ).annotate(
+        search_rank=Case(
+            When(word_prefix(query), then=Value(1.0)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ) + TrigramWordSimilarity(query, 'search_text'),
+    ).order_by('-search_rank', 'pk')
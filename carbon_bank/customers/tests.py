@@ -1,10 +1,19 @@
+import tempfile
+from io import StringIO
+from unittest import mock, skipUnless
+
 import ipdb
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import override_settings
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
 
 from management.models import BankAccount
+from . import onboarding
 from .api.views import CustomerCreateAPIView
 from .models import Customer
 
@@ -99,3 +108,123 @@ class CustomerAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(
             response.data["count"] == Customer.objects.all().count())
+
+    def test_bulk_create_customers(self):
+        self.create_customer('selcuk1@gmail.com', '123456')
+        row = {
+            'first_name': 'ali', 'last_name': 'veli', 'address': 'istanbul', 'sex': Customer.MALE,
+            'password': 'Selcuk123',
+        }
+        payload = [
+            dict(row, email='ali@gmail.com', identity_number='1001'),
+            dict(row, email='ali@gmail.com', identity_number='1002'),
+            dict(row, email='selcuk1@gmail.com', identity_number='1003'),
+            dict(row, email='veli@gmail.com', identity_number='123456'),
+            dict(row, email='ayse@gmail.com', identity_number='1005', sex='other'),
+            dict(row, email='fatma@gmail.com', identity_number='1006', sex=Customer.FEMALE),
+        ]
+        url = reverse('customers:bulk-create')
+        response = self.client.post(url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([customer['row'] for customer in response.data['customers']], [1, 6])
+        self.assertEqual({error['row']: set(error['errors']) for error in response.data['errors']}, {
+            2: {'email'}, 3: {'email'}, 4: {'identity_number'}, 5: {'sex'},
+        })
+
+        customer = Customer.objects.get(user__username='fatma@gmail.com')
+        self.assertEqual(customer.bankaccount.account_number, response.data['customers'][1]['account_number'])
+        self.assertFalse(customer.bankaccount.is_active)
+        self.assertTrue(customer.user.check_password('Selcuk123'))
+
+        response = self.client.post(url, payload[:1], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(ONBOARDING_MAX_ROWS=2)
+    def test_bulk_create_stops_reading_past_the_limit(self):
+        read = []
+
+        def rows(upload):
+            for number in range(100):
+                read.append(number)
+                yield {'email': f'ali{number}@gmail.com'}
+
+        upload = SimpleUploadedFile('customers.csv', b'email\n')
+        with mock.patch('customers.api.views.read_upload', rows):
+            response = self.client.post(reverse('customers:bulk-create'), {'file': upload})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('At most 2 customers', response.data['detail'])
+        self.assertEqual(len(read), 3)
+        self.assertFalse(Customer.objects.filter(user__username__startswith='ali').exists())
+
+    def test_bulk_create_reports_rows_lost_to_concurrent_requests(self):
+        insert_chunk = onboarding._insert_chunk
+
+        def racing_insert(chunk, passwords, report):
+            # Every chunk insert and the row 2 insert collide with another request.
+            if len(chunk) > 1 or chunk[0][0] == 2:
+                raise IntegrityError('duplicate key value violates unique constraint')
+            insert_chunk(chunk, passwords, report)
+
+        row = {
+            'first_name': 'ali', 'last_name': 'veli', 'address': 'istanbul', 'sex': Customer.MALE,
+            'password': 'Selcuk123',
+        }
+        payload = [dict(row, email=f'ali{number}@gmail.com', identity_number=f'100{number}') for number in range(3)]
+        with mock.patch.object(onboarding, '_insert_chunk', racing_insert):
+            response = self.client.post(reverse('customers:bulk-create'), payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([customer['row'] for customer in response.data['customers']], [1, 3])
+        self.assertEqual([error['row'] for error in response.data['errors']], [2])
+        self.assertIn('non_field_errors', response.data['errors'][0]['errors'])
+
+    def test_import_customers_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as source:
+            source.write('first_name,last_name,email,password,identity_number,address,sex\n')
+            for number in range(5):
+                source.write(f'ali,veli,ali{number}@gmail.com,secret{number},{2000 + number},istanbul,male\n')
+            source.write('ali,veli,not-an-email,secret,2999,istanbul,male\n')
+            source.flush()
+            stderr = StringIO()
+            call_command('import_customers', source.name, '--chunk-size', '2', '--processes', '2',
+                         stdout=StringIO(), stderr=stderr)
+
+        self.assertEqual(BankAccount.objects.filter(owner__user__username__startswith='ali').count(), 5)
+        self.assertTrue(User.objects.get(username='ali3@gmail.com').check_password('secret3'))
+        self.assertIn('row 6:', stderr.getvalue())
+
+    def test_search_customers(self):
+        self.create_customer('selcuk1@gmail.com', '123456')
+        self.create_customer('ahmet@carbonbank.com', '654321')
+        url = reverse('customers:list')
+
+        def search(query):
+            response = self.client.get(url, {'q': query})
+            return [customer['email'] for customer in response.data['results']]
+
+        self.assertEqual(search('CARBONBANK'), ['ahmet@carbonbank.com'])
+        self.assertEqual(search('6543'), ['ahmet@carbonbank.com'])
+        self.assertEqual(len(search('selcuk')), 2)
+        customer = Customer.objects.get(user__username='selcuk1@gmail.com')
+        self.assertEqual(search(str(customer.guid)), ['selcuk1@gmail.com'])
+
+        customer.user.first_name = 'Mehmet'
+        customer.user.save()
+        self.assertEqual(search('mehmet'), ['selcuk1@gmail.com'])
+
+    def test_short_search_matches_the_start_of_any_word(self):
+        self.create_customer('selcuk1@gmail.com', '123456')
+        self.create_customer('ahmet@carbonbank.com', '654321')
+        user = User.objects.get(username='ahmet@carbonbank.com')
+        user.last_name = 'Alvarez'
+        user.save()
+
+        response = self.client.get(reverse('customers:list'), {'q': 'al'})
+        self.assertEqual([customer['email'] for customer in response.data['results']], ['ahmet@carbonbank.com'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Fuzzy matching needs pg_trgm.')
+    def test_search_customers_tolerates_typos(self):
+        self.create_customer('selcuk1@gmail.com', '123456')
+        self.create_customer('ahmet@carbonbank.com', '654321')
+        response = self.client.get(reverse('customers:list'), {'q': 'carbonbamk'})
+        self.assertEqual([customer['email'] for customer in response.data['results']], ['ahmet@carbonbank.com'])
@@ -0,0 +1,36 @@
+"""
+Gunicorn settings for carbon_bank.
+
+CARBON_BANK_SERVER_MODE selects how the project is served:
+    wsgi  sync workers running carbon_bank.wsgi (default)
+    asgi  uvicorn workers running carbon_bank.asgi; the money movement, balance and
+          listing views then run as async views (see cores/async_views.py)
+"""
+import os
+
+server_mode = os.environ.get('CARBON_BANK_SERVER_MODE', 'wsgi')
+
+bind = os.environ.get('GUNICORN_BIND', ':8000')
+# Every worker has its own database connections: up to ASYNC_DB_THREADS of them in asgi mode
+# (or the pool's MAX_SIZE + MAX_OVERFLOW). Keep workers times that below the server's
+# max_connections, and use the shared caches (settings.CACHES['shared']) with more than one.
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+reload = os.environ.get('GUNICORN_RELOAD', '1') == '1'
+
+if server_mode == 'asgi':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'carbon_bank.asgi:application'
+else:
+    wsgi_app = 'carbon_bank.wsgi:application'
+
+
+def on_starting(server):
+    # Refuse to start on settings the system checks reject, e.g. a per-process cache where
+    # several workers need to share it (cores/checks.py).
+    import django
+    from django.core.management import call_command
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'carbon_bank.settings')
+    os.environ['GUNICORN_WORKERS'] = str(server.cfg.workers)
+    django.setup()
+    call_command('check')
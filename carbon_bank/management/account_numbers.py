@@ -0,0 +1,109 @@
+"""
+Account numbers: a 13 digit serial number followed by a Luhn check digit.
+
+On PostgreSQL serials come from the ``management_account_number`` sequence, which advances by
+BLOCK_SIZE. A process reserves a block of BLOCK_SIZE serials with one ``nextval`` and hands
+them out from memory. Sequences are not transactional: a rolled back customer creation leaves
+a gap, and no two processes ever receive the same block, so numbers are unique without a
+lookup or a retry. The accounts a process creates are numbered consecutively, which keeps
+inserts into the unique index on a few pages instead of scattering them over the whole tree.
+
+Other backends (development, tests) continue from the highest account number, inside the
+caller's transaction.
+
+Numbers are 14 characters long, so they never collide with the 13 character random numbers
+of older accounts.
+"""
+import os
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Max
+from django.db.models.functions import Length
+
+SEQUENCE = 'management_account_number'
+# Changing it needs an ALTER SEQUENCE ... INCREMENT BY to match.
+BLOCK_SIZE = 1000
+SERIAL_DIGITS = 13
+NUMBER_LENGTH = SERIAL_DIGITS + 1
+
+
+def check_digit(digits):
+    """Luhn check digit of a string of digits."""
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str(-total % 10)
+
+
+def format_account_number(serial):
+    digits = f'{serial:0{SERIAL_DIGITS}d}'
+    return digits + check_digit(digits)
+
+
+def is_valid_account_number(number):
+    """Whether ``number`` is a well formed account number of the current format."""
+    return (
+        len(number) == NUMBER_LENGTH
+        and number.isdigit()
+        and check_digit(number[:-1]) == number[-1]
+    )
+
+
+class AccountNumberAllocator:
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.blocks = 0
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Forked processes must not hand out the rest of their parent's block.
+        self._next = self._end = 0
+
+    def allocate(self, count=1):
+        """``count`` new account numbers, in ascending order."""
+        connection = connections[self.using]
+        if connection.vendor != 'postgresql':
+            return [format_account_number(serial) for serial in self._next_serials(count)]
+
+        serials = []
+        with self._lock:
+            while len(serials) < count:
+                if self._next >= self._end:
+                    self._next = self._reserve_block(connection)
+                    self._end = self._next + BLOCK_SIZE
+                    self.blocks += 1
+                taken = min(count - len(serials), self._end - self._next)
+                serials.extend(range(self._next, self._next + taken))
+                self._next += taken
+        return [format_account_number(serial) for serial in serials]
+
+    @staticmethod
+    def _reserve_block(connection):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT nextval(%s)', [SEQUENCE])
+            return cursor.fetchone()[0]
+
+    def _next_serials(self, count):
+        from management.models import BankAccount
+
+        highest = BankAccount.objects.using(self.using).annotate(
+            length=Length('account_number'),
+        ).filter(length=NUMBER_LENGTH).aggregate(highest=Max('account_number'))['highest']
+        first = int(highest[:-1]) + 1 if highest else 1
+        return range(first, first + count)
+
+
+allocator = AccountNumberAllocator()
+os.register_at_fork(after_in_child=allocator.reset)
+
+
+def allocate_account_numbers(count=1):
+    return allocator.allocate(count)
@@ -5,11 +5,16 @@ from django.contrib import admin
 
 class BankAccountAdmin(admin.ModelAdmin):
     list_display = [
-        'id', 'guid', 'account_number', 'owner', 'is_active', 'total_balance'
+        'id', 'guid', 'account_number', 'owner', 'is_active', 'total_balance', 'hot_shards'
     ]
     list_display_links = ['id', 'is_active', 'total_balance']
     search_fields = ['guid', 'owner', 'account_number']
     list_filter = ['is_active']
+    list_select_related = ['owner__user']
+    readonly_fields = ['balance', 'balance_watermark', 'hot_shards']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_shard_balance()
 
 
 admin.site.register(BankAccount, BankAccountAdmin)
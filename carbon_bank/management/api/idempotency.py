@@ -0,0 +1,96 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from management.locking import retry_on_conflict
+from management.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+
+class IdempotentCreateMixin:
+    """
+        Honour the ``Idempotency-Key`` request header on create views.
+
+        The first request with a key runs normally and its successful response is stored in
+        the same transaction as the ledger rows. A retry with the same key is answered from
+        that row with a single indexed lookup: no validation, no row locks, no ledger writes.
+        A concurrent duplicate blocks on the unique (user, key) index until the first request
+        commits, then replays its response.
+
+        Views that answer creates differently override ``create_response``, not ``create``.
+    """
+
+    def create(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return self.create_response(request, *args, **kwargs)
+
+        if len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            return Response({'idempotency_key': 'Idempotency key is too long.'}, status.HTTP_400_BAD_REQUEST)
+
+        endpoint = request.resolver_match.view_name
+        request_hash = hashlib.sha256(
+            json.dumps(request.data, sort_keys=True, cls=JSONEncoder).encode()
+        ).hexdigest()
+
+        response = self.replay_idempotent(request.user, key, endpoint, request_hash)
+        if response is not None:
+            return response
+
+        try:
+            return self.create_idempotent(request, key, endpoint, request_hash, *args, **kwargs)
+        except IntegrityError:
+            response = self.replay_idempotent(request.user, key, endpoint, request_hash)
+            if response is None:
+                raise
+            return response
+
+    @staticmethod
+    def replay_idempotent(user, key, endpoint, request_hash):
+        stored = IdempotencyKey.objects.filter(
+            user=user,
+            key=key,
+            expires_at__gt=timezone.now(),
+        ).values('endpoint', 'request_hash', 'response_status', 'response_body').first()
+        if stored is None:
+            return None
+
+        if stored['endpoint'] != endpoint or stored['request_hash'] != request_hash:
+            return Response(
+                {'idempotency_key': 'Idempotency key was already used for a different request.'},
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        return Response(stored['response_body'], stored['response_status'], headers={'Idempotent-Replayed': 'true'})
+
+    @retry_on_conflict
+    def create_idempotent(self, request, key, endpoint, request_hash, *args, **kwargs):
+        with transaction.atomic():
+            # A key left over from an expired entry is replaced, not replayed.
+            IdempotencyKey.objects.filter(user=request.user, key=key, expires_at__lte=timezone.now()).delete()
+            record = IdempotencyKey.objects.create(
+                user=request.user,
+                key=key,
+                endpoint=endpoint,
+                request_hash=request_hash,
+                response_status=status.HTTP_102_PROCESSING,
+                expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            )
+
+            # Validation errors propagate as exceptions and roll the key back with the ledger,
+            # so only successful responses are stored and replayed.
+            response = self.create_response(request, *args, **kwargs)
+            record.response_status = response.status_code
+            record.response_body = json.loads(json.dumps(response.data, cls=JSONEncoder))
+            record.save(update_fields=['response_status', 'response_body'])
+        return response
+
+    def create_response(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
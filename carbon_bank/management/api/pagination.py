@@ -0,0 +1,9 @@
+from rest_framework.pagination import CursorPagination
+
+
+class LedgerCursorPagination(CursorPagination):
+    """
+        Keyset pagination over ledger rows, newest first. The (created_date, id) ordering is
+        stable, so every page is a single index range scan regardless of its depth.
+    """
+    ordering = ('-created_date', '-id')
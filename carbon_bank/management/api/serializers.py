@@ -1,11 +1,20 @@
+from decimal import Decimal
+
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
 from rest_framework import serializers
 
+from cores.instrumentation import TimedSerializerMixin
+from cores.principal import get_principal
 from customers.models import Customer
-from management.models import BankAccount, BankTransaction
+from management import fast_path
+from management.group_commit import Deposit, get_deposit_batcher
+from management.locking import lock_accounts, retry_on_conflict
+from management.models import BankAccount, BankTransaction, Transfer
 
 
-class AccountSerializer(serializers.ModelSerializer):
+class AccountSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     owner = serializers.CharField(source='owner.user.get_full_name')
     balance = serializers.DecimalField(
         source='total_balance',
@@ -20,7 +29,7 @@ class AccountSerializer(serializers.ModelSerializer):
         ]
 
 
-class AccountActivateSerializer(serializers.ModelSerializer):
+class AccountActivateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = BankAccount
         fields = [
@@ -28,7 +37,7 @@ class AccountActivateSerializer(serializers.ModelSerializer):
         ]
 
 
-class TransactionSerializer(serializers.ModelSerializer):
+class TransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     bank_account = serializers.CharField(source='bank_account.account_number')
     sender = serializers.CharField(source='sender.user.email')
     receiver = serializers.CharField(source='receiver.user.email')
@@ -36,30 +45,40 @@ class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = BankTransaction
         fields = [
-            'id', 'bank_account', 'sender', 'receiver', 'amount', 'is_debit',
+            'id', 'bank_account', 'sender', 'receiver', 'amount', 'is_debit', 'transfer',
         ]
 
 
-class DepositTransactionSerializer(serializers.Serializer):
-    # sender = serializers.PrimaryKeyRelatedField(
-    #     queryset=Customer.objects.filter(is_deleted=False),
-    #     write_only=True
-    # )
+class TransactionResultMixin:
+    """Creating serializers that answer with the ledger row they created."""
+
+    def to_representation(self, instance):
+        return TransactionSerializer(instance, context=self.context).data
+
+
+class DepositTransactionSerializer(TransactionResultMixin, TimedSerializerMixin, serializers.Serializer):
     amount = serializers.DecimalField(max_digits=12, decimal_places=2)
 
     def validate(self, attrs):
-        # sender = attrs.get('sender')
-        sender = Customer.objects.get(user=self.context["request"].user)
-        if not sender.bankaccount.is_active:
+        principal = get_principal(self.context['request'])
+        if principal.account is None or not principal.account.is_active:
             raise serializers.ValidationError({
                 'sender': 'Bank account is not active.'
             })
+        attrs['sender'] = principal.customer
         return attrs
 
-    @transaction.atomic
     def create(self, validated_data):
-        sender = Customer.objects.get(user=self.context["request"].user)
+        sender = validated_data.get('sender')
         deposit_amount = validated_data.get('amount')
+        batcher = get_deposit_batcher()
+        if batcher is not None and not transaction.get_connection().in_atomic_block:
+            # Committed together with the deposits of other requests, see management/group_commit.py.
+            deposit_tran = batcher.deposit(Deposit(sender.bankaccount.pk, sender.pk, deposit_amount))
+            deposit_tran.bank_account = sender.bankaccount
+            deposit_tran.sender = deposit_tran.receiver = sender
+            return deposit_tran
+
         deposit_tran = BankTransaction()
         deposit_tran.bank_account = sender.bankaccount
         deposit_tran.sender = sender
@@ -68,20 +87,26 @@ class DepositTransactionSerializer(serializers.Serializer):
         deposit_tran.is_debit = False
         deposit_tran.description = 'Amount deposit'
         deposit_tran.save()
-
-        serializer = TransactionSerializer(instance=deposit_tran)
-        return serializer.data
+        return deposit_tran
 
 
 class WithdrawSerializer(DepositTransactionSerializer):
 
+    @retry_on_conflict
     @transaction.atomic
     def create(self, validated_data):
-        sender = Customer.objects.get(user=self.context["request"].user)
+        sender = validated_data.get('sender')
         deposit_amount = validated_data.get('amount')
-        sender_bank = BankAccount.objects.select_for_update().get(
-            pk=sender.bankaccount.pk,
-        )
+        if fast_path.is_enabled():
+            outcome = fast_path.withdraw(sender.bankaccount.pk, deposit_amount)
+            if not outcome.ok:
+                raise serializers.ValidationError(fast_path.ERRORS[outcome.status])
+            return BankTransaction(
+                pk=outcome.transaction_id, bank_account=sender.bankaccount, sender=sender, receiver=sender,
+                amount=deposit_amount, is_debit=True, description='Amount withdrawn',
+            )
+
+        sender_bank = lock_accounts([sender.bankaccount.pk])[sender.bankaccount.pk]
         if sender_bank.total_balance < deposit_amount:
             raise serializers.ValidationError({
                 'amount': 'Insufficient balance.'
@@ -94,71 +119,169 @@ class WithdrawSerializer(DepositTransactionSerializer):
         withdraw_tran.is_debit = True
         withdraw_tran.description = 'Amount withdrawn'
         withdraw_tran.save()
-
-        serializer = TransactionSerializer(instance=withdraw_tran)
-        return serializer.data
+        return withdraw_tran
 
 
-class TransferTransactionSerializer(serializers.Serializer):
+class TransferTransactionSerializer(TransactionResultMixin, TimedSerializerMixin, serializers.Serializer):
+    # Only admins choose the sender, customers always send from their own account.
     sender = serializers.PrimaryKeyRelatedField(
-        queryset=Customer.objects.filter(is_deleted=False),
+        queryset=Customer.objects.filter(is_deleted=False).select_related('bankaccount'),
+        required=False,
     )
     destination_account_number = serializers.CharField()
     amount = serializers.DecimalField(max_digits=12, decimal_places=2)
 
+    def validate(self, attrs):
+        principal = get_principal(self.context['request'])
+        if not principal.is_superuser:
+            attrs['sender'] = principal.customer
+        if attrs.get('sender') is None:
+            raise serializers.ValidationError({
+                'sender': 'Invalid sender.'
+            })
+        return attrs
+
+    @retry_on_conflict
     @transaction.atomic
     def create(self, validated_data):
         sender = validated_data.get('sender')
         amount = validated_data.get('amount')
         account_number = validated_data.get('destination_account_number')
+        if fast_path.is_enabled():
+            outcome = fast_path.transfer(sender.bankaccount.pk, account_number, amount)
+            if not outcome.ok:
+                raise serializers.ValidationError(fast_path.ERRORS[outcome.status])
+            transfer_id = outcome.transfer_id
+        else:
+            transfer_id = self.post_transfer(sender, account_number, amount).pk
+
+        # One query for the row and everything its representation shows.
+        return BankTransaction.objects.select_related(
+            'bank_account', 'sender__user', 'receiver__user',
+        ).get(transfer_id=transfer_id, is_debit=True)
 
+    @staticmethod
+    def post_transfer(sender, account_number, amount):
         try:
-            receiver_bank = BankAccount.objects.select_for_update().get(
-                account_number=account_number,
-            )
+            receiver_bank = BankAccount.objects.get(account_number=account_number)
         except BankAccount.DoesNotExist:
             raise serializers.ValidationError({
                 'destination_account_number': 'Invalid account number.'
             })
 
+        # Both rows are locked together in pk order, never receiver-then-sender. Hot
+        # receivers are credited on a balance shard and their row is not locked at all.
+        locked = [sender.bankaccount.pk]
+        if not receiver_bank.hot_shards:
+            locked.append(receiver_bank.pk)
+        accounts = lock_accounts(locked)
+        receiver_bank = accounts.get(receiver_bank.pk, receiver_bank)
+        sender_bank = accounts[sender.bankaccount.pk]
+
         if not receiver_bank.is_active:
             raise serializers.ValidationError({
                 'receiver': 'Bank account is not active.'
             })
 
-        if not sender.bankaccount.is_active:
+        if not sender_bank.is_active:
             raise serializers.ValidationError({
                 'sender': 'Bank account is not active.'
             })
 
         # Be sure sender bank has sufficient balance!
-        sender_bank = BankAccount.objects.select_for_update().get(
-            pk=sender.bankaccount.pk,
-        )
         if sender_bank.total_balance < amount:
             raise serializers.ValidationError({
                 'amount': 'Insufficient balance.'
             })
 
-        # Bank transaction for sender.
-        transaction_sender = BankTransaction()
-        transaction_sender.bank_account = sender.bankaccount
-        transaction_sender.sender = sender
-        transaction_sender.receiver = receiver_bank.owner
-        transaction_sender.amount = amount
-        transaction_sender.is_debit = True
-        transaction_sender.description = 'Amount transferred'
-        transaction_sender.save()
-
-        # Bank transaction for receiver.
-        transaction_receiver = BankTransaction()
-        transaction_receiver.bank_account = receiver_bank
-        transaction_receiver.sender = sender
-        transaction_receiver.receiver = receiver_bank.owner
-        transaction_receiver.amount = amount
-        transaction_receiver.is_debit = False
-        transaction_receiver.description = 'Amount received'
-        transaction_receiver.save()
-
-        serializer = TransactionSerializer(instance=transaction_sender)
-        return serializer.data
+        # Both legs are inserted in one round trip and linked by the transfer.
+        transfer, = Transfer.objects.post([
+            Transfer(sender_account=sender_bank, receiver_account=receiver_bank, amount=amount),
+        ])
+        return transfer
+
+
+class BatchTransferItemSerializer(TimedSerializerMixin, serializers.Serializer):
+    sender = serializers.IntegerField(required=False)
+    destination_account_number = serializers.CharField()
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class BatchTransferSerializer(TimedSerializerMixin, serializers.Serializer):
+    transfers = BatchTransferItemSerializer(many=True, allow_empty=False)
+
+    def validate_transfers(self, value):
+        if len(value) > settings.BATCH_TRANSFER_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f'At most {settings.BATCH_TRANSFER_MAX_ITEMS} transfers are allowed in one batch.'
+            )
+        return value
+
+    @retry_on_conflict
+    @transaction.atomic
+    def create(self, validated_data):
+        items = validated_data.get('transfers')
+        principal = get_principal(self.context["request"])
+        if not principal.is_superuser:
+            for item in items:
+                item['sender'] = principal.customer_id
+
+        sender_ids = {item['sender'] for item in items if item.get('sender') is not None}
+        account_numbers = {item['destination_account_number'] for item in items}
+
+        # Lock every account involved once, in the same global order as single transfers.
+        # Hot accounts that are only credited are read without a lock.
+        involved = list(BankAccount.objects.filter(
+            Q(owner_id__in=sender_ids) | Q(account_number__in=account_numbers),
+        ).values_list('pk', 'owner_id', 'hot_shards'))
+        unlocked = [pk for pk, owner_id, hot_shards in involved if hot_shards and owner_id not in sender_ids]
+        accounts = list(lock_accounts(pk for pk, _, _ in involved if pk not in unlocked).values())
+        accounts += BankAccount.objects.filter(pk__in=unlocked)
+        by_owner = {account.owner_id: account for account in accounts}
+        by_number = {account.account_number: account for account in accounts}
+        # Only senders need their shards counted, and they are locked: the shards of a hot
+        # sender can only grow until commit.
+        balances = {
+            account.pk: account.total_balance if account.owner_id in sender_ids else account.balance
+            for account in accounts
+        }
+
+        results = []
+        transfers = []
+        for index, item in enumerate(items):
+            amount = item.get('amount')
+            sender_bank = by_owner.get(item.get('sender'))
+            receiver_bank = by_number.get(item.get('destination_account_number'))
+
+            errors = self.validate_item(sender_bank, receiver_bank, amount, balances)
+            if errors:
+                results.append({'index': index, 'status': 'failed', 'errors': errors})
+                continue
+
+            balances[sender_bank.pk] -= amount
+            balances[receiver_bank.pk] += amount
+            transfers.append(Transfer(sender_account=sender_bank, receiver_account=receiver_bank, amount=amount))
+            results.append({
+                'index': index,
+                'status': 'success',
+                'transfer': str(transfers[-1].guid),
+                'destination_account_number': receiver_bank.account_number,
+                'amount': str(amount),
+            })
+
+        Transfer.objects.post(transfers)
+        return results
+
+    @staticmethod
+    def validate_item(sender_bank, receiver_bank, amount, balances):
+        if sender_bank is None:
+            return {'sender': 'Invalid sender.'}
+        if receiver_bank is None:
+            return {'destination_account_number': 'Invalid account number.'}
+        if not receiver_bank.is_active:
+            return {'receiver': 'Bank account is not active.'}
+        if not sender_bank.is_active:
+            return {'sender': 'Bank account is not active.'}
+        if balances[sender_bank.pk] < amount:
+            return {'amount': 'Insufficient balance.'}
+        return None
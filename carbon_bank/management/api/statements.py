@@ -0,0 +1,116 @@
+import csv
+import datetime
+import io
+import json
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BaseRenderer
+
+from management.models import BankTransaction
+
+# Rows are sent in pieces of about this many characters rather than one write per row.
+BUFFER_SIZE = 64 * 1024
+STATEMENT_FIELDS = ['id', 'created_date', 'type', 'amount', 'balance', 'sender', 'receiver', 'description']
+
+
+class StatementRenderer(BaseRenderer):
+    """
+        Selects the statement format through content negotiation (``?format=`` or Accept).
+        Statements themselves are streamed by the view, only error payloads are rendered here.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode(self.charset)
+
+
+class CSVStatementRenderer(StatementRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    @staticmethod
+    def lines(rows):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, STATEMENT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() >= BUFFER_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+
+class NDJSONStatementRenderer(StatementRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    @staticmethod
+    def lines(rows):
+        buffer, size = [], 0
+        for row in rows:
+            line = json.dumps(row) + '\n'
+            buffer.append(line)
+            size += len(line)
+            if size >= BUFFER_SIZE:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        yield ''.join(buffer)
+
+
+def parse_period(query_params):
+    """``from`` and ``to`` dates (inclusive, local time) as an aware [start, end) range."""
+    bounds = []
+    for name, offset in (('from', 0), ('to', 1)):
+        value = query_params.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: 'Use the YYYY-MM-DD format.'})
+        bounds.append(timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=offset),
+                                                                    datetime.time.min)))
+    start, end = bounds
+    if start and end and start >= end:
+        raise ValidationError({'to': 'Must not be before from.'})
+    return start, end
+
+
+def statement_rows(account, start=None, end=None, using=None):
+    """
+        The live ledger rows of ``account`` in [start, end), oldest first, with the running
+        balance after each row. Rows are read through a server-side cursor in chunks of
+        STATEMENT_CHUNK_SIZE, so memory does not grow with the length of the history.
+    """
+    rows = BankTransaction.objects.using(using).filter(bank_account=account, is_deleted=False)
+    if start is not None:
+        rows = rows.filter(created_date__gte=start)
+    if end is not None:
+        rows = rows.filter(created_date__lt=end)
+    rows = rows.order_by('created_date', 'id').values_list(
+        'id', 'created_date', 'is_debit', 'amount', 'sender__user__email', 'receiver__user__email', 'description',
+    )
+
+    balance = None
+    for pk, created_date, is_debit, amount, sender, receiver, description in rows.iterator(
+        chunk_size=settings.STATEMENT_CHUNK_SIZE,
+    ):
+        if balance is None:
+            # Opening balance of the first row streamed, which also covers archived history.
+            balance = account.balance_at(start or created_date)
+        balance += -amount if is_debit else amount
+        yield {
+            'id': pk,
+            'created_date': created_date.isoformat(),
+            'type': 'debit' if is_debit else 'credit',
+            'amount': str(amount),
+            'balance': str(balance),
+            'sender': sender,
+            'receiver': receiver,
+            'description': description,
+        }
@@ -1,8 +1,9 @@
 from django.urls import path, include
 from rest_framework import routers
 
+from cores.async_views import server_view
 from .views import TransactionListAPIView, ActivateAccountView, AccountListAPIView, CreateDeposit, CreateTransfer, \
-    CreateWithdraw
+    CreateWithdraw, CreateBatchTransfer, StatementExportView
 
 app_name = 'management'
 
@@ -14,12 +15,14 @@ router = routers.DefaultRouter()
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('transaction-list/<pk>', TransactionListAPIView.as_view(), name='transaction-list'),
+    path('transaction-list/<int:pk>', server_view(TransactionListAPIView), name='transaction-list'),
     path('activate-account/<guid>', ActivateAccountView.as_view(), name='activate-account'),
-    path('account-list/', AccountListAPIView.as_view(), name='account-list'),
-    path('deposit/', CreateDeposit.as_view(), name='deposit'),
-    path('transfer/', CreateTransfer.as_view(), name='transfer'),
-    path('withdraw/', CreateWithdraw.as_view(), name='withdraw'),
+    path('account-list/', server_view(AccountListAPIView), name='account-list'),
+    path('deposit/', server_view(CreateDeposit), name='deposit'),
+    path('transfer/', server_view(CreateTransfer), name='transfer'),
+    path('batch-transfer/', server_view(CreateBatchTransfer), name='batch-transfer'),
+    path('withdraw/', server_view(CreateWithdraw), name='withdraw'),
+    path('statement/<int:pk>', server_view(StatementExportView), name='statement'),
 ]
 
 
@@ -1,18 +1,23 @@
-from django.db.models import Q
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, mixins, status
-from rest_framework.generics import ListAPIView, RetrieveUpdateAPIView, CreateAPIView
+from rest_framework.generics import ListAPIView, RetrieveAPIView, RetrieveUpdateAPIView, CreateAPIView
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 
+from cores.db.replicas import ReplicaReadMixin
 from cores.permissions import IsCustomer
-from customers.models import Customer
+from cores.principal import get_principal
 from management.models import BankAccount, BankTransaction
+from .idempotency import IdempotentCreateMixin
+from .pagination import LedgerCursorPagination
+from .statements import CSVStatementRenderer, NDJSONStatementRenderer, parse_period, statement_rows
 from .serializers import (AccountSerializer, DepositTransactionSerializer,
                           TransferTransactionSerializer, WithdrawSerializer,
-                          TransactionSerializer, AccountActivateSerializer)
+                          TransactionSerializer, AccountActivateSerializer,
+                          BatchTransferSerializer)
 
 
-class CreateDeposit(CreateAPIView):
+class CreateDeposit(IdempotentCreateMixin, CreateAPIView):
     """
         Send money to your bank account.
     """
@@ -20,18 +25,8 @@ class CreateDeposit(CreateAPIView):
     serializer_class = DepositTransactionSerializer
     permission_classes = [IsCustomer]
 
-    def perform_create(self, serializer):
-        data = self.request.data.copy()
-        if not self.request.user.is_superuser:
-            data['sender'] = Customer.objects.get(user=self.request.user).pk
-        serializer = self.get_serializer(data=data, context={'request': self.request})
-        if serializer.is_valid():
-            response = serializer.save()
-            return Response(response, status.HTTP_201_CREATED)
-        return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
 
-
-class CreateTransfer(CreateAPIView):
+class CreateTransfer(IdempotentCreateMixin, CreateAPIView):
     """
         Make a money transfer
     """
@@ -39,18 +34,24 @@ class CreateTransfer(CreateAPIView):
     serializer_class = TransferTransactionSerializer
     permission_classes = [IsAdminUser | IsCustomer, ]
 
-    def perform_create(self, serializer):
-        data = self.request.data.copy()
-        if not self.request.user.is_superuser:
-            data['sender'] = self.request.user.customer.pk
-        serializer = self.get_serializer(data=data, context={'request': self.request})
-        if serializer.is_valid():
-            response = serializer.save()
-            return Response(response, status.HTTP_201_CREATED)
-        return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
 
+class CreateBatchTransfer(IdempotentCreateMixin, CreateAPIView):
+    """
+        Make many money transfers in one database transaction. Every item is reported
+        as success or failed, failed items do not stop the others.
+    """
+    queryset = BankTransaction.objects.filter(is_deleted=False)
+    serializer_class = BatchTransferSerializer
+    permission_classes = [IsAdminUser | IsCustomer, ]
 
-class CreateWithdraw(CreateAPIView):
+    def create_response(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        return Response({'results': results}, status.HTTP_200_OK)
+
+
+class CreateWithdraw(IdempotentCreateMixin, CreateAPIView):
     """
         Withdraw money from your bank account.
     """
@@ -58,18 +59,8 @@ class CreateWithdraw(CreateAPIView):
     serializer_class = WithdrawSerializer
     permission_classes = [IsCustomer]
 
-    def perform_create(self, serializer):
-        data = self.request.data.copy()
-        if not self.request.user.is_superuser:
-            data['sender'] = self.request.user.customer.pk
-        serializer = self.get_serializer(data=data, context={'request': self.request})
-        if serializer.is_valid():
-            response = serializer.save()
-            return Response(response, status.HTTP_201_CREATED)
-        return Response(serializer.errors, status.HTTP_400_BAD_REQUEST)
 
-
-class AccountListAPIView(ListAPIView):
+class AccountListAPIView(ReplicaReadMixin, ListAPIView):
     """
         List all accounts for a specific user or get your own account.
     """
@@ -78,9 +69,10 @@ class AccountListAPIView(ListAPIView):
     permission_classes = [IsAdminUser | IsCustomer]
 
     def get_queryset(self):
+        queryset = BankAccount.objects.with_owner().with_shard_balance().order_by('pk')
         if self.request.user.is_superuser:
-            return BankAccount.objects.filter(is_deleted=False)
-        return BankAccount.objects.filter(owner=self.request.user.customer)
+            return queryset.filter(is_deleted=False)
+        return queryset.filter(owner=get_principal(self.request).customer)
 
 
 class ActivateAccountView(RetrieveUpdateAPIView):
@@ -93,7 +85,7 @@ class ActivateAccountView(RetrieveUpdateAPIView):
     permission_classes = [IsAdminUser]
 
 
-class TransactionListAPIView(ListAPIView):
+class TransactionListAPIView(ReplicaReadMixin, ListAPIView):
     """
         List all transaction for a specific user. you should be admin. pk = Customer id
     """
@@ -101,6 +93,43 @@ class TransactionListAPIView(ListAPIView):
     queryset = BankTransaction.objects.filter(is_deleted=False)
     permission_classes = [IsAdminUser]
 
+    pagination_class = LedgerCursorPagination
+
     def get_queryset(self):
-        return BankTransaction.objects.filter(Q(sender=Customer.objects.get(pk=self.kwargs["pk"])) | Q(
-            receiver=Customer.objects.get(pk=self.kwargs["pk"])))
+        # The rows on the customer's account: one leg per transfer, not both.
+        return BankTransaction.objects.filter(
+            bank_account__owner_id=self.kwargs["pk"],
+            is_deleted=False,
+        ).select_related(
+            'bank_account', 'sender__user', 'receiver__user',
+        ).order_by(*LedgerCursorPagination.ordering)
+
+
+class StatementExportView(ReplicaReadMixin, RetrieveAPIView):
+    """
+        Download the full ledger of an account as CSV, or NDJSON with ?format=ndjson, with the
+        running balance after each transaction. Limit it with ?from=YYYY-MM-DD&to=YYYY-MM-DD.
+        Admins can export any statement, customers their own. pk = Customer id
+    """
+    queryset = BankAccount.objects.filter(is_deleted=False)
+    lookup_field = 'owner'
+    lookup_url_kwarg = 'pk'
+    permission_classes = [IsAdminUser | IsCustomer]
+    renderer_classes = [CSVStatementRenderer, NDJSONStatementRenderer]
+
+    def get_queryset(self):
+        queryset = BankAccount.objects.filter(is_deleted=False)
+        if self.request.user.is_superuser:
+            return queryset
+        return queryset.filter(owner=get_principal(self.request).customer)
+
+    def retrieve(self, request, *args, **kwargs):
+        account = self.get_object()
+        start, end = parse_period(request.query_params)
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.lines(statement_rows(account, start, end, using=self.read_alias)),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        response['Content-Disposition'] = f'attachment; filename="statement-{account.account_number}.{renderer.format}"'
+        return response
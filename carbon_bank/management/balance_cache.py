@@ -0,0 +1,346 @@
+"""
+Cache of the account representation served by the get-balance endpoint, keyed by account.
+
+BALANCE_CACHE picks the backend:
+
+    BALANCE_CACHE = {
+        'BACKEND': 'management.balance_cache.LocalBalanceCache',   # per process LRU, the default
+        'TIMEOUT': 60,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+    BALANCE_CACHE = {
+        'BACKEND': 'management.balance_cache.SharedBalanceCache',  # any Django cache, e.g. redis
+        'TIMEOUT': 60,
+        'OPTIONS': {'CACHE_ALIAS': 'default'},
+    }
+
+Entries are dropped by ``invalidate_balances``, which ``BankAccount.apply_transactions`` and
+``BankAccount.save`` call for every account they change, once inside the transaction and
+again after it commits. A fill that started before an invalidation is not stored, and
+concurrent misses of one account wait for a single load instead of all hitting the database.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from cores.metrics import registry
+
+
+class _Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.loaded = False
+        self.value = None
+
+
+class BaseBalanceCache:
+    """Single-flight loading and hit/miss/eviction counters on top of a backend's storage."""
+    name = 'base'
+
+    def __init__(self, timeout=60, lock_timeout=5.0, **options):
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+            self.coalesced = 0
+
+    def _count(self, counter, amount=1):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, account_id):
+        found, value = self._get(account_id)
+        self._count('hits' if found else 'misses')
+        return value if found else None
+
+    def get_or_load(self, account_id, loader):
+        """The cached value of ``account_id``, calling ``loader(account_id)`` on a miss."""
+        found, value = self._get(account_id)
+        if found:
+            self._count('hits')
+            return value
+        self._count('misses')
+
+        with self._flights_lock:
+            flight = self._flights.get(account_id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[account_id] = _Flight()
+
+        if not leader:
+            # Another thread is loading this account, share its result.
+            if flight.done.wait(self.lock_timeout) and flight.loaded:
+                self._count('coalesced')
+                return flight.value
+            return loader(account_id)
+
+        try:
+            generation = self._generation(account_id)
+            value = self._load(account_id, loader, generation)
+            flight.value, flight.loaded = value, True
+            return value
+        finally:
+            with self._flights_lock:
+                del self._flights[account_id]
+                self._loaded(account_id)
+            flight.done.set()
+
+    def _load(self, account_id, loader, generation):
+        value = loader(account_id)
+        self._store(account_id, value, generation)
+        return value
+
+    def account_of_owner(self, owner_id):
+        """The account of a customer, remembered by ``remember_owner``. Accounts never change owner."""
+        found, account_id = self._get(('owner', str(owner_id)))
+        return account_id if found else None
+
+    def remember_owner(self, owner_id, account_id):
+        self._put(('owner', str(owner_id)), account_id)
+
+    def invalidate(self, account_ids):
+        account_ids = list(account_ids)
+        self._delete(account_ids)
+        self._count('invalidations', len(account_ids))
+
+    def clear(self):
+        raise NotImplementedError
+
+    def collect(self):
+        labels = {'backend': self.name}
+        with self._stats_lock:
+            counters = [
+                ('hits', 'Balance cache hits.', self.hits),
+                ('misses', 'Balance cache misses.', self.misses),
+                ('evictions', 'Entries evicted for space or expired.', self.evictions),
+                ('invalidations', 'Entries invalidated by ledger postings.', self.invalidations),
+                ('coalesced', 'Misses served by a concurrent load of the same account.', self.coalesced),
+            ]
+        for name, doc, value in counters:
+            yield f'carbon_bank_balance_cache_{name}_total', 'counter', doc, value, labels
+
+    # Storage, implemented by the backends.
+
+    def _get(self, account_id):
+        """``(True, value)`` for a live entry, ``(False, None)`` otherwise."""
+        raise NotImplementedError
+
+    def _generation(self, account_id):
+        """Token that changes whenever ``account_id`` is invalidated."""
+        raise NotImplementedError
+
+    def _store(self, account_id, value, generation):
+        """Store ``value`` unless ``account_id`` was invalidated since ``generation`` was read."""
+        raise NotImplementedError
+
+    def _put(self, key, value):
+        raise NotImplementedError
+
+    def _delete(self, account_ids):
+        raise NotImplementedError
+
+    def _loaded(self, account_id):
+        """Called once a load of ``account_id`` finished, stored or not."""
+
+
+class LocalBalanceCache(BaseBalanceCache):
+    """In-process LRU with a TTL. Each worker process has its own copy."""
+    name = 'local'
+
+    def __init__(self, timeout=60, lock_timeout=5.0, max_entries=10000, **options):
+        super().__init__(timeout, lock_timeout)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def _get(self, account_id):
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[account_id]
+                self._count('evictions')
+                return False, None
+            self._entries.move_to_end(account_id)
+            return True, value
+
+    def _generation(self, account_id):
+        with self._lock:
+            return self._generations.get(account_id, 0)
+
+    def _store(self, account_id, value, generation):
+        with self._lock:
+            if self._generations.get(account_id, 0) == generation:
+                self._put_locked(account_id, value)
+
+    def _put(self, key, value):
+        with self._lock:
+            self._put_locked(key, value)
+
+    def _put_locked(self, key, value):
+        self._entries[key] = (time.monotonic() + self.timeout, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._count('evictions')
+
+    def _delete(self, account_ids):
+        with self._lock:
+            for account_id in account_ids:
+                self._entries.pop(account_id, None)
+                # Only a load in progress can store a stale value, so generations are
+                # tracked for those accounts only.
+                if account_id in self._flights:
+                    self._generations[account_id] = self._generations.get(account_id, 0) + 1
+
+    def _loaded(self, account_id):
+        with self._lock:
+            self._generations.pop(account_id, None)
+
+
+class SharedBalanceCache(BaseBalanceCache):
+    """
+        Entries in a Django cache shared by all workers (redis, memcached, or locmem as a
+        local stand-in). The cache server evicts and expires entries itself, so only
+        lookups and invalidations are counted here. A short lease in the cache keeps the
+        other processes from loading an account that one of them is already loading.
+    """
+    name = 'shared'
+    poll_interval = 0.01
+
+    def __init__(self, timeout=60, lock_timeout=5.0, cache_alias='default', key_prefix='balance', **options):
+        super().__init__(timeout, lock_timeout)
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, key, kind='entry'):
+        if isinstance(key, tuple):
+            kind, key = key
+        return f'{self.key_prefix}:{kind}:{key}'
+
+    def clear(self):
+        self.cache.clear()
+
+    def _get(self, account_id):
+        entry = self.cache.get(self._key(account_id))
+        return (False, None) if entry is None else (True, entry)
+
+    def _generation(self, account_id):
+        return self.cache.get(self._key(account_id, 'generation'), 0)
+
+    def _load(self, account_id, loader, generation):
+        lease = self._key(account_id, 'lease')
+        if not self.cache.add(lease, 1, self.lock_timeout):
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                found, value = self._get(account_id)
+                if found:
+                    self._count('coalesced')
+                    return value
+            return loader(account_id)
+        try:
+            return super()._load(account_id, loader, generation)
+        finally:
+            self.cache.delete(lease)
+
+    def _store(self, account_id, value, generation):
+        if self._generation(account_id) == generation:
+            self._put(account_id, value)
+
+    def _put(self, key, value):
+        self.cache.set(self._key(key), value, self.timeout)
+
+    def _delete(self, account_ids):
+        self.cache.delete_many([self._key(account_id) for account_id in account_ids])
+        # Generations only need to outlive the loads in flight, a fill that sees an expired
+        # counter compares 0 with what it read and is dropped.
+        ttl = max(self.timeout, self.lock_timeout)
+        for account_id in account_ids:
+            key = self._key(account_id, 'generation')
+            # add() only creates the counter, incr() is atomic on the shared backends.
+            self.cache.add(key, 0, ttl)
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, 1, ttl)
+
+
+_balance_cache = None
+_balance_cache_lock = threading.Lock()
+
+
+def get_balance_cache():
+    global _balance_cache
+    if _balance_cache is None:
+        with _balance_cache_lock:
+            if _balance_cache is None:
+                config = settings.BALANCE_CACHE
+                options = {key.lower(): value for key, value in config.get('OPTIONS', {}).items()}
+                _balance_cache = import_string(config['BACKEND'])(
+                    timeout=config.get('TIMEOUT', 60),
+                    lock_timeout=config.get('LOCK_TIMEOUT', 5.0),
+                    **options,
+                )
+    return _balance_cache
+
+
+@receiver(setting_changed)
+def _reset_balance_cache(setting, **kwargs):
+    global _balance_cache
+    if setting == 'BALANCE_CACHE':
+        _balance_cache = None
+
+
+def _collect():
+    if _balance_cache is not None:
+        yield from _balance_cache.collect()
+
+
+registry.register_collector(_collect)
+
+
+def invalidate_balances(account_ids):
+    """
+        Drop the cached balance of ``account_ids`` now and, inside a transaction, again
+        after it commits: a concurrent fill may have read the balance before the commit.
+    """
+    account_ids = list(account_ids)
+    if not account_ids:
+        return
+    balance_cache = get_balance_cache()
+    balance_cache.invalidate(account_ids)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: balance_cache.invalidate(account_ids))
@@ -0,0 +1,218 @@
+"""
+Withdrawals and transfers as one SQL statement on PostgreSQL.
+
+The ORM path (management/api/serializers.py) needs a round trip for every step: look up the
+receiver, lock the accounts, insert the transfer, the legs and the outbox events, update the
+balances. Here a single data-modifying CTE does all of it on the server:
+
+1. lock the accounts involved, in primary key order like ``lock_accounts``, except a hot
+   receiver (management/hot_accounts.py),
+2. check the receiver exists, both accounts are active and the sender's balance, shards
+   included, covers the amount, giving one ``status`` (see ERRORS),
+3. only when the status is ``ok``: insert the transfer and its legs, fold the legs into the
+   balances, or a balance shard for a hot receiver, and record a ``transaction.posted``
+   outbox event per leg, with the same payload as ``OutboxEvent.objects.record_postings``.
+
+The checks read the locked rows, so they see the latest committed balance. All the inserts
+are skipped when a check fails, the statement then only returns the status.
+
+Enabled with settings.LEDGER_SQL_FAST_PATH (off by default), other backends always take the
+ORM path. SQLFastPathParityTest in management/tests.py checks both paths post the same rows.
+"""
+import uuid
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from management.balance_cache import invalidate_balances
+from management.hot_accounts import next_shard_pick
+from management.models import OutboxEvent
+
+# Validation errors of the ORM path, by status.
+ERRORS = {
+    'invalid_account': {'destination_account_number': 'Invalid account number.'},
+    'receiver_inactive': {'receiver': 'Bank account is not active.'},
+    'sender_inactive': {'sender': 'Bank account is not active.'},
+    'insufficient_balance': {'amount': 'Insufficient balance.'},
+}
+
+_POST_LEGS = """
+balances AS (
+    UPDATE management_bankaccount AS account
+    SET balance = account.balance + delta.amount,
+        balance_watermark = GREATEST(account.balance_watermark, delta.last_id)
+    FROM (
+        SELECT bank_account_id, SUM(CASE WHEN is_debit THEN -amount ELSE amount END) AS amount, MAX(id) AS last_id
+        FROM account_legs GROUP BY bank_account_id
+    ) AS delta
+    WHERE account.id = delta.bank_account_id
+),
+events AS (
+    INSERT INTO management_outboxevent (topic, payload, created_date, attempts, last_error)
+    SELECT %(topic)s, jsonb_build_object(
+        'transaction_id', id,
+        'transfer_id', transfer_id,
+        'account_id', bank_account_id,
+        'sender_id', sender_id,
+        'receiver_id', receiver_id,
+        'amount', amount::numeric(14, 2)::text,
+        'is_debit', is_debit,
+        'description', description,
+        'created_date', to_char(created_date AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')
+    ), statement_timestamp(), 0, ''
+    FROM legs ORDER BY id
+)
+"""
+
+# The sender's balance shards (management/hot_accounts.py), none unless it is a hot account.
+# They are locked after the account row, which makes them read at their latest version: a
+# sweep that committed while this statement waited for the account lock has moved them into
+# the balance already.
+_SENDER_SHARDS = """
+shards AS (
+    SELECT balance FROM management_balanceshard
+    WHERE bank_account_id IN (SELECT id FROM account)
+    FOR SHARE
+),
+"""
+
+WITHDRAW_SQL = """
+WITH account AS (
+    SELECT id, owner_id, is_active, balance FROM management_bankaccount
+    WHERE id = %(account_id)s
+    FOR UPDATE
+),
+""" + _SENDER_SHARDS + """
+outcome AS (
+    SELECT id AS account_id, owner_id, CASE
+        WHEN NOT is_active THEN 'sender_inactive'
+        WHEN balance + (SELECT COALESCE(SUM(balance), 0) FROM shards) < %(amount)s THEN 'insufficient_balance'
+        ELSE 'ok'
+    END AS status
+    FROM account
+),
+legs AS (
+    INSERT INTO management_banktransaction (created_date, modified_date, is_deleted, bank_account_id,
+                                            sender_id, receiver_id, amount, is_debit, description)
+    SELECT statement_timestamp(), statement_timestamp(), false, account_id,
+           owner_id, owner_id, %(amount)s, true, 'Amount withdrawn'
+    FROM outcome WHERE status = 'ok'
+    RETURNING id, created_date, bank_account_id, sender_id, receiver_id, amount, is_debit, description, transfer_id
+),
+account_legs AS (
+    SELECT * FROM legs
+),
+""" + _POST_LEGS + """
+SELECT outcome.status, legs.id
+FROM outcome LEFT JOIN legs ON true
+"""
+
+TRANSFER_SQL = """
+WITH receiver AS (
+    SELECT id, owner_id, is_active, hot_shards FROM management_bankaccount
+    WHERE account_number = %(account_number)s
+),
+-- Hot receivers are credited on a balance shard and not locked.
+accounts AS (
+    SELECT id, owner_id, is_active, balance FROM management_bankaccount
+    WHERE id = %(sender_account_id)s OR id IN (SELECT id FROM receiver WHERE hot_shards = 0)
+    ORDER BY id
+    FOR UPDATE
+),
+account AS (
+    SELECT * FROM accounts WHERE id = %(sender_account_id)s
+),
+""" + _SENDER_SHARDS + """
+outcome AS (
+    SELECT sender.id AS sender_account_id, sender.owner_id AS sender_id,
+           receiver.id AS receiver_account_id, receiver.owner_id AS receiver_id, receiver.hot_shards, CASE
+        WHEN receiver.id IS NULL THEN 'invalid_account'
+        WHEN NOT COALESCE(locked_receiver.is_active, receiver.is_active) THEN 'receiver_inactive'
+        WHEN NOT sender.is_active THEN 'sender_inactive'
+        WHEN sender.balance + (SELECT COALESCE(SUM(balance), 0) FROM shards) < %(amount)s THEN 'insufficient_balance'
+        ELSE 'ok'
+    END AS status
+    FROM account AS sender
+    LEFT JOIN receiver ON true
+    LEFT JOIN accounts AS locked_receiver ON locked_receiver.id = receiver.id
+),
+transfer AS (
+    INSERT INTO management_transfer (guid, sender_account_id, receiver_account_id, amount, created_date)
+    SELECT %(guid)s::uuid, sender_account_id, receiver_account_id, %(amount)s, statement_timestamp()
+    FROM outcome WHERE status = 'ok'
+    RETURNING id
+),
+legs AS (
+    INSERT INTO management_banktransaction (created_date, modified_date, is_deleted, bank_account_id,
+                                            sender_id, receiver_id, amount, is_debit, description, transfer_id)
+    SELECT statement_timestamp(), statement_timestamp(), false, leg.account_id,
+           outcome.sender_id, outcome.receiver_id, %(amount)s, leg.is_debit, leg.description, transfer.id
+    FROM outcome CROSS JOIN transfer CROSS JOIN LATERAL (VALUES
+        (outcome.sender_account_id, true, 'Amount transferred'),
+        (outcome.receiver_account_id, false, 'Amount received')
+    ) AS leg (account_id, is_debit, description)
+    RETURNING id, created_date, bank_account_id, sender_id, receiver_id, amount, is_debit, description, transfer_id
+),
+shard_credits AS (
+    INSERT INTO management_balanceshard (bank_account_id, shard, balance, balance_watermark)
+    SELECT legs.bank_account_id, mod(%(pick)s, outcome.hot_shards), legs.amount, legs.id
+    FROM legs JOIN outcome ON legs.bank_account_id = outcome.receiver_account_id
+    WHERE NOT legs.is_debit AND outcome.hot_shards > 0
+    ON CONFLICT (bank_account_id, shard) DO UPDATE
+    SET balance = management_balanceshard.balance + EXCLUDED.balance,
+        balance_watermark = GREATEST(management_balanceshard.balance_watermark, EXCLUDED.balance_watermark)
+),
+account_legs AS (
+    SELECT legs.* FROM legs CROSS JOIN outcome
+    WHERE legs.is_debit OR outcome.hot_shards = 0
+),
+""" + _POST_LEGS + """
+SELECT outcome.status, transfer.id, (SELECT id FROM legs WHERE is_debit), outcome.receiver_account_id
+FROM outcome LEFT JOIN transfer ON true
+"""
+
+
+class Outcome(NamedTuple):
+    status: str
+    transfer_id: Optional[int] = None
+    transaction_id: Optional[int] = None
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+
+def is_enabled(using=DEFAULT_DB_ALIAS):
+    return settings.LEDGER_SQL_FAST_PATH and connections[using].vendor == 'postgresql'
+
+
+def withdraw(account_id, amount, using=DEFAULT_DB_ALIAS):
+    """Withdraw ``amount`` from the account, must run in a transaction."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(WITHDRAW_SQL, {
+            'account_id': account_id, 'amount': amount, 'topic': OutboxEvent.TRANSACTION_POSTED,
+        })
+        row = cursor.fetchone()
+    if row is None:
+        return Outcome('sender_inactive')
+    status, transaction_id = row
+    if status == 'ok':
+        invalidate_balances([account_id])
+    return Outcome(status, transaction_id=transaction_id)
+
+
+def transfer(sender_account_id, account_number, amount, using=DEFAULT_DB_ALIAS):
+    """Transfer ``amount`` to the account numbered ``account_number``, must run in a transaction."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(TRANSFER_SQL, {
+            'sender_account_id': sender_account_id, 'account_number': account_number, 'amount': amount,
+            'guid': str(uuid.uuid4()), 'topic': OutboxEvent.TRANSACTION_POSTED, 'pick': next_shard_pick(),
+        })
+        row = cursor.fetchone()
+    if row is None:
+        return Outcome('sender_inactive')
+    status, transfer_id, transaction_id, receiver_account_id = row
+    if status == 'ok':
+        invalidate_balances(sorted({sender_account_id, receiver_account_id}))
+    return Outcome(status, transfer_id, transaction_id)
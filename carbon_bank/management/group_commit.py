@@ -0,0 +1,179 @@
+"""
+Group commit for deposits.
+
+Every deposit is its own database transaction, so during bulk top-ups the commits (one WAL
+flush each) cap the throughput. With DEPOSIT_GROUP_COMMIT enabled the deposit endpoint hands
+its row to the process's DepositBatcher instead:
+
+    DEPOSIT_GROUP_COMMIT = {
+        'ENABLED': True,
+        'MAX_BATCH': 100,    # deposits written in one transaction at most
+        'MAX_WAIT': 0.005,   # seconds the first deposit of a batch waits for others
+    }
+
+A writer thread takes the deposits queued within MAX_WAIT of the first one, up to MAX_BATCH,
+and posts them with one ``bulk_create`` in one transaction, balances and outbox events
+included. Each caller blocks until that transaction committed and then gets its own ledger
+row, so a response still means the deposit is durable. When a batch fails, its deposits are
+retried one transaction each and every caller gets its own result or error.
+
+Deposits made inside a transaction (an Idempotency-Key stores its response in the same
+transaction as the ledger row) are not queued: they have to commit or roll back with it.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.dispatch import receiver
+
+from cores.metrics import registry
+from management.locking import retry_on_conflict
+from management.models import BankTransaction
+
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Queued by DepositBatcher.close(): the writer thread exits once it reaches it.
+STOP = object()
+
+batch_size = registry.histogram(
+    'carbon_bank_deposit_group_commit_size', 'Deposits written per group commit transaction.', BATCH_BUCKETS,
+)
+
+
+class Deposit(NamedTuple):
+    account_id: int
+    customer_id: int
+    amount: object
+
+    def build(self):
+        return BankTransaction(
+            bank_account_id=self.account_id, sender_id=self.customer_id, receiver_id=self.customer_id,
+            amount=self.amount, is_debit=False, description='Amount deposit',
+        )
+
+
+@retry_on_conflict
+def post_deposits(deposits):
+    """Write ``deposits`` in one transaction, returns their ledger rows in the same order."""
+    rows = [deposit.build() for deposit in deposits]
+    with transaction.atomic():
+        if connections[DEFAULT_DB_ALIAS].features.can_return_rows_from_bulk_insert:
+            BankTransaction.objects.post(rows)
+        else:
+            # The rows need their ids for the responses: insert them one by one, still in
+            # a single transaction (SQLite).
+            for row in rows:
+                row.save()
+    return rows
+
+
+class DepositBatcher:
+
+    def __init__(self, max_batch=100, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Transactions written, only the writer thread updates it.
+        self.batches = 0
+
+    def submit(self, deposit):
+        """Queue ``deposit``, the future resolves to its ledger row once committed."""
+        future = Future()
+        self._queue.put((deposit, future))
+        self._start()
+        return future
+
+    def deposit(self, deposit):
+        return self.submit(deposit).result()
+
+    def close(self):
+        """Write the deposits queued so far, then stop the writer thread and close its connections."""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+            if writer is not None:
+                self._queue.put(STOP)
+                writer.join()
+
+    def _start(self):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='deposit-group-commit', daemon=True)
+                    self._writer.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if batch[-1] is STOP:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stopping = batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            # Long running: drop connections that broke or exceeded CONN_MAX_AGE, as requests do.
+            close_old_connections()
+            if batch:
+                self._write(batch)
+            if stopping:
+                connections.close_all()
+                return
+
+    def _write(self, batch):
+        self.batches += 1
+        batch_size.observe(len(batch))
+        try:
+            rows = post_deposits([deposit for deposit, _ in batch])
+        except Exception as exc:
+            if len(batch) > 1:
+                # One bad deposit must not fail the others: retry them a transaction each.
+                for item in batch:
+                    self._write([item])
+            else:
+                batch[0][1].set_exception(exc)
+            return
+        for (_, future), row in zip(batch, rows):
+            future.set_result(row)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_deposit_batcher():
+    """The process's DepositBatcher, ``None`` unless DEPOSIT_GROUP_COMMIT is enabled."""
+    global _batcher
+    config = settings.DEPOSIT_GROUP_COMMIT
+    if not config['ENABLED']:
+        return None
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = DepositBatcher(max_batch=config['MAX_BATCH'], max_wait=config['MAX_WAIT'])
+    return _batcher
+
+
+@receiver(setting_changed)
+def _reset_deposit_batcher(setting, **kwargs):
+    global _batcher
+    if setting == 'DEPOSIT_GROUP_COMMIT':
+        if _batcher is not None:
+            _batcher.close()
+        _batcher = None
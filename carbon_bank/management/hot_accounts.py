@@ -0,0 +1,129 @@
+"""
+Hot accounts: accounts credited so often (a merchant receiving thousands of transfers per
+second) that the lock of their BankAccount row serializes every transfer to them.
+
+``set_hot_shards(account, n)`` (the ``hot_account`` command) gives an account n BalanceShard
+rows. From then on:
+
+- credits are added to one of the shards, picked round robin, and neither lock nor update
+  the account row, so up to n credits to the account proceed concurrently;
+- debits lock the account row as before and count the shards into the available balance.
+  While a debit holds that lock credits can only raise the shards and the sweeper, which
+  needs the lock too, cannot lower them, so the check never overestimates;
+- ``total_balance`` adds the shards, ``with_shard_balance()`` annotates them for listings;
+- ``sweep_shards`` (the ``sweep_balance_shards`` command) moves shard balances into the
+  account row under its lock, skipping shards an in-flight credit holds.
+
+The ledger rows are written as for any account, the shards only split the running balance.
+"""
+import itertools
+import random
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from management.balance_cache import invalidate_balances
+from management.models import BalanceShard, BankAccount, BankTransaction
+
+# Each process starts at a random shard, so processes do not all hit shard 0 first.
+_picks = itertools.count(random.randrange(1 << 16))
+
+
+def next_shard_pick():
+    return next(_picks)
+
+
+def hot_shard_counts(transactions):
+    """``{account id: shard count}`` for the hot accounts ``transactions`` are posted to."""
+    counts = {}
+    unknown = set()
+    for tran in transactions:
+        account = BankTransaction.bank_account.field.get_cached_value(tran, None)
+        if account is not None:
+            counts[account.pk] = account.hot_shards
+        else:
+            unknown.add(tran.bank_account_id)
+    unknown -= counts.keys()
+    if unknown:
+        counts.update(BankAccount.objects.filter(pk__in=unknown).values_list('pk', 'hot_shards'))
+    return {account_id: shards for account_id, shards in counts.items() if shards}
+
+
+def credit_shards(transactions, shard_counts):
+    """Add credit ledger rows to a shard of their account each. Locks only those shard rows."""
+    credits = {}
+    for tran in transactions:
+        key = (tran.bank_account_id, next_shard_pick() % shard_counts[tran.bank_account_id])
+        amount, watermark = credits.get(key, (0, 0))
+        credits[key] = (amount + tran.amount, max(watermark, tran.pk or 0))
+
+    # Sorted, so transactions crediting several shards lock them in the same order.
+    for (account_id, shard), (amount, watermark) in sorted(credits.items()):
+        shard_rows = BalanceShard.objects.filter(bank_account_id=account_id, shard=shard)
+        values = {
+            'balance': F('balance') + amount,
+            'balance_watermark': Greatest(F('balance_watermark'), watermark),
+        }
+        if shard_rows.update(**values):
+            continue
+        # Shards beyond the ones set_hot_shards created, after the shard count was raised.
+        try:
+            with transaction.atomic():
+                BalanceShard.objects.create(
+                    bank_account_id=account_id, shard=shard, balance=amount, balance_watermark=watermark,
+                )
+        except IntegrityError:
+            shard_rows.update(**values)
+
+
+def set_hot_shards(account, shards):
+    """Spread credits to ``account`` over ``shards`` balance shards, or none with 0."""
+    with transaction.atomic():
+        BankAccount.objects.filter(pk=account.pk).update(hot_shards=shards)
+        BalanceShard.objects.bulk_create(
+            [BalanceShard(bank_account_id=account.pk, shard=shard) for shard in range(shards)],
+            ignore_conflicts=True,
+        )
+    account.hot_shards = shards
+    if not shards:
+        # Credits that read the account as hot before this committed may still land on a
+        # shard, the next sweep moves them.
+        sweep_account(account.pk, wait=True)
+        BalanceShard.objects.filter(bank_account_id=account.pk, balance=0).delete()
+    invalidate_balances([account.pk])
+
+
+def sweep_account(account_id, wait=False):
+    """
+        Move the shard balances of the account into its row. Shards locked by a credit are
+        skipped unless ``wait``. Returns the amount moved.
+    """
+    with transaction.atomic():
+        # Blocks debits, which count the shards, for the duration of the sweep.
+        if not list(BankAccount.objects.select_for_update().filter(pk=account_id).values_list('pk', flat=True)):
+            return 0
+        shards = BalanceShard.objects.filter(bank_account_id=account_id).exclude(balance=0)
+        skip_locked = not wait and connection.features.has_select_for_update_skip_locked
+        shards = list(shards.select_for_update(skip_locked=skip_locked).values_list('pk', 'balance', 'balance_watermark'))
+        if not shards:
+            return 0
+        amount = sum(balance for _, balance, _ in shards)
+        BalanceShard.objects.filter(pk__in=[pk for pk, _, _ in shards]).update(balance=0)
+        BankAccount.objects.filter(pk=account_id).update(
+            balance=F('balance') + amount,
+            balance_watermark=Greatest(F('balance_watermark'), max(watermark for _, _, watermark in shards)),
+        )
+    return amount
+
+
+def sweep_shards():
+    """Sweep every account with a non-empty shard. Returns the number of accounts swept and the amount moved."""
+    account_ids = BalanceShard.objects.exclude(balance=0).values_list('bank_account_id', flat=True).distinct()
+    swept = moved = 0
+    for account_id in sorted(account_ids):
+        amount = sweep_account(account_id)
+        if amount:
+            swept += 1
+            moved += amount
+    return swept, moved
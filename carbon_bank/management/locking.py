@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+from cores.metrics import registry
+from management.models import BankAccount
+
+# PostgreSQL SQLSTATEs that are safe to retry once the transaction has rolled back.
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+RETRYABLE_SQLSTATES = {SERIALIZATION_FAILURE, DEADLOCK_DETECTED}
+
+
+class LockStats:
+    """
+        Process wide counters for account row locks. Wait time is measured around the
+        SELECT ... FOR UPDATE statement, so it includes the time spent queued behind other
+        transactions holding the same rows.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquisitions = 0
+            self.rows_locked = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self.retries = 0
+            self.conflicts = 0
+
+    def record_wait(self, seconds, rows):
+        with self._lock:
+            self.acquisitions += 1
+            self.rows_locked += rows
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_conflict(self):
+        with self._lock:
+            self.conflicts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'acquisitions': self.acquisitions,
+                'rows_locked': self.rows_locked,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'retries': self.retries,
+                'conflicts': self.conflicts,
+            }
+
+    def collect(self):
+        stats = self.snapshot()
+        prefix = 'carbon_bank_account_lock'
+        yield f'{prefix}_acquisitions_total', 'counter', 'Account lock statements executed.', stats['acquisitions']
+        yield f'{prefix}_rows_total', 'counter', 'Account rows locked.', stats['rows_locked']
+        yield f'{prefix}_wait_seconds_total', 'counter', 'Time spent waiting for account locks.', \
+            stats['wait_seconds_total']
+        yield f'{prefix}_wait_seconds_max', 'gauge', 'Longest account lock wait.', stats['wait_seconds_max']
+        yield f'{prefix}_retries_total', 'counter', 'Transactions retried after a conflict.', stats['retries']
+        yield f'{prefix}_conflicts_total', 'counter', 'Deadlocks and serialization failures.', stats['conflicts']
+
+
+lock_stats = LockStats()
+registry.register_collector(lock_stats.collect)
+
+
+def lock_accounts(account_ids):
+    """
+        Lock the given bank accounts with SELECT ... FOR UPDATE in primary key order and
+        return them keyed by pk. Every code path that locks more than one account must go
+        through here: a global lock order is what keeps opposite transfers from deadlocking.
+    """
+    account_ids = sorted(set(account_ids))
+    started = time.monotonic()
+    accounts = list(BankAccount.objects.select_for_update().filter(pk__in=account_ids).order_by('pk'))
+    lock_stats.record_wait(time.monotonic() - started, len(accounts))
+    return {account.pk: account for account in accounts}
+
+
+def is_retryable(exc):
+    return getattr(exc.__cause__, 'pgcode', None) in RETRYABLE_SQLSTATES
+
+
+def retry_on_conflict(func):
+    """
+        Re-run ``func`` when the database aborts it with a deadlock or serialization failure,
+        with exponential backoff and jitter. ``func`` must own its transaction (decorate on top
+        of ``transaction.atomic``); inside an outer atomic block nothing can be retried, so the
+        error is raised as is.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            return func(*args, **kwargs)
+
+        attempts = settings.LEDGER_LOCK_RETRY_ATTEMPTS
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                if not is_retryable(exc):
+                    raise
+                lock_stats.record_conflict()
+                if attempt == attempts:
+                    raise
+            lock_stats.record_retry()
+            delay = min(settings.LEDGER_LOCK_RETRY_MAX_DELAY,
+                        settings.LEDGER_LOCK_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1))
+
+    return wrapper
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from management.periods import PeriodError, archive_closed_rows, closed_through, parse_boundary
+
+
+class Command(BaseCommand):
+    help = ('Move the ledger rows of closed periods to gzipped CSV files and remove them from '
+            'the database. History listings no longer show archived rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before', type=parse_boundary, default=None,
+            help='Archive rows created before this date, YYYY-MM-DD. Default: the end of the last closed period.',
+        )
+        parser.add_argument('--output-dir', default=settings.LEDGER_ARCHIVE_DIR)
+
+    def handle(self, *args, **options):
+        before = options['before'] or closed_through()
+        if before is None:
+            raise CommandError('No ledger period is closed yet, run close_ledger_period first.')
+        try:
+            paths = archive_closed_rows(before, options['output_dir'])
+        except PeriodError as exc:
+            raise CommandError(str(exc))
+        for path in paths:
+            self.stdout.write(path)
+        self.stdout.write(self.style.SUCCESS(f'{len(paths)} archive files written.'))
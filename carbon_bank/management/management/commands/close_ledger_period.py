@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from management import partitions
+from management.periods import PeriodError, close_period, parse_boundary
+
+
+class Command(BaseCommand):
+    help = ('Write per-account closing balances at the end of a ledger period, after which '
+            'balances no longer read the rows before it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--through', type=parse_boundary, default=None,
+            help='End of the period (exclusive), YYYY-MM-DD. Default: the start of the current month.',
+        )
+
+    def handle(self, *args, **options):
+        period_end = options['through'] or partitions.month_start(timezone.now())
+        try:
+            closed = close_period(period_end)
+        except PeriodError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            f'Closed the ledger through {period_end:%Y-%m-%d}: {closed} account balances written.'
+        ))
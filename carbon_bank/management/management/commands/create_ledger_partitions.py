@@ -0,0 +1,22 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from management import partitions
+
+
+class Command(BaseCommand):
+    help = 'Create the monthly ledger partitions for the coming months. Run it at least monthly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError('The ledger table is not partitioned (PostgreSQL only).')
+        now = timezone.now()
+        created = partitions.ensure_partitions(now, now + datetime.timedelta(days=31 * options['months_ahead']))
+        for name in created:
+            self.stdout.write(name)
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} partitions created.'))
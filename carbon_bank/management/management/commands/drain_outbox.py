@@ -0,0 +1,61 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+
+from management.outbox import DeliveryError, drain_batch, requeue_parked
+
+
+class Command(BaseCommand):
+    help = ('Deliver outbox events to the sinks in settings.OUTBOX, at least once, in batches. '
+            'Runs until stopped (SIGTERM/SIGINT finish the current batch first); several '
+            'workers can run side by side on PostgreSQL.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX['BATCH_SIZE'])
+        parser.add_argument('--once', action='store_true', help='Exit once no events are pending.')
+        parser.add_argument(
+            '--requeue-parked', action='store_true',
+            help='First put the events parked after OUTBOX["MAX_ATTEMPTS"] failed deliveries back in the queue.',
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        if not options['once']:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, self.stop)
+
+        if options['requeue_parked']:
+            self.stdout.write(f'{requeue_parked()} parked outbox events requeued.')
+
+        delivered = failures = 0
+        while not self.stopping:
+            if not options['once']:
+                # Long running: drop connections that broke or exceeded CONN_MAX_AGE, as requests
+                # do. Not with --once, which may run inside a caller's transaction.
+                close_old_connections()
+            try:
+                count = drain_batch(options['batch_size'])
+            except (DeliveryError, DatabaseError) as exc:
+                # DatabaseError: the batch rolled back, when it outlived OUTBOX['TRANSACTION_TIMEOUT']
+                # for instance, and its events are delivered again.
+                if options['once']:
+                    raise CommandError(f'{exc}, {delivered} events delivered before.')
+                failures += 1
+                delay = min(settings.OUTBOX['POLL_INTERVAL'] * 2 ** failures, settings.OUTBOX['RETRY_MAX_DELAY'])
+                self.stderr.write(f'{exc}, retrying in {delay:.0f}s')
+                time.sleep(delay)
+                continue
+            failures = 0
+            delivered += count
+            if count == 0:
+                if options['once']:
+                    break
+                time.sleep(settings.OUTBOX['POLL_INTERVAL'])
+
+        self.stdout.write(self.style.SUCCESS(f'{delivered} outbox events delivered.'))
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from management.hot_accounts import set_hot_shards
+from management.models import BankAccount
+
+
+class Command(BaseCommand):
+    help = ('Spread the credits to an account over balance shards, so concurrent transfers to it '
+            'do not wait for each other. --shards 0 makes it a regular account again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_number')
+        parser.add_argument('--shards', type=int, default=settings.HOT_ACCOUNT_SHARDS)
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shards'] <= 1024:
+            raise CommandError('--shards must be between 0 and 1024.')
+        try:
+            account = BankAccount.objects.get(account_number=options['account_number'])
+        except BankAccount.DoesNotExist:
+            raise CommandError(f'No account numbered {options["account_number"]}.')
+
+        set_hot_shards(account, options['shards'])
+        if options['shards']:
+            self.stdout.write(self.style.SUCCESS(f'{account.account_number} is credited on {options["shards"]} shards.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{account.account_number} is a regular account.'))
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from management.models import BalanceShard, BankAccount, BankTransaction
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized account balances from the ledger, or verify them with --verify.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Only compare stored balances against the ledger, do not write anything.',
+        )
+        parser.add_argument(
+            '--account', dest='account_numbers', action='append', default=[],
+            help='Restrict to the given account number. Can be passed multiple times.',
+        )
+
+    def handle(self, *args, **options):
+        verify = options['verify']
+        accounts = BankAccount.objects.with_ledger_balance().with_shard_balance().order_by('pk')
+        if options['account_numbers']:
+            accounts = accounts.filter(account_number__in=options['account_numbers'])
+
+        checked = mismatched = 0
+        for candidate in accounts.iterator():
+            checked += 1
+            # Credits of hot accounts wait on balance shards, they count towards the balance.
+            if candidate.total_balance == candidate.ledger_balance:
+                continue
+
+            with transaction.atomic():
+                # The single-pass read above can race with postings, re-check under the row lock.
+                account = BankAccount.objects.select_for_update().get(pk=candidate.pk)
+                shards = BalanceShard.objects.select_for_update().filter(bank_account=account)
+                account.shard_balance = sum(shards.values_list('balance', flat=True))
+                ledger_balance = account.ledger_balance
+                if account.total_balance == ledger_balance:
+                    continue
+
+                mismatched += 1
+                self.stdout.write(
+                    f'{account.account_number}: stored {account.total_balance}, ledger {ledger_balance}'
+                )
+                if verify:
+                    continue
+
+                watermark = BankTransaction.objects.filter(
+                    bank_account=account,
+                ).aggregate(last=Max('id'))['last']
+                account.balance = ledger_balance
+                account.balance_watermark = watermark or 0
+                account.save(update_fields=['balance', 'balance_watermark', 'modified_date'])
+                shards.update(balance=0)
+
+        if verify and mismatched:
+            raise CommandError(f'{mismatched} of {checked} account balances do not match the ledger.')
+
+        if verify:
+            self.stdout.write(self.style.SUCCESS(f'{checked} accounts verified.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{checked} accounts checked, {mismatched} rebuilt.'))
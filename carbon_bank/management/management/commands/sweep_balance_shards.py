@@ -0,0 +1,42 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from management.hot_accounts import sweep_shards
+
+
+class Command(BaseCommand):
+    help = ('Move the balances of hot account shards into their accounts. Runs until stopped '
+            '(SIGTERM/SIGINT finish the current sweep first).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.BALANCE_SHARD_SWEEP_INTERVAL,
+                            help='Seconds between two sweeps.')
+        parser.add_argument('--once', action='store_true', help='Sweep once and exit.')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        if not options['once']:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, self.stop)
+
+        swept = moved = 0
+        while not self.stopping:
+            if not options['once']:
+                # Long running: drop connections that broke or exceeded CONN_MAX_AGE, as requests
+                # do. Not with --once, which may run inside a caller's transaction.
+                close_old_connections()
+            accounts, amount = sweep_shards()
+            swept += accounts
+            moved += amount
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'{moved} moved from the shards of {swept} accounts.'))
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.18 on 2026-10-17 17:57
+
+from django.db import migrations, models
+from django.db.models import Max, Sum
+
+
+def populate_balances(apps, schema_editor):
+    BankAccount = apps.get_model('management', 'BankAccount')
+    BankTransaction = apps.get_model('management', 'BankTransaction')
+
+    for account in BankAccount.objects.all():
+        ledger = BankTransaction.objects.filter(bank_account=account, is_deleted=False)
+        credit = ledger.filter(is_debit=False).aggregate(total=Sum('amount'))['total'] or 0
+        debit = ledger.filter(is_debit=True).aggregate(total=Sum('amount'))['total'] or 0
+        account.balance = credit - debit
+        account.balance_watermark = ledger.aggregate(last=Max('id'))['last'] or 0
+        account.save(update_fields=['balance', 'balance_watermark'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankaccount',
+            name='balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='bankaccount',
+            name='balance_watermark',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
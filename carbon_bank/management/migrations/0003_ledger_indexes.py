@@ -0,0 +1,25 @@
+# Generated by Django 3.2.18 on 2026-10-17 17:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0002_bankaccount_balance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['bank_account', 'is_debit'], include=('amount',), name='ledger_account_balance_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['sender', '-created_date', '-id'], name='ledger_sender_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['receiver', '-created_date', '-id'], name='ledger_receiver_history_idx'),
+        ),
+    ]
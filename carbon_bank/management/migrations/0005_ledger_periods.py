@@ -0,0 +1,66 @@
+# Generated by Django 3.2.18 on 2026-10-17 18:21
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from management import partitions
+
+
+def partition_ledger(apps, schema_editor):
+    # Native range partitioning is PostgreSQL only, other backends keep the plain table.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    BankTransaction = apps.get_model('management', 'BankTransaction')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    first = BankTransaction.objects.aggregate(first=models.Min('created_date'))['first'] or now
+    partitions.partition_table(schema_editor, first, now + datetime.timedelta(days=92))
+
+
+def unpartition_ledger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    partitions.unpartition_table(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0004_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountPeriodBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_end', models.DateTimeField()),
+                ('closing_balance', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('last_transaction_id', models.BigIntegerField(default=0)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='banktransaction',
+            name='ledger_account_balance_idx',
+        ),
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['bank_account', 'is_debit'], include=('amount', 'created_date'), name='ledger_open_balance_idx'),
+        ),
+        migrations.AddField(
+            model_name='accountperiodbalance',
+            name='bank_account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='period_balances', to='management.bankaccount'),
+        ),
+        migrations.AddIndex(
+            model_name='accountperiodbalance',
+            index=models.Index(fields=['period_end'], name='period_balance_end_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='accountperiodbalance',
+            constraint=models.UniqueConstraint(fields=('bank_account', 'period_end'), name='period_balance_account_end_unique'),
+        ),
+        migrations.RunPython(partition_ledger, unpartition_ledger),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.18 on 2026-10-17 21:05
+
+from django.db import migrations
+
+from management import account_numbers
+
+
+def create_sequence(apps, schema_editor):
+    # Other backends number accounts from the highest existing number, see management/account_numbers.py.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'CREATE SEQUENCE {account_numbers.SEQUENCE} INCREMENT BY {account_numbers.BLOCK_SIZE} START WITH 1'
+    )
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP SEQUENCE {account_numbers.SEQUENCE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0005_ledger_periods'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
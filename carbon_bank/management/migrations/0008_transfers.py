@@ -0,0 +1,55 @@
+# Generated by Django 3.2.18 on 2026-10-17 18:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0007_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Transfer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('guid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='receiver_account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='incoming_transfers', to='management.bankaccount'),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='sender_account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_transfers', to='management.bankaccount'),
+        ),
+        migrations.AddField(
+            model_name='banktransaction',
+            name='transfer',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='legs', to='management.transfer'),
+        ),
+        migrations.RemoveIndex(
+            model_name='banktransaction',
+            name='ledger_sender_history_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='banktransaction',
+            name='ledger_receiver_history_idx',
+        ),
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['bank_account', '-created_date', '-id'], name='ledger_account_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='banktransaction',
+            index=models.Index(condition=models.Q(('transfer__isnull', False)), fields=['transfer'], name='ledger_transfer_idx'),
+        ),
+    ]
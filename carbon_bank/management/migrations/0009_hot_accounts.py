@@ -0,0 +1,33 @@
+# Generated by Django 3.2.18 on 2026-10-17 18:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0008_transfers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankaccount',
+            name='hot_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('balance_watermark', models.BigIntegerField(default=0)),
+                ('bank_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shards', to='management.bankaccount')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='balanceshard',
+            constraint=models.UniqueConstraint(fields=('bank_account', 'shard'), name='balance_shard_account_unique'),
+        ),
+    ]
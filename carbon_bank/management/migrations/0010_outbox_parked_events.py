@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-17 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0009_hot_accounts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='parked_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,8 +1,77 @@
-import random
+import datetime
 import uuid
-from django.db import models
-from django.db.models import Sum
+from decimal import Decimal
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from cores.models import CustomBaseClass
+from management.account_numbers import allocate_account_numbers
+from management.balance_cache import get_balance_cache, invalidate_balances
+
+CENTS = Decimal('0.01')
+# Start of the open period of an account that was never closed.
+LEDGER_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def signed_amount_sum(prefix=''):
+    """
+        SUM(CASE WHEN is_debit THEN -amount ELSE amount END) over live ledger rows,
+        optionally through a relation prefix such as ``'mutations__'``.
+    """
+    output_field = DecimalField(max_digits=14, decimal_places=2)
+    return Coalesce(
+        Sum(
+            Case(
+                When(**{f'{prefix}is_debit': True}, then=-F(f'{prefix}amount')),
+                default=F(f'{prefix}amount'),
+                output_field=output_field,
+            ),
+            filter=Q(**{f'{prefix}is_deleted': False}),
+        ),
+        Value(0),
+        output_field=output_field,
+    )
+
+
+def ledger_balance_expression():
+    """
+        Balance of the outer BankAccount from the ledger: its latest period closing balance
+        plus the live rows posted since, so closed (and archived) periods are never read.
+    """
+    output_field = DecimalField(max_digits=14, decimal_places=2)
+    closings = AccountPeriodBalance.objects.order_by('-period_end')
+    open_since = Coalesce(
+        Subquery(closings.filter(bank_account=OuterRef(OuterRef('pk'))).values('period_end')[:1]),
+        Value(LEDGER_EPOCH),
+    )
+    open_period = BankTransaction.objects.filter(
+        bank_account=OuterRef('pk'),
+        is_deleted=False,
+        created_date__gte=open_since,
+    ).order_by().values('bank_account').annotate(total=signed_amount_sum()).values('total')
+    return (
+        Coalesce(Subquery(closings.filter(bank_account=OuterRef('pk')).values('closing_balance')[:1]),
+                 Value(0), output_field=output_field)
+        + Coalesce(Subquery(open_period), Value(0), output_field=output_field)
+    )
+
+
+class BankAccountQuerySet(models.QuerySet):
+
+    def with_owner(self):
+        return self.select_related('owner__user')
+
+    def with_ledger_balance(self):
+        return self.annotate(computed_balance=ledger_balance_expression())
+
+    def with_shard_balance(self):
+        """Annotate the credits waiting on balance shards, so ``total_balance`` needs no query."""
+        output_field = DecimalField(max_digits=14, decimal_places=2)
+        shards = BalanceShard.objects.filter(bank_account=OuterRef('pk')).order_by().values('bank_account')
+        return self.annotate(shard_balance=Coalesce(
+            Subquery(shards.annotate(total=Sum('balance')).values('total')), Value(0), output_field=output_field,
+        ))
 
 
 class BankAccount(CustomBaseClass):
@@ -10,36 +79,210 @@ class BankAccount(CustomBaseClass):
     account_number = models.CharField(max_length=15, unique=True)
     owner = models.OneToOneField('customers.Customer', on_delete=models.CASCADE)
     is_active = models.BooleanField(default=False)
+    # Running balance maintained in the same transaction that writes ledger rows,
+    # so reads never have to aggregate the whole account history.
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Highest BankTransaction id already folded into ``balance``.
+    balance_watermark = models.BigIntegerField(default=0)
+    # Hot accounts (see management/hot_accounts.py) take credits on this many BalanceShard
+    # rows instead of ``balance``, 0 for regular accounts.
+    hot_shards = models.PositiveSmallIntegerField(default=0)
+
+    # Moved by postings, the shard sweeper, hot_accounts and rebuild_balances only, through
+    # update() or explicit update_fields. A plain save() of an instance loaded before a
+    # posting would write their old values back, so it leaves them out.
+    LEDGER_FIELDS = ('balance', 'balance_watermark', 'hot_shards')
+
+    objects = BankAccountQuerySet.as_manager()
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred and field.name not in self.LEDGER_FIELDS
+            ]
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        get_balance_cache().remember_owner(self.owner_id, self.pk)
+        invalidate_balances([self.pk])
 
     @property
     def total_balance(self):
-        aggregate_credit = BankTransaction.objects.filter(
-            bank_account__pk=self.pk,
-            is_debit=False,
-        ).aggregate(total=Sum('amount'))
+        if hasattr(self, 'shard_balance'):
+            return self.balance + self.shard_balance
+        if not self.hot_shards:
+            return self.balance
+        return self.balance + (self.balance_shards.aggregate(total=Sum('balance'))['total'] or 0)
 
-        aggregate_debit = BankTransaction.objects.filter(
+    @property
+    def ledger_balance(self):
+        if hasattr(self, 'computed_balance'):
+            total = self.computed_balance
+        else:
+            opening = self.period_balances.order_by('-period_end').first()
+            total = BankTransaction.objects.filter(
+                bank_account__pk=self.pk,
+                is_deleted=False,
+                created_date__gte=opening.period_end if opening else LEDGER_EPOCH,
+            ).aggregate(total=signed_amount_sum())['total']
+            if opening:
+                total += opening.closing_balance
+        # Backends without a native decimal type (SQLite) sum in floating point.
+        return Decimal(total).quantize(CENTS)
+
+    def balance_at(self, moment):
+        """
+            Ledger balance just before ``moment``: the closing balance before it plus the rows
+            since, read from the database this account was loaded from.
+        """
+        # Not self.period_balances: related managers ask the router, which no longer pins a
+        # statement streamed after the response left the view to its replica.
+        opening = AccountPeriodBalance.objects.using(self._state.db).filter(
+            bank_account_id=self.pk, period_end__lte=moment,
+        ).order_by('-period_end').first()
+        total = BankTransaction.objects.using(self._state.db).filter(
             bank_account__pk=self.pk,
-            is_debit=True,
-        ).aggregate(total=Sum('amount'))
+            is_deleted=False,
+            created_date__gte=opening.period_end if opening else LEDGER_EPOCH,
+            created_date__lt=moment,
+        ).aggregate(total=signed_amount_sum())['total']
+        if opening:
+            total += opening.closing_balance
+        return Decimal(total).quantize(CENTS)
 
-        credit = aggregate_credit.get('total')
-        credit = credit if credit is not None else 0
+    @classmethod
+    def apply_transactions(cls, transactions):
+        """
+            Fold freshly inserted ledger rows into the running balance of their accounts.
+            Must run inside the transaction that inserted the rows. Credits to hot accounts
+            go to one of their balance shards and leave the account row alone.
+        """
+        from management.hot_accounts import credit_shards, hot_shard_counts
 
-        debit = aggregate_debit.get('total')
-        debit = debit if debit is not None else 0
+        hot = hot_shard_counts(tran for tran in transactions if not tran.is_debit)
+        deltas = {}
+        watermarks = {}
+        shard_credits = []
+        for tran in transactions:
+            account_id = tran.bank_account_id
+            if not tran.is_debit and hot.get(account_id):
+                shard_credits.append(tran)
+                continue
+            deltas[account_id] = deltas.get(account_id, 0) + tran.signed_amount
+            if tran.pk is not None:
+                watermarks[account_id] = max(watermarks.get(account_id, 0), tran.pk)
 
-        return credit - debit
+        for account_id in sorted(deltas):
+            values = {'balance': F('balance') + deltas[account_id]}
+            if account_id in watermarks:
+                values['balance_watermark'] = Greatest(F('balance_watermark'), watermarks[account_id])
+            cls.objects.filter(pk=account_id).update(**values)
+        credit_shards(shard_credits, hot)
+        invalidate_balances(sorted(set(deltas) | {tran.bank_account_id for tran in shard_credits}))
 
     @classmethod
     def generate_account_number(cls):
-        return ''.join(random.choice('0123456789ABCDEFGHIKLMNOPRS') for _ in range(13))
+        return allocate_account_numbers(1)[0]
+
+    @classmethod
+    def generate_account_numbers(cls, count):
+        return allocate_account_numbers(count)
 
     def __str__(self):
         return f'Account number: {self.account_number}     Balance: {self.total_balance}      Owner: {self.owner.fullname}' \
                f'Guid: {self.owner.guid}'
 
 
+class BalanceShard(models.Model):
+    """
+        Part of the balance of a hot account: credits are added here, spread over the
+        account's shards, so they do not all wait for the lock of the account row. The
+        sweeper moves shard balances into ``BankAccount.balance``.
+    """
+    bank_account = models.ForeignKey(BankAccount, related_name='balance_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Highest BankTransaction id already folded into ``balance``.
+    balance_watermark = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bank_account', 'shard'], name='balance_shard_account_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.bank_account_id}/{self.shard}: {self.balance}'
+
+
+class TransferManager(models.Manager):
+
+    def post(self, transfers):
+        """
+            Record ``transfers``, unsaved Transfer instances, and their debit and credit legs:
+            the transfers in one insert, all legs in another. The legs are available as
+            ``transfer.debit`` and ``transfer.credit`` afterwards.
+        """
+        with transaction.atomic():
+            self.bulk_create(transfers)
+            if transfers and transfers[0].pk is None:
+                # Backends that do not return ids from bulk inserts (SQLite).
+                ids = dict(self.filter(guid__in=[transfer.guid for transfer in transfers]).values_list('guid', 'pk'))
+                for transfer in transfers:
+                    transfer.pk = ids[transfer.guid]
+            legs = []
+            for transfer in transfers:
+                transfer.debit, transfer.credit = transfer.build_legs()
+                legs += [transfer.debit, transfer.credit]
+            BankTransaction.objects.post(legs)
+        return transfers
+
+
+class Transfer(models.Model):
+    """
+        Journal entry of a transfer between two accounts, grouping its debit leg on the
+        sender's account and its credit leg on the receiver's (``legs``).
+    """
+    guid = models.UUIDField(unique=True, editable=False, default=uuid.uuid4)
+    sender_account = models.ForeignKey(BankAccount, related_name='outgoing_transfers', on_delete=models.CASCADE)
+    receiver_account = models.ForeignKey(BankAccount, related_name='incoming_transfers', on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    objects = TransferManager()
+
+    def build_legs(self):
+        """The unsaved debit and credit ledger rows of this transfer."""
+        common = {
+            'transfer': self,
+            'sender_id': self.sender_account.owner_id,
+            'receiver_id': self.receiver_account.owner_id,
+            'amount': self.amount,
+        }
+        return (
+            BankTransaction(bank_account=self.sender_account, is_debit=True,
+                            description='Amount transferred', **common),
+            BankTransaction(bank_account=self.receiver_account, is_debit=False,
+                            description='Amount received', **common),
+        )
+
+    def __str__(self):
+        return f'{self.sender_account_id} -> {self.receiver_account_id}: {self.amount}'
+
+
+class BankTransactionManager(models.Manager):
+
+    def post(self, transactions):
+        """
+            Insert ledger rows in one round trip and fold them into the account balances,
+            all within one database transaction.
+        """
+        with transaction.atomic():
+            created = self.bulk_create(transactions)
+            BankAccount.apply_transactions(created)
+            OutboxEvent.objects.record_postings(created)
+        return created
+
+
 class BankTransaction(CustomBaseClass):
     bank_account = models.ForeignKey(
         BankAccount,
@@ -59,8 +302,150 @@ class BankTransaction(CustomBaseClass):
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     is_debit = models.BooleanField(default=False)
     description = models.TextField()
+    # Both legs of a transfer point to it, deposits and withdrawals have none.
+    transfer = models.ForeignKey(
+        Transfer,
+        related_name='legs',
+        null=True,
+        blank=True,
+        db_index=False,
+        on_delete=models.CASCADE,
+    )
+
+    objects = BankTransactionManager()
+
+    class Meta:
+        indexes = [
+            # Balance aggregation: index-only scan of (account, is_debit, amount), with
+            # created_date to skip rows of closed periods without visiting the heap.
+            models.Index(
+                fields=['bank_account', 'is_debit'],
+                include=['amount', 'created_date'],
+                condition=Q(is_deleted=False),
+                name='ledger_open_balance_idx',
+            ),
+            # History: the rows of one account (one leg per transfer), newest first.
+            models.Index(
+                fields=['bank_account', '-created_date', '-id'],
+                condition=Q(is_deleted=False),
+                name='ledger_account_history_idx',
+            ),
+            models.Index(
+                fields=['transfer'],
+                condition=Q(transfer__isnull=False),
+                name='ledger_transfer_idx',
+            ),
+        ]
+
+    @property
+    def signed_amount(self):
+        return -self.amount if self.is_debit else self.amount
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Ledger rows are append-only: every insert moves the account balance and
+        # records its outbox event within the same database transaction.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            BankAccount.apply_transactions([self])
+            OutboxEvent.objects.record_postings([self])
 
     def __str__(self):
         return (f'Owner: {self.bank_account.owner.user.get_full_name()} '
                 f'{"Debit: " if self.is_debit else "Credit: "} {self.amount}'
                 f' MODIFIED DATE: {self.modified_date}')
+
+
+class AccountPeriodBalance(models.Model):
+    """
+        Balance of an account at the end of a closed ledger period, written by
+        ``close_ledger_period`` for every account with rows in that period. Ledger rows
+        before ``period_end`` are final and may be archived.
+    """
+    bank_account = models.ForeignKey(BankAccount, related_name='period_balances', on_delete=models.CASCADE)
+    period_end = models.DateTimeField()
+    closing_balance = models.DecimalField(max_digits=14, decimal_places=2)
+    # Highest BankTransaction id included in ``closing_balance``.
+    last_transaction_id = models.BigIntegerField(default=0)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bank_account', 'period_end'], name='period_balance_account_end_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['period_end'], name='period_balance_end_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.bank_account_id} @ {self.period_end}: {self.closing_balance}'
+
+
+class IdempotencyKey(models.Model):
+    """
+        Response of a money movement request, stored under the client's Idempotency-Key so a
+        retried request can be answered without touching the ledger again.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    endpoint = models.CharField(max_length=100)
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField()
+    response_body = models.JSONField(null=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_user_key_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.key} {self.endpoint} -> {self.response_status}'
+
+
+class OutboxEventManager(models.Manager):
+
+    def record_postings(self, transactions):
+        """A ``transaction.posted`` event per ledger row, in the transaction inserting them."""
+        self.bulk_create(
+            OutboxEvent(topic=OutboxEvent.TRANSACTION_POSTED, payload={
+                # None on backends that do not return ids from bulk inserts (SQLite).
+                'transaction_id': tran.pk,
+                'transfer_id': tran.transfer_id,
+                'account_id': tran.bank_account_id,
+                'sender_id': tran.sender_id,
+                'receiver_id': tran.receiver_id,
+                'amount': str(Decimal(tran.amount).quantize(CENTS)),
+                'is_debit': tran.is_debit,
+                'description': tran.description,
+                'created_date': tran.created_date.isoformat(),
+            })
+            for tran in transactions
+        )
+
+
+class OutboxEvent(models.Model):
+    """
+        Event written in the same database transaction as the change it describes, so it
+        exists exactly when the change committed. ``drain_outbox`` delivers it to the sinks
+        in settings.OUTBOX and deletes it, or parks it after OUTBOX['MAX_ATTEMPTS'] failed
+        deliveries, see management/outbox.py.
+    """
+    TRANSACTION_POSTED = 'transaction.posted'
+
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created_date = models.DateTimeField(auto_now_add=True)
+    # Failed deliveries so far, and the last error.
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    # Set when the event was parked: drain_outbox skips it until ``--requeue-parked``.
+    parked_date = models.DateTimeField(null=True, blank=True)
+
+    objects = OutboxEventManager()
+
+    def __str__(self):
+        return f'{self.pk} {self.topic}'
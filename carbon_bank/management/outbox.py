@@ -0,0 +1,187 @@
+"""
+Delivery of outbox events to the sinks configured in settings.OUTBOX.
+
+Events are written by the request in the transaction that posts the ledger rows, which only
+costs an insert; the work reacting to them (notifications, analytics, fraud checks) runs in
+``drain_outbox`` workers instead, outside the request and its row locks.
+
+A worker claims the oldest events in batches (``SELECT ... FOR UPDATE SKIP LOCKED`` on
+PostgreSQL, so several workers share the load), hands the batch to every sink and deletes
+it in the same transaction. Delivery is at least once: a sink that fails, or a worker that
+dies before committing, makes the whole batch be delivered again, to every sink. Consumers
+deduplicate on the event ``id``.
+
+Events that failed before are retried one at a time, and an event that failed
+OUTBOX['MAX_ATTEMPTS'] times is parked: it stays in the table, skipped, so that it does not
+hold back the events behind it, until ``drain_outbox --requeue-parked``. The batch rows stay
+locked while the sinks run, so the transaction is bounded by OUTBOX['TRANSACTION_TIMEOUT'] and
+sink timeouts have to stay well below it.
+"""
+import json
+import os
+import queue
+import threading
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from management.models import OutboxEvent
+
+
+def serialize_event(event):
+    return {
+        'id': event.pk,
+        'topic': event.topic,
+        'created_date': event.created_date.isoformat(),
+        'payload': event.payload,
+    }
+
+
+class BaseSink:
+    """Receives every batch of events. Raising makes the batch be delivered again later."""
+    name = 'base'
+
+    def send(self, events):
+        raise NotImplementedError
+
+
+class FileSink(BaseSink):
+    """Appends one JSON line per event and syncs the file before the batch counts as delivered."""
+    name = 'file'
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, 'a', encoding='utf-8') as output:
+            output.writelines(json.dumps(serialize_event(event)) + '\n' for event in events)
+            output.flush()
+            os.fsync(output.fileno())
+
+
+class QueueSink(BaseSink):
+    """Puts events on ``self.queue``, for consumers in the worker process."""
+    name = 'queue'
+
+    def __init__(self, max_size=0, timeout=5.0):
+        self.queue = queue.Queue(max_size)
+        self.timeout = timeout
+
+    def send(self, events):
+        for event in events:
+            self.queue.put(serialize_event(event), timeout=self.timeout)
+
+
+class WebhookSink(BaseSink):
+    """POSTs each batch as ``{"events": [...]}``, any non-2xx answer counts as a failure."""
+    name = 'webhook'
+
+    def __init__(self, url, timeout=5.0, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+
+    def send(self, events):
+        response = self.session.post(
+            self.url, json={'events': [serialize_event(event) for event in events]}, timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                _sinks = [
+                    import_string(config['BACKEND'])(
+                        **{key.lower(): value for key, value in config.get('OPTIONS', {}).items()}
+                    )
+                    for config in settings.OUTBOX['SINKS']
+                ]
+    return _sinks
+
+
+@receiver(setting_changed)
+def _reset_sinks(setting, **kwargs):
+    global _sinks
+    if setting == 'OUTBOX':
+        _sinks = None
+
+
+class DeliveryError(Exception):
+    pass
+
+
+def set_transaction_timeout(seconds):
+    """Bound the statements, lock waits and idle time of the current transaction (PostgreSQL)."""
+    if connection.vendor != 'postgresql':
+        return
+    milliseconds = str(int(seconds * 1000))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT set_config('statement_timeout', %s, true), set_config('lock_timeout', %s, true), "
+            "set_config('idle_in_transaction_session_timeout', %s, true)",
+            [milliseconds] * 3,
+        )
+
+
+def drain_batch(batch_size=None, sinks=None):
+    """
+        Deliver the oldest pending events, at most ``batch_size``. Returns the number
+        delivered. A failing sink raises DeliveryError after the failure was recorded on the
+        events, which stay pending, or are parked once they failed OUTBOX['MAX_ATTEMPTS'] times.
+    """
+    batch_size = batch_size or settings.OUTBOX['BATCH_SIZE']
+    sinks = get_sinks() if sinks is None else sinks
+    failure = None
+    parked = False
+    with transaction.atomic():
+        set_transaction_timeout(settings.OUTBOX['TRANSACTION_TIMEOUT'])
+        pending = OutboxEvent.objects.filter(parked_date__isnull=True).order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        events = list(pending[:batch_size])
+        if not events:
+            return 0
+        retried = next((index for index, event in enumerate(events) if event.attempts), None)
+        if retried is not None:
+            # Events that failed before go alone: one that keeps failing is parked on its own
+            # attempts, not on those of the fresh events it was batched with.
+            events = events[:retried] or events[retried:retried + 1]
+        delivered = OutboxEvent.objects.filter(pk__in=[event.pk for event in events])
+        try:
+            for sink in sinks:
+                sink.send(events)
+        except Exception as exc:
+            failure = exc
+            parked = len(events) == 1 and events[0].attempts + 1 >= settings.OUTBOX['MAX_ATTEMPTS']
+            delivered.update(
+                attempts=F('attempts') + 1,
+                last_error=f'{sink.name}: {type(exc).__name__}: {exc}',
+                parked_date=timezone.now() if parked else None,
+            )
+        else:
+            delivered.delete()
+    if failure is not None:
+        message = f'{sink.name} sink failed: {failure}'
+        if parked:
+            message += f', event {events[0].pk} parked after {settings.OUTBOX["MAX_ATTEMPTS"]} attempts'
+        raise DeliveryError(message) from failure
+    return len(events)
+
+
+def requeue_parked():
+    """Put the parked events back in the queue with a fresh attempt count, returns how many."""
+    return OutboxEvent.objects.filter(parked_date__isnull=False).update(parked_date=None, attempts=0)
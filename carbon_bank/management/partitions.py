@@ -0,0 +1,178 @@
+"""
+Monthly range partitions of the ledger table (PostgreSQL only).
+
+The table is partitioned on ``created_date`` with one partition per calendar month (UTC),
+named ``<table>_pYYYYMM``, plus a default partition that catches rows outside every range.
+``ensure_partitions`` creates missing months, moving rows out of the default partition
+first, so it can run at any time; run it ahead of each month (``create_ledger_partitions``).
+"""
+import datetime
+import re
+from dataclasses import dataclass
+
+from django.db import connection as default_connection, transaction
+
+TABLE = 'management_banktransaction'
+DEFAULT_PARTITION = f'{TABLE}_default'
+_BOUND = re.compile(r"FROM \('(?P<lower>[^']+)'\) TO \('(?P<upper>[^']+)'\)")
+_SHORT_OFFSET = re.compile(r'([+-]\d\d)$')
+
+
+@dataclass
+class Partition:
+    name: str
+    lower: datetime.datetime
+    upper: datetime.datetime
+
+
+def month_start(moment):
+    moment = moment.astimezone(datetime.timezone.utc)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+def is_partitioned(connection=default_connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(connection=default_connection):
+    """Monthly partitions, oldest first. The default partition is not included."""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+        """, [TABLE])
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND.search(bound)
+        if match is None:
+            continue
+        partitions.append(Partition(name, _parse_bound(match['lower']), _parse_bound(match['upper'])))
+    return sorted(partitions, key=lambda partition: partition.lower)
+
+
+def _parse_bound(value):
+    # Postgres prints offsets as '+00', older Pythons only parse '+00:00'.
+    moment = datetime.datetime.fromisoformat(_SHORT_OFFSET.sub(r'\1:00', value))
+    return moment.astimezone(datetime.timezone.utc)
+
+
+def _literal(moment):
+    return f"'{moment.isoformat()}'"
+
+
+def create_partition(cursor, month):
+    """Create the partition of ``month``, taking over its rows from the default partition."""
+    name, upper = partition_name(month), next_month(month)
+    cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_date >= %s AND created_date < %s '
+        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved',
+        [month, upper],
+    )
+    # Attaching builds the partition's copies of the parent's indexes.
+    cursor.execute(
+        f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ({_literal(month)}) TO ({_literal(upper)})'
+    )
+
+
+def oldest_default_row(before, connection=default_connection):
+    """``created_date`` of the oldest row before ``before`` left in the default partition, or None."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT min(created_date) FROM {DEFAULT_PARTITION} WHERE created_date < %s', [before])
+        return cursor.fetchone()[0]
+
+
+def ensure_partitions(start, end, connection=default_connection):
+    """Create every missing monthly partition from ``start`` through ``end``. Returns the new names."""
+    existing = {partition.lower for partition in list_partitions(connection)}
+    created = []
+    month = month_start(start)
+    while month <= end:
+        if month not in existing:
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                create_partition(cursor, month)
+            created.append(partition_name(month))
+        month = next_month(month)
+    return created
+
+
+def partition_table(schema_editor, start, end):
+    """
+        Rebuild the plain ledger table as a partitioned one with monthly partitions from
+        ``start`` through ``end``. Columns, defaults, the id sequence, foreign keys and indexes
+        are carried over; the primary key becomes (id, created_date) as partitioning requires.
+    """
+    _rebuild(schema_editor, 'PARTITION BY RANGE (created_date)', 'PRIMARY KEY (id, created_date)')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+        month = month_start(start)
+        while month <= end:
+            create_partition(cursor, month)
+            month = next_month(month)
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_unpartitioned')
+        _drop_old(cursor)
+
+
+def unpartition_table(schema_editor):
+    _rebuild(schema_editor, '', 'PRIMARY KEY (id)')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_unpartitioned')
+        _drop_old(cursor)
+
+
+def _rebuild(schema_editor, partition_clause, primary_key):
+    old = f'{TABLE}_unpartitioned'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = %s AND indexname NOT IN (
+                SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p'
+            )
+        """, [TABLE, TABLE])
+        indexes = cursor.fetchall()
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = to_regclass(%s) AND contype = 'f'
+        """, [TABLE])
+        foreign_keys = cursor.fetchall()
+
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {old}')
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX {name} RENAME TO {name}_old')
+        for name, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE {old} RENAME CONSTRAINT {name} TO {name}_old')
+        cursor.execute(f"SELECT pg_get_serial_sequence('{old}', 'id')")
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f'ALTER TABLE {old} DROP CONSTRAINT {TABLE}_pkey')
+
+        cursor.execute(
+            f'CREATE TABLE {TABLE} (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+            f'CONSTRAINT {TABLE}_pkey {primary_key}) {partition_clause}'
+        )
+        # The sequence would be dropped together with the old table otherwise.
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id')
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+        for _, definition in indexes:
+            cursor.execute(definition.replace(f' ON ONLY public.{TABLE} ', f' ON public.{TABLE} '))
+
+
+def _drop_old(cursor):
+    cursor.execute(f'DROP TABLE {TABLE}_unpartitioned')
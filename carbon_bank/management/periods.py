@@ -0,0 +1,164 @@
+"""
+Closing ledger periods and archiving the rows of closed ones.
+
+Closing a period writes one ``AccountPeriodBalance`` per account with ledger rows since the
+previous close. Balances are then computed from the latest closing balance plus the rows
+after it (``ledger_balance_expression``), so rows of closed periods are never read again and
+can be moved out of the database by ``archive_closed_rows``.
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from management import partitions
+from management.models import AccountPeriodBalance, BankAccount, BankTransaction, signed_amount_sum
+
+
+class PeriodError(Exception):
+    pass
+
+
+def parse_boundary(value):
+    """``YYYY-MM-DD`` as midnight UTC, the way period and partition boundaries are stored."""
+    try:
+        day = datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a YYYY-MM-DD date.')
+    return datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc)
+
+
+def closed_through():
+    """End of the latest closed period, ``None`` if no period was closed yet."""
+    return AccountPeriodBalance.objects.aggregate(end=Max('period_end'))['end']
+
+
+def close_period(period_end, batch_size=5000):
+    """Write the closing balances at ``period_end``. Returns the number of accounts closed."""
+    previous_end = closed_through()
+    if previous_end is not None and period_end <= previous_end:
+        raise PeriodError(f'Periods are already closed through {previous_end:%Y-%m-%d %H:%M}.')
+    # Rows are stamped when inserted but only visible once committed: leave in-flight
+    # transactions time to commit before their period is summarized.
+    latest_allowed = timezone.now() - settings.LEDGER_CLOSE_GRACE
+    if period_end > latest_allowed:
+        raise PeriodError(f'A period can only be closed once it ended {settings.LEDGER_CLOSE_GRACE} ago.')
+
+    rows = BankTransaction.objects.filter(is_deleted=False, created_date__lt=period_end)
+    if previous_end is not None:
+        rows = rows.filter(created_date__gte=previous_end)
+    totals = rows.order_by('bank_account').values('bank_account').annotate(
+        total=signed_amount_sum(),
+        last_id=Max('id'),
+    )
+
+    closed = 0
+    with transaction.atomic():
+        batch = []
+        for row in totals.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                closed += _write_closings(batch, period_end)
+                batch = []
+        closed += _write_closings(batch, period_end)
+    return closed
+
+
+def _write_closings(totals, period_end):
+    if not totals:
+        return 0
+    previous = dict(BankAccount.objects.filter(
+        pk__in=[row['bank_account'] for row in totals],
+    ).annotate(previous=Subquery(
+        AccountPeriodBalance.objects.filter(
+            bank_account=OuterRef('pk'),
+        ).order_by('-period_end').values('closing_balance')[:1],
+    )).values_list('pk', 'previous'))
+    AccountPeriodBalance.objects.bulk_create(
+        AccountPeriodBalance(
+            bank_account_id=row['bank_account'],
+            period_end=period_end,
+            closing_balance=(previous.get(row['bank_account']) or 0) + row['total'],
+            last_transaction_id=row['last_id'],
+        )
+        for row in totals
+    )
+    return len(totals)
+
+
+def archive_closed_rows(before, directory, batch_size=10000):
+    """
+        Export the ledger rows created before ``before`` to gzipped CSV files in ``directory``
+        and remove them from the database. Returns the written paths.
+
+        On a partitioned table whole monthly partitions are copied out and dropped; only
+        partitions ending by ``before`` are archived, after the rows of older months still in
+        the default partition got their own. Otherwise the rows are exported and deleted in
+        batches.
+    """
+    end = closed_through()
+    if end is None or before > end:
+        raise PeriodError('Only closed periods can be archived, close them with close_ledger_period first.')
+    os.makedirs(directory, exist_ok=True)
+
+    if partitions.is_partitioned():
+        # Rows of months that had no partition yet sit in the default partition: give those
+        # months their partitions first, so that the rows are archived with them.
+        oldest = partitions.oldest_default_row(before)
+        if oldest is not None:
+            partitions.ensure_partitions(oldest, before)
+        return [
+            _archive_partition(partition, directory)
+            for partition in partitions.list_partitions()
+            if partition.upper <= before
+        ]
+
+    rows = BankTransaction.objects.filter(created_date__lt=before)
+    if not rows.exists():
+        return []
+    path = os.path.join(directory, f'{partitions.TABLE}_before_{before:%Y%m%d}.csv.gz')
+    fields = BankTransaction._meta.concrete_fields
+    with _archive_file(path) as archive:
+        writer = csv.writer(archive)
+        writer.writerow([field.column for field in fields])
+        values = rows.order_by('pk').values_list(*[field.attname for field in fields])
+        writer.writerows(values.iterator(chunk_size=batch_size))
+
+    while True:
+        ids = list(rows.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        BankTransaction.objects.filter(pk__in=ids).delete()
+    return [path]
+
+
+def _archive_partition(partition, directory):
+    path = os.path.join(directory, f'{partition.name}.csv.gz')
+    with _archive_file(path) as archive, connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {partition.name} TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {partitions.TABLE} DETACH PARTITION {partition.name}')
+        cursor.execute(f'DROP TABLE {partition.name}')
+    return path
+
+
+@contextmanager
+def _archive_file(path):
+    """Gzipped text file that only appears under its name once completely written."""
+    if os.path.exists(path):
+        raise PeriodError(f'{path} already exists.')
+    partial = f'{path}.partial'
+    try:
+        with gzip.open(partial, 'wt', encoding='utf-8', newline='') as archive:
+            yield archive
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
@@ -1,11 +1,51 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.http import StreamingHttpResponse
+from django.test import AsyncRequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
 from rest_framework.reverse import reverse
-from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate
+from rest_framework.test import APIClient, APITestCase, APIRequestFactory, force_authenticate
 
+from cores.asgi import ASGIHandler
+from cores.permissions import IsCustomer
+from cores.principal import get_principal
+from cores.async_views import async_api_view, shutdown_db_executor
 from customers.models import Customer
-from .api.serializers import AccountActivateSerializer
-from .models import BankAccount, BankTransaction
+from .api.pagination import LedgerCursorPagination
+from .api.statements import CSVStatementRenderer, statement_rows
+from .api.serializers import AccountActivateSerializer, TransferTransactionSerializer, WithdrawSerializer
+from .api.views import AccountListAPIView, ActivateAccountView, CreateTransfer
+from .balance_cache import LocalBalanceCache, SharedBalanceCache, get_balance_cache
+from .group_commit import Deposit, get_deposit_batcher
+from .hot_accounts import set_hot_shards
+from . import fast_path, group_commit, partitions
+from .account_numbers import (BLOCK_SIZE, AccountNumberAllocator, check_digit, format_account_number,
+                              is_valid_account_number)
+from .locking import DEADLOCK_DETECTED, lock_stats, retry_on_conflict
+from .models import BankAccount, BankTransaction, IdempotencyKey, OutboxEvent, Transfer
+from .outbox import BaseSink, DeliveryError, QueueSink, drain_batch
+from .periods import PeriodError, archive_closed_rows, close_period
 
 
 class BankAccountViewSetAPITest(APITestCase):
@@ -84,6 +124,22 @@ class BankAccountViewSetAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data["is_active"], False)
 
+    def test_saving_a_stale_account_keeps_its_balance(self):
+        self.create_and_authenticate_su()
+        self.create_customer('selcuk1@gmail.com', '123456')
+        stale = BankAccount.objects.get()
+        self.create_deposit(BankAccount.objects.get(), 100)
+        BankAccount.objects.update(hot_shards=2)
+
+        # The view loaded the account before the deposit committed.
+        with mock.patch.object(ActivateAccountView, 'get_object', return_value=stale):
+            response = self.client.put(reverse('management:activate-account', args=[stale.guid]), {'is_active': True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        account = BankAccount.objects.get()
+        self.assertTrue(account.is_active)
+        self.assertEqual((account.balance, account.hot_shards), (100, 2))
+        self.assertEqual(account.balance, account.ledger_balance)
+
     def test_deposit_account(self):
         self.create_customer('selcuk@gmail.com', '123456')
         customer = Customer.objects.get(user__username='selcuk@gmail.com')
@@ -186,6 +242,33 @@ class BankAccountViewSetAPITest(APITestCase):
         self.assertEqual(bank_customer1.total_balance, 100000)
         self.assertEqual(bank_customer2.total_balance, 30000)
 
+    def test_transfer_legs_are_linked_and_listed_once(self):
+        self.create_and_authenticate_su()
+        for email, identity_id in (('selcuk1@gmail.com', '12345'), ('selcuk2@gmail.com', '54321')):
+            self.create_customer(email, identity_id)
+        customer1, customer2 = Customer.objects.order_by('pk')
+        BankAccount.objects.update(is_active=True)
+        self.create_deposit(customer1.bankaccount, 500)
+
+        response = self.client.post(reverse('management:transfer'), {
+            'sender': customer1.pk,
+            'destination_account_number': customer2.bankaccount.account_number,
+            'amount': 200,
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        transfer = Transfer.objects.get()
+        self.assertEqual(response.data['transfer'], transfer.pk)
+        self.assertTrue(response.data['is_debit'])
+        self.assertEqual(
+            sorted(transfer.legs.values_list('bank_account', 'is_debit')),
+            sorted([(customer1.bankaccount.pk, True), (customer2.bankaccount.pk, False)]),
+        )
+
+        for customer, expected in ((customer1, [('200.00', True), ('500.00', False)]),
+                                   (customer2, [('200.00', False)])):
+            response = self.client.get(reverse('management:transaction-list', args=[customer.pk]))
+            self.assertEqual([(row['amount'], row['is_debit']) for row in response.data['results']], expected)
+
     def test_bank_transfer_with_amount_exceeded(self):
         self.create_customer('selcuk1@gmail.com', '12345')
         customer1 = Customer.objects.get(user__email='selcuk1@gmail.com')
@@ -285,3 +368,857 @@ class BankAccountViewSetAPITest(APITestCase):
         response = self.client.post(url, data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(str(response.data['destination_account_number']), 'Invalid account number.')
+
+    def test_balance_is_materialized_on_ledger_insert(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        bank_account = Customer.objects.get(user__email='selcuk1@gmail.com').bankaccount
+        self.create_deposit(bank_account, 100)
+        self.create_deposit(bank_account, 50)
+        last_transaction = BankTransaction.objects.latest('pk')
+
+        bank_account.refresh_from_db()
+        self.assertEqual(bank_account.balance, 150)
+        self.assertEqual(bank_account.balance_watermark, last_transaction.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(bank_account.total_balance, 150)
+
+    def test_rebuild_balances_command(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        bank_account = Customer.objects.get(user__email='selcuk1@gmail.com').bankaccount
+        self.create_deposit(bank_account, 100)
+        BankAccount.objects.filter(pk=bank_account.pk).update(balance=7)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_balances', verify=True, stdout=StringIO())
+
+        call_command('rebuild_balances', stdout=StringIO())
+        bank_account.refresh_from_db()
+        self.assertEqual(bank_account.balance, 100)
+        call_command('rebuild_balances', verify=True, stdout=StringIO())
+
+    def test_hot_account_credits_go_to_balance_shards(self):
+        self.create_and_authenticate_su()
+        for email, identity_id in (('selcuk1@gmail.com', '12345'), ('selcuk2@gmail.com', '54321')):
+            self.create_customer(email, identity_id)
+        customer1, customer2 = Customer.objects.order_by('pk')
+        BankAccount.objects.update(is_active=True)
+        self.create_deposit(customer1.bankaccount, 500)
+        merchant = customer2.bankaccount
+        call_command('hot_account', merchant.account_number, '--shards', '4', stdout=StringIO())
+        merchant.refresh_from_db()
+        self.assertEqual(merchant.hot_shards, 4)
+        self.assertEqual(merchant.balance_shards.count(), 4)
+
+        self.client.force_authenticate(user=User.objects.get(pk=customer1.user_id))
+        for _ in range(3):
+            response = self.client.post(reverse('management:transfer'), {
+                'destination_account_number': merchant.account_number, 'amount': 100,
+            })
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.create_deposit(merchant, 50)
+
+        merchant.refresh_from_db()
+        self.assertEqual(merchant.balance, 0)
+        self.assertEqual(merchant.total_balance, 350)
+        self.assertEqual(BankAccount.objects.with_shard_balance().get(pk=merchant.pk).total_balance, 350)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('management:account-list'))
+        self.assertEqual([account['balance'] for account in response.data['results']], ['200.00', '350.00'])
+        call_command('rebuild_balances', verify=True, stdout=StringIO())
+
+        # Debits count the shards.
+        self.client.force_authenticate(user=User.objects.get(pk=customer2.user_id))
+        response = self.client.post(reverse('management:withdraw'), {'amount': 340})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        response = self.client.post(reverse('management:withdraw'), {'amount': 20})
+        self.assertEqual(str(response.data['amount']), 'Insufficient balance.')
+
+        call_command('sweep_balance_shards', '--once', stdout=StringIO())
+        merchant.refresh_from_db()
+        self.assertEqual(merchant.balance, 10)
+        self.assertEqual(merchant.balance_watermark, BankTransaction.objects.filter(bank_account=merchant).latest('pk').pk)
+        self.assertFalse(merchant.balance_shards.exclude(balance=0).exists())
+        call_command('rebuild_balances', verify=True, stdout=StringIO())
+
+        call_command('hot_account', merchant.account_number, '--shards', '0', stdout=StringIO())
+        self.assertFalse(merchant.balance_shards.exists())
+        self.assertEqual(BankAccount.objects.get(pk=merchant.pk).total_balance, 10)
+
+    def test_account_list_query_count_is_constant(self):
+        self.create_and_authenticate_su()
+        url = reverse('management:account-list')
+        self.create_customer('selcuk1@gmail.com', '12345')
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get(url)
+
+        for index in range(5):
+            self.create_customer(f'customer{index}@gmail.com', f'9000{index}')
+        with self.assertNumQueries(len(small_page)):
+            response = self.client.get(url)
+        self.assertEqual(response.data['count'], 6)
+
+    def test_principal_is_loaded_once_per_request(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        customer = Customer.objects.select_related('bankaccount').get(user__email='selcuk1@gmail.com')
+        request = Request(self.factory.get('/'))
+        request.user = User.objects.get(pk=customer.user_id)
+        with self.assertNumQueries(1):
+            principal = get_principal(request)
+            self.assertEqual(principal.customer, customer)
+            self.assertEqual(principal.account, customer.bankaccount)
+        with self.assertNumQueries(0):
+            self.assertIs(get_principal(request), principal)
+            self.assertTrue(IsCustomer().has_permission(request, None))
+            self.assertIs(request.user.customer.bankaccount, principal.account)
+
+    # Counts the ledger's queries: the shared DatabaseCache would add its own.
+    @override_settings(BALANCE_CACHE={'BACKEND': 'management.balance_cache.LocalBalanceCache'})
+    def test_money_movement_query_counts(self):
+        for email, identity_id in (('selcuk1@gmail.com', '12345'), ('selcuk2@gmail.com', '54321')):
+            self.create_customer(email, identity_id)
+        customer1, customer2 = Customer.objects.order_by('pk')
+        BankAccount.objects.update(is_active=True)
+        self.create_deposit(customer1.bankaccount, 500)
+
+        # The principal query, then the ledger writes (savepoint, insert, balance update,
+        # outbox insert); the transfer also looks up and locks both accounts, reads back
+        # the transfer id without RETURNING from bulk inserts and loads the debit leg for
+        # the response. The SQL fast path does the locks and writes in one statement.
+        if fast_path.is_enabled():
+            withdraw_queries, transfer_queries = 4, 5
+        else:
+            withdraw_queries = 9
+            transfer_queries = 15 if connection.features.can_return_rows_from_bulk_insert else 16
+        for url, data, queries in (
+            ('management:deposit', {'amount': 100}, 6),
+            ('management:withdraw', {'amount': 100}, withdraw_queries),
+            ('management:transfer', {'destination_account_number': customer2.bankaccount.account_number,
+                                     'amount': 100}, transfer_queries),
+        ):
+            self.client.force_authenticate(user=User.objects.get(pk=customer1.user_id))
+            with self.assertNumQueries(queries):
+                response = self.client.post(reverse(url), data)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+            self.assertEqual(response.data['amount'], '100.00')
+        customer1.bankaccount.refresh_from_db()
+        self.assertEqual(customer1.bankaccount.total_balance, 400)
+
+    def test_with_ledger_balance_annotation(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        self.create_customer('selcuk2@gmail.com', '54321')
+        bank_customer1 = Customer.objects.get(user__email='selcuk1@gmail.com').bankaccount
+        self.create_deposit(bank_customer1, 100)
+
+        with self.assertNumQueries(1):
+            balances = {
+                account.pk: account.ledger_balance
+                for account in BankAccount.objects.with_ledger_balance()
+            }
+        self.assertEqual(balances[bank_customer1.pk], 100)
+        self.assertEqual(sum(balances.values()), 100)
+
+    def test_transaction_list_cursor_pagination(self):
+        self.create_and_authenticate_su()
+        self.create_customer('selcuk1@gmail.com', '12345')
+        customer = Customer.objects.get(user__email='selcuk1@gmail.com')
+        for amount in range(1, 6):
+            self.create_deposit(customer.bankaccount, amount)
+
+        url = reverse('management:transaction-list', args=[customer.pk])
+        with mock.patch.object(LedgerCursorPagination, 'page_size', 2):
+            pages = []
+            with CaptureQueriesContext(connection) as first_page:
+                response = self.client.get(url)
+            while True:
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                pages.append([row['amount'] for row in response.data['results']])
+                if not response.data['next']:
+                    break
+                with self.assertNumQueries(len(first_page)):
+                    response = self.client.get(response.data['next'])
+
+        self.assertEqual(pages, [['5.00', '4.00'], ['3.00', '2.00'], ['1.00']])
+
+    def test_batch_transfer(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        customer1 = Customer.objects.get(user__email='selcuk1@gmail.com')
+        bank_customer1 = customer1.bankaccount
+        bank_customer1.is_active = True
+        bank_customer1.save()
+        self.create_deposit(bank_customer1, 1000)
+
+        self.create_customer('selcuk2@gmail.com', '54321')
+        bank_customer2 = Customer.objects.get(user__email='selcuk2@gmail.com').bankaccount
+        bank_customer2.is_active = True
+        bank_customer2.save()
+
+        data = {
+            'transfers': [
+                {'destination_account_number': bank_customer2.account_number, 'amount': 600},
+                {'destination_account_number': bank_customer2.account_number, 'amount': 600},
+                {'destination_account_number': '555555555', 'amount': 10},
+                {'destination_account_number': bank_customer2.account_number, 'amount': 400},
+            ]
+        }
+        url = reverse('management:batch-transfer')
+        self.client.force_authenticate(user=customer1.user)
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['success', 'failed', 'failed', 'success'],
+        )
+        self.assertEqual(response.data['results'][1]['errors'], {'amount': 'Insufficient balance.'})
+        self.assertEqual(
+            response.data['results'][2]['errors'],
+            {'destination_account_number': 'Invalid account number.'},
+        )
+
+        bank_customer1.refresh_from_db()
+        bank_customer2.refresh_from_db()
+        self.assertEqual(bank_customer1.total_balance, 0)
+        self.assertEqual(bank_customer2.total_balance, 1000)
+        self.assertEqual(bank_customer1.ledger_balance, 0)
+        self.assertEqual(bank_customer2.ledger_balance, 1000)
+        self.assertEqual(BankTransaction.objects.filter(description='Amount received').count(), 2)
+
+    def test_batch_transfer_with_idempotency_key_is_replayed(self):
+        self.create_customer('selcuk1@gmail.com', '12345')
+        customer1 = Customer.objects.get(user__email='selcuk1@gmail.com')
+        bank_customer1 = customer1.bankaccount
+        bank_customer1.is_active = True
+        bank_customer1.save()
+        self.create_deposit(bank_customer1, 1000)
+        self.create_customer('selcuk2@gmail.com', '54321')
+        bank_customer2 = Customer.objects.get(user__email='selcuk2@gmail.com').bankaccount
+        bank_customer2.is_active = True
+        bank_customer2.save()
+
+        data = {'transfers': [{'destination_account_number': bank_customer2.account_number, 'amount': 300}]}
+        url = reverse('management:batch-transfer')
+        self.client.force_authenticate(user=customer1.user)
+        first = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='payroll-1')
+        retry = self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY='payroll-1')
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+        bank_customer1.refresh_from_db()
+        self.assertEqual(bank_customer1.total_balance, 700)
+        self.assertEqual(BankTransaction.objects.filter(description='Amount received').count(), 1)
+
+    def test_retry_on_conflict_retries_deadlocks(self):
+        cause = Exception('deadlock detected')
+        cause.pgcode = DEADLOCK_DETECTED
+        deadlock = OperationalError('deadlock detected')
+        deadlock.__cause__ = cause
+        calls = []
+
+        @retry_on_conflict
+        def transfer():
+            calls.append(1)
+            if len(calls) < 3:
+                raise deadlock
+            return 'done'
+
+        lock_stats.reset()
+        with mock.patch('management.locking.connection') as mocked_connection, \
+                mock.patch('management.locking.time.sleep'):
+            mocked_connection.in_atomic_block = False
+            self.assertEqual(transfer(), 'done')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(lock_stats.snapshot()['retries'], 2)
+
+    def test_deposit_with_idempotency_key_is_replayed(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        customer = Customer.objects.get(user__username='selcuk@gmail.com')
+        bankaccount = customer.bankaccount
+        bankaccount.is_active = True
+        bankaccount.save()
+        self.client.force_authenticate(user=customer.user)
+
+        url = reverse('management:deposit')
+        first = self.client.post(url, {'amount': 100}, HTTP_IDEMPOTENCY_KEY='top-up-1')
+        with self.assertNumQueries(1):
+            retry = self.client.post(url, {'amount': 100}, HTTP_IDEMPOTENCY_KEY='top-up-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+        conflict = self.client.post(url, {'amount': 5}, HTTP_IDEMPOTENCY_KEY='top-up-1')
+        self.assertEqual(conflict.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        bankaccount.refresh_from_db()
+        self.assertEqual(bankaccount.total_balance, 100)
+        self.assertEqual(BankTransaction.objects.filter(bank_account=bankaccount).count(), 1)
+
+    def test_purge_idempotency_keys_command(self):
+        self.create_and_authenticate_su()
+        for index, expires_in in enumerate((-60, -1, 60)):
+            IdempotencyKey.objects.create(
+                user=self.user,
+                key=f'key-{index}',
+                endpoint='management:deposit',
+                request_hash='',
+                response_status=status.HTTP_201_CREATED,
+                expires_at=timezone.now() + timedelta(seconds=expires_in),
+            )
+
+        call_command('purge_idempotency_keys', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key-2'])
+
+    # Counts the ledger's queries: the shared DatabaseCache would add its own.
+    @override_settings(BALANCE_CACHE={'BACKEND': 'management.balance_cache.LocalBalanceCache'})
+    def test_get_balance_is_cached_until_money_moves(self):
+        get_balance_cache().clear()
+        self.create_and_authenticate_su()
+        self.create_customer('selcuk@gmail.com', '123456')
+        customer = Customer.objects.get(user__username='selcuk@gmail.com')
+        url = reverse('customers:get-balance', args=[customer.pk])
+
+        self.assertEqual(self.client.get(url).data['balance'], '0.00')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['balance'], '0.00')
+
+        self.create_deposit(customer.bankaccount, 100)
+        self.assertEqual(self.client.get(url).data['balance'], '100.00')
+
+        customer.bankaccount.is_active = True
+        customer.bankaccount.save()
+        self.assertTrue(self.client.get(url).data['is_active'])
+
+    def test_close_ledger_period_and_archive(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        account = Customer.objects.get(user__username='selcuk@gmail.com').bankaccount
+        for amount in (100, 250):
+            self.create_deposit(account, amount)
+        BankTransaction.objects.update(created_date=timezone.now() - timedelta(days=90))
+        self.create_deposit(account, 50)
+        period_end = timezone.now() - timedelta(days=30)
+
+        with self.assertRaises(CommandError):
+            call_command('archive_ledger', '--before', f'{period_end:%Y-%m-%d}', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('close_ledger_period', '--through', f'{timezone.now() + timedelta(days=1):%Y-%m-%d}',
+                         stdout=StringIO())
+
+        close_period(period_end)
+        closing = account.period_balances.get()
+        self.assertEqual(closing.closing_balance, 350)
+        with self.assertRaises(PeriodError):
+            close_period(period_end)
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = archive_closed_rows(period_end, directory)
+            with gzip.open(paths[0], 'rt') as archive:
+                self.assertEqual(len(archive.readlines()), 3)
+
+        self.assertEqual(BankTransaction.objects.count(), 1)
+        account = BankAccount.objects.with_ledger_balance().get(pk=account.pk)
+        self.assertEqual(account.ledger_balance, 400)
+        self.assertEqual(BankAccount.objects.get(pk=account.pk).ledger_balance, 400)
+        call_command('rebuild_balances', verify=True, stdout=StringIO())
+
+    def test_account_numbers_are_sequential_with_check_digit(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        first = BankAccount.objects.get().account_number
+        numbers = BankAccount.generate_account_numbers(3)
+        self.assertTrue(all(is_valid_account_number(number) for number in [first] + numbers))
+        self.assertEqual([int(number[:-1]) for number in numbers], [int(first[:-1]) + step for step in (1, 2, 3)])
+        self.assertFalse(is_valid_account_number(first[:-1] + str((int(first[-1]) + 1) % 10)))
+
+    def test_postings_are_delivered_through_the_outbox(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        self.create_customer('selcuk2@gmail.com', '1234562')
+        customer, other = Customer.objects.order_by('pk')
+        self.create_deposit(customer.bankaccount, 100)
+        BankTransaction.objects.post([BankTransaction(
+            bank_account=customer.bankaccount, sender=customer, receiver=other,
+            amount=40, is_debit=True, description='Amount transferred',
+        )])
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+        class FailingSink(BaseSink):
+            name = 'failing'
+
+            def send(self, events):
+                raise OSError('unreachable')
+
+        queue_sink = QueueSink()
+        with self.assertRaises(DeliveryError):
+            drain_batch(sinks=[queue_sink, FailingSink()])
+        self.assertEqual(list(OutboxEvent.objects.values_list('attempts', flat=True)), [1, 1])
+        self.assertIn('unreachable', OutboxEvent.objects.first().last_error)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'outbox.jsonl')
+            with override_settings(OUTBOX={**settings.OUTBOX, 'SINKS': [
+                {'BACKEND': 'management.outbox.FileSink', 'OPTIONS': {'PATH': path}},
+            ]}):
+                call_command('drain_outbox', '--once', '--batch-size', '1', stdout=StringIO())
+            with open(path) as delivered:
+                events = [json.loads(line) for line in delivered]
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([event['payload']['amount'] for event in events], ['100.00', '40.00'])
+        self.assertEqual(events[1]['payload']['receiver_id'], other.pk)
+        # At least once: the failed attempt reached the first sink already.
+        self.assertEqual(queue_sink.queue.qsize(), 2)
+
+    @override_settings(OUTBOX={**settings.OUTBOX, 'MAX_ATTEMPTS': 2})
+    def test_failing_outbox_events_are_parked(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        account = Customer.objects.get().bankaccount
+        for amount in (100, 200, 300):
+            self.create_deposit(account, amount)
+        poison = OutboxEvent.objects.order_by('pk').first()
+
+        class PoisonSink(BaseSink):
+            name = 'poison'
+
+            def __init__(self):
+                self.delivered = []
+
+            def send(self, events):
+                if any(event.pk == poison.pk for event in events):
+                    raise ValueError('cannot encode')
+                self.delivered.extend(event.payload['amount'] for event in events)
+
+        sink = PoisonSink()
+        with self.assertRaises(DeliveryError):
+            drain_batch(sinks=[sink])
+        # Retried alone, so the events batched with it are not parked on its failures.
+        with self.assertRaisesMessage(DeliveryError, f'event {poison.pk} parked after 2 attempts'):
+            drain_batch(sinks=[sink])
+        self.assertEqual(drain_batch(sinks=[sink]), 1)
+        self.assertEqual(drain_batch(sinks=[sink]), 1)
+        self.assertEqual(drain_batch(sinks=[sink]), 0)
+        self.assertEqual(sink.delivered, ['200.00', '300.00'])
+        poison.refresh_from_db()
+        self.assertEqual(poison.attempts, 2)
+        self.assertIsNotNone(poison.parked_date)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'outbox.jsonl')
+            with override_settings(OUTBOX={**settings.OUTBOX, 'SINKS': [
+                {'BACKEND': 'management.outbox.FileSink', 'OPTIONS': {'PATH': path}},
+            ]}):
+                call_command('drain_outbox', '--once', '--requeue-parked', stdout=StringIO())
+            with open(path) as delivered:
+                self.assertEqual([json.loads(line)['id'] for line in delivered], [poison.pk])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_statement_export(self):
+        self.create_customer('selcuk@gmail.com', '123456')
+        self.create_customer('selcuk2@gmail.com', '1234562')
+        customer, other = Customer.objects.order_by('pk')
+        for amount, days_ago in ((100, 3), (250, 2), (40, 1)):
+            self.create_deposit(customer.bankaccount, amount)
+            BankTransaction.objects.filter(pk=BankTransaction.objects.latest('pk').pk).update(
+                created_date=timezone.now() - timedelta(days=days_ago),
+            )
+        BankTransaction.objects.filter(amount=40).update(is_debit=True)
+        url = reverse('management:statement', args=[customer.pk])
+
+        self.client.force_authenticate(user=customer.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn(customer.bankaccount.account_number, response['Content-Disposition'])
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['balance'] for row in rows], ['100.00', '350.00', '310.00'])
+        self.assertEqual(rows[2]['type'], 'debit')
+
+        since = f'{timezone.localtime() - timedelta(days=2):%Y-%m-%d}'
+        response = self.client.get(url, {'format': 'ndjson', 'from': since})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([(row['amount'], row['balance']) for row in rows], [('250.00', '350.00'), ('40.00', '310.00')])
+
+        self.assertEqual(self.client.get(url, {'from': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=other.user)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_statement_running_balance_after_archive(self):
+        self.create_and_authenticate_su()
+        self.create_customer('selcuk@gmail.com', '123456')
+        account = Customer.objects.get(user__username='selcuk@gmail.com').bankaccount
+        for amount in (100, 250):
+            self.create_deposit(account, amount)
+        BankTransaction.objects.update(created_date=timezone.now() - timedelta(days=90))
+        self.create_deposit(account, 50)
+        period_end = timezone.now() - timedelta(days=30)
+        close_period(period_end)
+        with tempfile.TemporaryDirectory() as directory:
+            archive_closed_rows(period_end, directory)
+
+        response = self.client.get(reverse('management:statement', args=[account.owner_id]), {'format': 'ndjson'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['balance'] for row in rows], ['400.00'])
+
+    @override_settings(BALANCE_CACHE={
+        'BACKEND': 'management.balance_cache.SharedBalanceCache',
+        'OPTIONS': {'CACHE_ALIAS': 'default', 'KEY_PREFIX': 'test-balance'},
+    })
+    def test_get_balance_with_shared_cache(self):
+        caches['default'].clear()
+        self.create_and_authenticate_su()
+        self.create_customer('selcuk@gmail.com', '123456')
+        customer = Customer.objects.get(user__username='selcuk@gmail.com')
+        url = reverse('customers:get-balance', args=[customer.pk])
+
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['balance'], '0.00')
+        self.create_deposit(customer.bankaccount, 100)
+        self.assertEqual(self.client.get(url).data['balance'], '100.00')
+        self.assertIsInstance(get_balance_cache(), SharedBalanceCache)
+        self.assertEqual(get_balance_cache().hits, 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'The SQL fast path needs PostgreSQL.')
+@override_settings(LEDGER_SQL_FAST_PATH=True)
+class SQLFastPathAPITest(BankAccountViewSetAPITest):
+    """The API tests again, with withdrawals and transfers through the SQL fast path."""
+
+
+@skipUnless(connection.vendor == 'postgresql', 'The SQL fast path needs PostgreSQL.')
+class SQLFastPathParityTest(TransactionTestCase):
+    """The SQL fast path posts exactly what the ORM path posts, and fails where it fails."""
+
+    def request_for(self, account):
+        request = Request(APIRequestFactory().post('/'))
+        request.user = User.objects.get(customer__bankaccount=account)
+        return request
+
+    def post(self, serializer_class, account, data):
+        serializer = serializer_class(data=data, context={'request': self.request_for(account)})
+        serializer.is_valid(raise_exception=True)
+        try:
+            serializer.save()
+        except ValidationError as exc:
+            return {field: str(error) for field, error in exc.detail.items()}
+        return 'ok'
+
+    def scenario(self, prefix):
+        """Run every outcome of withdrawals and transfers, return what they posted."""
+        BankAccountViewSetAPITest.create_customer(f'{prefix}-payer@gmail.com', f'{prefix}1')
+        BankAccountViewSetAPITest.create_customer(f'{prefix}-payee@gmail.com', f'{prefix}2')
+        BankAccountViewSetAPITest.create_customer(f'{prefix}-closed@gmail.com', f'{prefix}3')
+        BankAccountViewSetAPITest.create_customer(f'{prefix}-merchant@gmail.com', f'{prefix}4')
+        accounts = {
+            role: BankAccount.objects.get(owner__user__username=f'{prefix}-{role}@gmail.com')
+            for role in ('payer', 'payee', 'closed', 'merchant')
+        }
+        roles = {account.pk: role for role, account in accounts.items()}
+        BankAccount.objects.filter(pk__in=roles).exclude(pk=accounts['closed'].pk).update(is_active=True)
+        set_hot_shards(accounts['merchant'], 4)
+        BankAccountViewSetAPITest.create_deposit(accounts['payer'], 1000)
+        BankAccountViewSetAPITest.create_deposit(accounts['closed'], 100)
+        first_event = OutboxEvent.objects.order_by('-pk').values_list('pk', flat=True).first()
+
+        def transfer(sender, receiver, amount):
+            number = accounts[receiver].account_number if receiver in accounts else receiver
+            return self.post(TransferTransactionSerializer, accounts[sender], {
+                'destination_account_number': number, 'amount': amount,
+            })
+
+        results = [
+            self.post(WithdrawSerializer, accounts['payer'], {'amount': 100}),
+            self.post(WithdrawSerializer, accounts['payer'], {'amount': 5000}),
+            transfer('payer', 'payee', 200),
+            transfer('payer', 'payee', 10000),
+            transfer('payer', '000000000000000', 10),
+            transfer('payer', 'closed', 10),
+            transfer('closed', 'payee', 10),
+            transfer('payer', 'payer', 50),
+            transfer('payer', 'merchant', 300),
+            transfer('payee', 'merchant', 150),
+            # The merchant's balance is all on its shards.
+            self.post(WithdrawSerializer, accounts['merchant'], {'amount': 420}),
+            self.post(WithdrawSerializer, accounts['merchant'], {'amount': 40}),
+        ]
+        balances = {role: (account.total_balance, account.ledger_balance)
+                    for role, account in ((role, BankAccount.objects.get(pk=account.pk))
+                                          for role, account in accounts.items())}
+        events = [
+            (roles[payload['account_id']], payload['amount'], payload['is_debit'], payload['description'],
+             payload['transfer_id'] is not None)
+            for payload in OutboxEvent.objects.filter(pk__gt=first_event).order_by('pk').values_list('payload', flat=True)
+        ]
+        return results, balances, events
+
+    def test_fast_path_matches_the_orm_path(self):
+        with override_settings(LEDGER_SQL_FAST_PATH=False):
+            expected = self.scenario('orm')
+        with override_settings(LEDGER_SQL_FAST_PATH=True):
+            self.assertTrue(fast_path.is_enabled())
+            actual = self.scenario('sql')
+        self.assertEqual(actual, expected)
+        results, balances, _ = actual
+        self.assertEqual(results[1], {'amount': 'Insufficient balance.'})
+        self.assertEqual(results[4], {'destination_account_number': 'Invalid account number.'})
+        self.assertEqual(results[5], {'receiver': 'Bank account is not active.'})
+        self.assertEqual(results[6], {'sender': 'Bank account is not active.'})
+        self.assertEqual(balances['merchant'], (30, 30))
+        for total, ledger in balances.values():
+            self.assertEqual(total, ledger)
+
+    @override_settings(LEDGER_SQL_FAST_PATH=True)
+    def test_concurrent_fast_path_postings(self):
+        _, balances, _ = self.scenario('sql')
+        accounts = list(BankAccount.objects.filter(is_active=True).order_by('pk'))
+        merchant = next(account for account in accounts if account.hot_shards)
+        payers = [account for account in accounts if not account.hot_shards]
+
+        for payer in payers:
+            BankAccountViewSetAPITest.create_deposit(payer, 1000)
+
+        def move(index):
+            sender = payers[index % len(payers)]
+            try:
+                if index % 3 == 0:
+                    return self.post(WithdrawSerializer, sender, {'amount': 1})
+                receiver = merchant if index % 3 == 1 else payers[(index + 1) % len(payers)]
+                return self.post(TransferTransactionSerializer, sender, {
+                    'destination_account_number': receiver.account_number, 'amount': 1,
+                })
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(move, range(600)))
+
+        self.assertEqual(results, ['ok'] * 600)
+        call_command('rebuild_balances', verify=True, stdout=StringIO())
+        self.assertEqual(OutboxEvent.objects.count(), BankTransaction.objects.count())
+        self.assertEqual(sum(account.total_balance for account in BankAccount.objects.all()),
+                         sum(total for total, _ in balances.values()) + 1000 * len(payers) - 200)
+
+
+class AccountNumberTest(SimpleTestCase):
+
+    def test_check_digit(self):
+        self.assertEqual(check_digit('7992739871'), '3')
+        self.assertEqual(format_account_number(42), '00000000000422')
+        self.assertTrue(is_valid_account_number('00000000000422'))
+        self.assertFalse(is_valid_account_number('00000000000423'))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Account number blocks come from a PostgreSQL sequence.')
+class AccountNumberBlockTest(TransactionTestCase):
+
+    def test_allocators_receive_disjoint_blocks(self):
+        first, second = AccountNumberAllocator(), AccountNumberAllocator()
+        numbers = first.allocate(BLOCK_SIZE + 1) + second.allocate(2)
+        self.assertEqual(len(set(numbers)), BLOCK_SIZE + 3)
+        self.assertEqual((first.blocks, second.blocks), (2, 1))
+        first.reset()
+        self.assertNotIn(first.allocate()[0], numbers)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Row locks need PostgreSQL.')
+class TransferConcurrencyTest(TransactionTestCase):
+    TRANSFERS = 2000
+
+    def setUp(self):
+        for email, identity_id in (('selcuk1@gmail.com', '12345'), ('selcuk2@gmail.com', '54321')):
+            BankAccountViewSetAPITest.create_customer(email, identity_id)
+        self.banks = list(BankAccount.objects.order_by('pk'))
+        for bank in self.banks:
+            bank.is_active = True
+            bank.save()
+            BankAccountViewSetAPITest.create_deposit(bank, 1000)
+        lock_stats.reset()
+
+    def transfer(self, index):
+        sender_bank, receiver_bank = self.banks[index % 2], self.banks[(index + 1) % 2]
+        request = Request(APIRequestFactory().post('/'))
+        try:
+            request.user = User.objects.get(customer__bankaccount=sender_bank)
+            serializer = TransferTransactionSerializer(data={
+                'destination_account_number': receiver_bank.account_number,
+                'amount': 1,
+            }, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        finally:
+            connections.close_all()
+
+    def test_opposite_transfers_do_not_deadlock(self):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(self.transfer, range(self.TRANSFERS)))
+
+        ledger_total = 0
+        for bank in self.banks:
+            bank.refresh_from_db()
+            self.assertEqual(bank.balance, bank.ledger_balance)
+            ledger_total += bank.balance
+        self.assertEqual(ledger_total, 2000)
+        self.assertEqual(BankTransaction.objects.count(), 2 + 2 * self.TRANSFERS)
+        self.assertEqual(lock_stats.snapshot()['conflicts'], 0)
+
+
+@override_settings(DEPOSIT_GROUP_COMMIT={'ENABLED': True, 'MAX_BATCH': 10, 'MAX_WAIT': 1.0})
+class DepositGroupCommitTest(TransactionTestCase):
+
+    def setUp(self):
+        BankAccountViewSetAPITest.create_customer('selcuk1@gmail.com', '12345')
+        BankAccount.objects.update(is_active=True)
+        self.customer = Customer.objects.select_related('bankaccount', 'user').get()
+        self.batcher = get_deposit_batcher()
+
+    def test_deposits_are_committed_together(self):
+        deposit = Deposit(self.customer.bankaccount.pk, self.customer.pk, 10)
+        with mock.patch.object(group_commit, 'post_deposits', wraps=group_commit.post_deposits) as post:
+            futures = [self.batcher.submit(deposit) for _ in range(10)]
+            rows = [future.result(5) for future in futures]
+        post.assert_called_once()
+        self.assertEqual(len({row.pk for row in rows}), 10)
+        self.assertEqual(BankTransaction.objects.count(), 10)
+        self.assertEqual(OutboxEvent.objects.count(), 10)
+        account = BankAccount.objects.get()
+        self.assertEqual(account.balance, 100)
+        self.assertEqual(account.balance_watermark, max(row.pk for row in rows))
+
+    def test_failed_deposit_does_not_fail_its_batch(self):
+        good = Deposit(self.customer.bankaccount.pk, self.customer.pk, 10)
+        bad = Deposit(self.customer.bankaccount.pk + 1000, self.customer.pk, 10)
+        self.batcher.max_wait = 0.05
+        futures = [self.batcher.submit(deposit) for deposit in (good, bad, good)]
+        self.assertIsNotNone(futures[0].result(5).pk)
+        with self.assertRaises(IntegrityError):
+            futures[1].result(5)
+        self.assertIsNotNone(futures[2].result(5).pk)
+        self.assertEqual(BankAccount.objects.get().balance, 20)
+
+    def test_deposit_endpoint(self):
+        self.batcher.max_wait = 0.01
+        client = APIClient()
+        client.force_authenticate(user=self.customer.user)
+        response = client.post(reverse('management:deposit'), {'amount': 100})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        self.assertEqual(response.data['id'], BankTransaction.objects.get().pk)
+        self.assertEqual(response.data['bank_account'], self.customer.bankaccount.account_number)
+        self.assertEqual(BankAccount.objects.get().balance, 100)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Native partitioning needs PostgreSQL.')
+class LedgerPartitionTest(TransactionTestCase):
+
+    def test_missing_partition_takes_over_rows_of_the_default_partition(self):
+        self.assertTrue(partitions.is_partitioned())
+        BankAccountViewSetAPITest.create_customer('selcuk@gmail.com', '123456')
+        account = BankAccount.objects.get()
+        BankAccountViewSetAPITest.create_deposit(account, 100)
+        future = partitions.month_start(timezone.now() + timedelta(days=5 * 365))
+        BankTransaction.objects.update(created_date=future)
+
+        self.assertEqual(partitions.ensure_partitions(future, future), [partitions.partition_name(future)])
+        self.assertIn(future, [partition.lower for partition in partitions.list_partitions()])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {partitions.partition_name(future)}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(BankAccount.objects.with_ledger_balance().get().ledger_balance, 100)
+
+
+class AsyncViewTest(TransactionTestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_db_executor()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        for email, identity_id in (('selcuk1@gmail.com', '12345'), ('selcuk2@gmail.com', '54321')):
+            BankAccountViewSetAPITest.create_customer(email, identity_id)
+        self.customer1, self.customer2 = Customer.objects.order_by('pk')
+        for customer in (self.customer1, self.customer2):
+            customer.bankaccount.is_active = True
+            customer.bankaccount.save()
+        BankAccountViewSetAPITest.create_deposit(self.customer1.bankaccount, 1000)
+
+    def call(self, view_class, request, user):
+        request._force_auth_user = user
+        return async_to_sync(async_api_view(view_class))(request)
+
+    def test_async_transfer(self):
+        request = self.factory.post(reverse('management:transfer'), {
+            'sender': self.customer1.pk,
+            'destination_account_number': self.customer2.bankaccount.account_number,
+            'amount': 300,
+        }, content_type='application/json')
+        response = self.call(CreateTransfer, request, self.customer1.user)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        request = self.factory.get(reverse('management:account-list'))
+        response = self.call(AccountListAPIView, request, self.customer2.user)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['balance'], '300.00')
+
+
+    def test_streaming_response_is_produced_on_a_database_thread(self):
+        account = self.customer1.bankaccount
+        response = StreamingHttpResponse(
+            CSVStatementRenderer.lines(statement_rows(account)), content_type='text/csv',
+        )
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(ASGIHandler().send_response)(response, send)
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+        self.assertEqual(body.splitlines()[1].split(',')[4], '1000.00')
+        self.assertFalse(messages[-1].get('more_body', False))
+
+
+class BalanceCacheTest(SimpleTestCase):
+
+    def test_lru_eviction_and_expiry(self):
+        cache = LocalBalanceCache(timeout=60, max_entries=2)
+        for account_id in (1, 2, 3):
+            cache.get_or_load(account_id, lambda pk: {'id': pk})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3), {'id': 3})
+
+        with mock.patch('management.balance_cache.time.monotonic', return_value=10 ** 9):
+            self.assertIsNone(cache.get(3))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 5, 2))
+
+    def test_fill_racing_an_invalidation_is_not_stored(self):
+        cache = LocalBalanceCache()
+
+        def load(account_id):
+            cache.invalidate([account_id])
+            return {'balance': 'stale'}
+
+        self.assertEqual(cache.get_or_load(1, load), {'balance': 'stale'})
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get_or_load(1, lambda pk: {'balance': 'fresh'}), {'balance': 'fresh'})
+        self.assertEqual(cache.get(1), {'balance': 'fresh'})
+
+    def test_concurrent_misses_load_once(self):
+        cache = LocalBalanceCache()
+        loads = []
+        release = threading.Event()
+
+        def load(account_id):
+            loads.append(account_id)
+            release.wait(5)
+            return {'id': account_id}
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [pool.submit(cache.get_or_load, 1, load) for _ in range(8)]
+            while not loads:
+                time.sleep(0.001)
+            time.sleep(0.05)
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(loads, [1])
+        self.assertEqual(results, [{'id': 1}] * 8)
+        self.assertEqual(cache.coalesced + cache.hits, 7)